@@ -1,6 +1,15 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.forms.models import BaseInlineFormSet
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.template.defaultfilters import truncatechars
+from django.utils.translation import ugettext_lazy as _
 
-from .models import Poll, Question, Answer, Profile, AnswerProfile, Walkthrough, WalkthroughProfile
+from . import app_settings
+from .models import Poll, Question, Answer, Profile, AnswerProfile, Walkthrough, WalkthroughProfile, ArchivedWalkthrough
+from .sharding import db_for, get_shards, shard_for
 
 
 def inline(model, inline_class=admin.StackedInline, **kwargs):
@@ -8,6 +17,141 @@ def inline(model, inline_class=admin.StackedInline, **kwargs):
     return type(model.__class__.__name__ + 'Inline', (inline_class,), kwargs)
 
 
+def estimated_count(queryset):
+    """
+    counts the rows of queryset up to ADMIN_COUNT_LIMIT. Bigger unfiltered tables are
+    estimated from the database statistics, where available.
+    """
+    connection = connections[queryset.db]
+    limit = app_settings.ADMIN_COUNT_LIMIT
+    cursor = connection.cursor()
+
+    if not queryset.query.where:
+        table = queryset.model._meta.db_table
+        estimate = None
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            estimate = row and row[0]
+        elif connection.vendor == 'mysql':
+            cursor.execute('SHOW TABLE STATUS LIKE %s', [table])
+            row = cursor.fetchone()
+            estimate = row and row[4]
+        if estimate and estimate > limit:
+            return int(estimate)
+
+    sql, params = queryset.order_by().values_list('pk')[:limit].query.sql_with_params()
+    cursor.execute('SELECT COUNT(*) FROM (%s) subquery' % sql, params)
+    return cursor.fetchone()[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    changelist with estimated counts and links to the next rows by id (?id__lt=<last id>)
+    instead of page numbers, which would need an OFFSET scan
+    """
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        self.result_count = paginator.count
+        if not self.query_set.query.where:
+            self.full_result_count = self.result_count
+        else:
+            self.full_result_count = self.model_admin.get_paginator(request, self.root_query_set, 1).count
+
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+
+        if (self.show_all and self.can_show_all) or not self.multi_page:
+            self.result_list = list(self.query_set._clone())
+        else:
+            self.result_list = list(paginator.page(1).object_list)
+        self.paginator = paginator
+
+        self.newest_query_string = None
+        self.older_query_string = None
+        if 'id__lt' in self.params:
+            self.newest_query_string = self.get_query_string(remove=['id__lt', PAGE_VAR])
+        if len(self.result_list) == self.list_per_page:
+            self.older_query_string = self.get_query_string({'id__lt': self.result_list[-1].pk}, [PAGE_VAR])
+
+
+def cached_choices(key, get_choices):
+    """
+    returns the list filter choices cached under key, get_choices returns them as
+    [(id, (text, ...))] on a miss
+    """
+    key = 'profilingpoll:admin:%s' % key
+    choices = cache.get(key)
+    if choices is None:
+        choices = [(id, truncatechars(' - '.join(texts), 80)) for id, texts in get_choices()]
+        cache.set(key, choices, app_settings.ADMIN_CHOICES_CACHE_TIMEOUT)
+    return choices
+
+
+class AnswerProfileFilter(admin.SimpleListFilter):
+    """
+    list filter on profile ids by a subquery instead of joining and distincting the
+    whole answer table
+    """
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__in=AnswerProfile.objects.filter(
+                **{self.lookup: self.value()}).values('profile'))
+        return queryset
+
+
+class ProfilePollFilter(AnswerProfileFilter):
+    title = _('poll')
+    parameter_name = 'poll'
+    lookup = 'answer__question__poll'
+
+    def lookups(self, request, model_admin):
+        return cached_choices('poll', lambda: [(id, (title,)) for id, title in Poll.objects.values_list('id', 'title')])
+
+
+class ProfileQuestionFilter(AnswerProfileFilter):
+    title = _('question')
+    parameter_name = 'question'
+    lookup = 'answer__question'
+
+    def lookups(self, request, model_admin):
+        poll = request.GET.get('poll')
+
+        def get_choices():
+            questions = Question.objects.all()
+            if poll:
+                questions = questions.filter(poll=poll)
+            return [(id, (text,)) for id, text in questions.values_list('id', 'text')]
+        return cached_choices('question:%s' % (poll or ''), get_choices)
+
+
+class ProfileAnswerFilter(AnswerProfileFilter):
+    title = _('answer')
+    parameter_name = 'answer'
+    lookup = 'answer'
+
+    def lookups(self, request, model_admin):
+        poll, question = request.GET.get('poll'), request.GET.get('question')
+
+        def get_choices():
+            answers = Answer.objects.all()
+            if question:
+                answers = answers.filter(question=question)
+            elif poll:
+                answers = answers.filter(question__poll=poll)
+            return [(id, (truncatechars(question_text, 40), text))
+                    for id, question_text, text in answers.values_list('id', 'question__text', 'text')]
+        return cached_choices('answer:%s:%s' % (poll or '', question or ''), get_choices)
+
+
 admin.site.register(Poll,
     list_display = ('title', 'active', 'created', 'modified'),
     list_filter = ('active',),
@@ -18,7 +162,7 @@ admin.site.register(Poll,
 )
 
 admin.site.register(Question,
-    list_display = ('__unicode__', 'poll', 'created', 'modified'),
+    list_display = ('__unicode__', 'poll', 'multiple_answers', 'created', 'modified'),
     list_filter = ('poll',),
     inlines = [
         inline(Answer, extra=4, max_num=4)
@@ -38,30 +182,101 @@ class ProfileAdmin(admin.ModelAdmin):
         js = ('lib/tiny_mce/tiny_mce.js', 'js/tinymce_init.js')
 
     list_display = ('__unicode__',)
-    list_filter = ('answers__question__poll', 'answers__question', 'answers',)
+    list_filter = (ProfilePollFilter, ProfileQuestionFilter, ProfileAnswerFilter)
     inlines = [
         inline(AnswerProfile, extra=0)
     ]
 
 admin.site.register(Profile, ProfileAdmin)
 
-admin.site.register(Walkthrough,
+class ShardFilter(admin.SimpleListFilter):
+    """
+    lists the walkthroughs of one shard at a time, the first one by default
+    """
+    title = _('shard')
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        if app_settings.SHARDS:
+            return [(alias, alias) for alias in get_shards()]
+
+    def choices(self, cl):
+        current = self.value() or get_shards()[0]
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': current == lookup,
+                'query_string': cl.get_query_string({self.parameter_name: lookup}, []),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        if app_settings.SHARDS:
+            shard = self.value() if self.value() in get_shards() else get_shards()[0]
+            return queryset.using(shard)
+        return queryset
+
+
+class ShardInlineFormSet(BaseInlineFormSet):
+    """
+    reads the inline rows from the shard of the walkthrough
+    """
+    def __init__(self, data=None, files=None, instance=None, save_as_new=False, prefix=None, queryset=None):
+        if instance is not None and instance.pk is not None:
+            queryset = (queryset if queryset is not None else self.model._default_manager).using(db_for(instance))
+        super(ShardInlineFormSet, self).__init__(data, files, instance, save_as_new, prefix, queryset)
+
+
+class KeysetAdmin(admin.ModelAdmin):
+    """
+    admin of big tables, listed newest first by keyset
+    """
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    change_list_template = 'admin/profilingpoll/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class WalkthroughAdmin(KeysetAdmin):
     list_display = ('poll', 'email', 'get_matching_profile', '_progress', '_completed', 'created', 'modified', 'ip',
-                    'user_agent'),
-    list_filter = ('poll',),
-    fields = ('poll', '_progress', '_completed', 'email', 'user_agent', 'ip'),
+                    'user_agent')
+    list_filter = ('poll', ShardFilter)
+    fields = ('poll', '_progress', '_completed', 'email', 'user_agent', 'ip')
     readonly_fields = ('poll', 'answers', '_answered_questions', '_completed', '_profiles', '_progress', 'email',
-                       'ip', 'user_agent'),
+                       'ip', 'user_agent')
     inlines = [
         inline(Walkthrough.answers.through,
             extra=0,
             max_num=0,
+            formset=ShardInlineFormSet,
             readonly_fields = ('answer',)
         ),
         inline(WalkthroughProfile,
             extra=0,
             max_num=0,
+            formset=ShardInlineFormSet,
             readonly_fields = ('walkthrough', 'profile', 'quantifier')
         )
     ]
-)
\ No newline at end of file
+
+    def queryset(self, request):
+        queryset = super(WalkthroughAdmin, self).queryset(request)
+        if app_settings.SHARDS:
+            # the definitions can't be joined from the shards
+            return queryset
+        # everything list_display needs, in the changelist query itself
+        return queryset.select_related('poll', 'poll__default_profile', '_matching_profile')
+
+    def get_object(self, request, object_id):
+        try:
+            return self.queryset(request).using(shard_for(object_id)).get(pk=object_id)
+        except (Walkthrough.DoesNotExist, ValueError):
+            return None
+
+admin.site.register(Walkthrough, WalkthroughAdmin)
+admin.site.register(ArchivedWalkthrough, KeysetAdmin,
+    list_display = ('walkthrough_id', 'poll', 'progress', 'created', 'modified', 'archived'),
+    list_filter = ('poll',),
+    readonly_fields = ('walkthrough_id', 'poll', 'answers', 'progress', 'matching_profile_id', 'created', 'modified'),
+)
@@ -0,0 +1,91 @@
+from django.conf import settings
+
+
+# Seconds a compiled poll plan (and its version token) lives in the django cache
+PLAN_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_PLAN_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# Number of questions kept in process memory, and seconds each is kept at most
+QUESTION_CACHE_SIZE = getattr(settings, 'PROFILINGPOLL_QUESTION_CACHE_SIZE', 1000)
+QUESTION_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_QUESTION_CACHE_TIMEOUT', 60 * 5)
+
+# Number of completed walkthrough ids remembered in the session
+MAX_COMPLETED_WALKTHROUGHS = getattr(settings, 'PROFILINGPOLL_MAX_COMPLETED_WALKTHROUGHS', 10)
+
+# Path of the write-behind answer buffer. If set, answers are appended to this file
+# and applied to the database in batches, see buffer.py
+ANSWER_BUFFER = getattr(settings, 'PROFILINGPOLL_ANSWER_BUFFER', None)
+
+# Seconds between two background flushes of the answer buffer. None: only flush with
+# the flush_answer_buffer command (e.g. from cron) and when a walkthrough is finished
+ANSWER_BUFFER_FLUSH_INTERVAL = getattr(settings, 'PROFILINGPOLL_ANSWER_BUFFER_FLUSH_INTERVAL', 5)
+
+# Number of walkthroughs applied per transaction when flushing the answer buffer
+ANSWER_BUFFER_BATCH_SIZE = getattr(settings, 'PROFILINGPOLL_ANSWER_BUFFER_BATCH_SIZE', 500)
+
+# Number of rows every poll statistics counter is spread over, to avoid hot rows
+STATS_SHARDS = getattr(settings, 'PROFILINGPOLL_STATS_SHARDS', 8)
+
+# Seconds the summed up poll statistics are cached
+STATS_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_STATS_CACHE_TIMEOUT', 60)
+
+# Serve question pages without reading the session, with ETag and Cache-Control headers,
+# so they can be cached by a reverse proxy. The walkthrough state needed by the page is
+# kept in a signed cookie and applied client side, answers are posted to a separate url
+# with the csrf token of the csrf cookie, which the page's script sets if missing.
+CACHEABLE_QUESTIONS = getattr(settings, 'PROFILINGPOLL_CACHEABLE_QUESTIONS', False)
+
+# Seconds cacheable question pages may be cached
+QUESTION_MAX_AGE = getattr(settings, 'PROFILINGPOLL_QUESTION_MAX_AGE', 60 * 5)
+
+# Name of the signed cookie holding the walkthrough state for cacheable question pages
+STATE_COOKIE = getattr(settings, 'PROFILINGPOLL_STATE_COOKIE', 'profilingpoll')
+
+# Count queries, database time and cache hits per view and scoring call, send them as
+# Server-Timing header and aggregate them into histograms, see instrumentation.py
+INSTRUMENTATION = getattr(settings, 'PROFILINGPOLL_INSTRUMENTATION', False)
+
+# Seconds between two writes of the histograms of a process to the django cache
+INSTRUMENTATION_FLUSH_INTERVAL = getattr(settings, 'PROFILINGPOLL_INSTRUMENTATION_FLUSH_INTERVAL', 10)
+
+# Admin changelists count filtered rows only up to this limit and estimate the size of
+# unfiltered tables above it from the database statistics (PostgreSQL, MySQL)
+ADMIN_COUNT_LIMIT = getattr(settings, 'PROFILINGPOLL_ADMIN_COUNT_LIMIT', 10000)
+
+# Seconds the choices of the admin list filters are cached
+ADMIN_CHOICES_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_ADMIN_CHOICES_CACHE_TIMEOUT', 60 * 5)
+
+# Days after their last change incomplete walkthroughs are moved to the archive by the
+# archive_walkthroughs command
+ARCHIVE_AFTER_DAYS = getattr(settings, 'PROFILINGPOLL_ARCHIVE_AFTER_DAYS', 30)
+
+# Seconds the rendered FirstPoll content of the FeinCMS integration is cached
+FIRSTPOLL_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_FIRSTPOLL_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Seconds result snapshots of completed walkthroughs are cached, and may be cached by
+# browsers and proxies
+RESULT_CACHE_TIMEOUT = getattr(settings, 'PROFILINGPOLL_RESULT_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+RESULT_MAX_AGE = getattr(settings, 'PROFILINGPOLL_RESULT_MAX_AGE', 60 * 60 * 24 * 30)
+
+# Database aliases of the walkthrough shards, see sharding.py. None keeps everything on
+# the default database
+SHARDS = getattr(settings, 'PROFILINGPOLL_SHARDS', None)
+
+# Number of walkthrough ids a process reserves at once when sharding
+SHARD_ID_BLOCK_SIZE = getattr(settings, 'PROFILINGPOLL_SHARD_ID_BLOCK_SIZE', 100)
+
+# Answers a client (REMOTE_ADDR and user agent) may post per minute, and at once. Posts
+# above are answered with 429 before the session or the database are touched, see
+# throttling.py. None disables the throttling
+THROTTLE_RATE = getattr(settings, 'PROFILINGPOLL_THROTTLE_RATE', None)
+THROTTLE_BURST = getattr(settings, 'PROFILINGPOLL_THROTTLE_BURST', 10)
+
+# 'local' keeps the throttling state in process memory, per worker, 'cache' shares it
+# through the django cache
+THROTTLE_BACKEND = getattr(settings, 'PROFILINGPOLL_THROTTLE_BACKEND', 'local')
+
+# Number of clients the local throttling backend keeps
+THROTTLE_CLIENTS = getattr(settings, 'PROFILINGPOLL_THROTTLE_CLIENTS', 10000)
+
+# Seconds a client without walkthrough in its session continues the walkthrough it
+# started last instead of creating a new one. None disables this
+DUPLICATE_WALKTHROUGH_WINDOW = getattr(settings, 'PROFILINGPOLL_DUPLICATE_WALKTHROUGH_WINDOW', None)
@@ -0,0 +1,99 @@
+"""
+Archival of abandoned walkthroughs.
+
+Incomplete walkthroughs, which weren't changed for PROFILINGPOLL_ARCHIVE_AFTER_DAYS
+days, are moved in keyset chunks into ArchivedWalkthrough rows with their answer ids
+packed into one column. Every chunk is archived and deleted in its own short
+transaction, so no long locks are held on the walkthrough tables. With sharding, the
+shards are archived one after the other into the archive on the default database.
+
+The statistics counters are left alone: incomplete walkthroughs only count for their
+answers, and rebuild_stats adds up the answers of the archived walkthroughs as well.
+"""
+from datetime import datetime, timedelta
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import app_settings
+from .scoring import group_pairs
+from .sharding import get_shards
+
+
+def stale_walkthroughs(days=None, poll_id=None, using=DEFAULT_DB_ALIAS):
+    """
+    returns the incomplete walkthroughs of the shard using not changed for days days
+    """
+    from .models import Walkthrough
+
+    days = app_settings.ARCHIVE_AFTER_DAYS if days is None else days
+    walkthroughs = Walkthrough.objects.using(using).filter(_completed__isnull=True,
+                                              modified__lt=datetime.now() - timedelta(days=days))
+    if poll_id is not None:
+        walkthroughs = walkthroughs.filter(poll=poll_id)
+    return walkthroughs
+
+
+def archive_walkthroughs(days=None, poll_id=None, chunk_size=500, dry_run=False):
+    """
+    moves the stale walkthroughs to the archive and returns their number. With
+    dry_run they are only counted.
+    """
+    if dry_run:
+        return sum(stale_walkthroughs(days, poll_id, using).count() for using in get_shards())
+    return sum(_archive_shard(stale_walkthroughs(days, poll_id, using), using, chunk_size)
+               for using in get_shards())
+
+
+def _archive_shard(walkthroughs, using, chunk_size):
+    from .models import Walkthrough, WalkthroughProfile, ArchivedWalkthrough
+
+    answers_through = Walkthrough.answers.through
+    questions_through = Walkthrough._answered_questions.through
+    archived = 0
+
+    last_id = 0
+    while True:
+        chunk = list(walkthroughs.filter(id__gt=last_id).order_by('id').values_list(
+            'id', 'poll_id', '_progress', '_matching_profile_id', 'created', 'modified')[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        ids = [row[0] for row in chunk]
+
+        with transaction.commit_on_success(using=using):
+            answers = group_pairs(answers_through.objects.using(using).filter(walkthrough__in=ids).values_list(
+                'walkthrough_id', 'answer_id'))
+            rows = [ArchivedWalkthrough(walkthrough_id=id, poll_id=poll, progress=progress,
+                                        matching_profile_id=matching_profile_id, created=created, modified=modified,
+                                        answers=','.join(str(answer_id) for answer_id in sorted(answers.get(id, ()))))
+                    for id, poll, progress, matching_profile_id, created, modified in chunk]
+            if using == DEFAULT_DB_ALIAS:
+                ArchivedWalkthrough.objects.bulk_create(rows)
+            else:
+                # the archive is committed before the shard: a chunk failing to delete is
+                # already archived and only deleted by the next run
+                done = set(ArchivedWalkthrough.objects.filter(walkthrough_id__in=ids).values_list(
+                    'walkthrough_id', flat=True))
+                with transaction.commit_on_success(using=DEFAULT_DB_ALIAS):
+                    ArchivedWalkthrough.objects.bulk_create([row for row in rows if row.walkthrough_id not in done])
+            answers_through.objects.using(using).filter(walkthrough__in=ids).delete()
+            questions_through.objects.using(using).filter(walkthrough__in=ids).delete()
+            WalkthroughProfile.objects.using(using).filter(walkthrough__in=ids).delete()
+            Walkthrough.objects.using(using).filter(pk__in=ids).delete()
+        archived += len(ids)
+
+    return archived
+
+
+def archived_answer_counts(poll_id):
+    """
+    returns {answer id: archived walkthroughs with this answer} of a poll
+    """
+    from .models import ArchivedWalkthrough
+
+    counts = {}
+    for answers in ArchivedWalkthrough.objects.filter(poll=poll_id).values_list('answers', flat=True).iterator():
+        for answer_id in answers.split(','):
+            if answer_id:
+                counts[int(answer_id)] = counts.get(int(answer_id), 0) + 1
+    return counts
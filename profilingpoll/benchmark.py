@@ -0,0 +1,201 @@
+"""
+Benchmarks of the walkthrough flow and the walkthrough export on synthetic polls.
+
+create_poll generates a poll of configurable size, run_flow drives complete
+walkthroughs (question -> get_email -> result) through the django test client and
+records the queries and latencies per view and the session size, run_export times
+export_walkthroughs over a number of synthetic walkthroughs. The results are plain
+dicts, which the benchmark_walkthroughs command compares against a stored baseline.
+
+benchmark_baseline.json holds the results of the command with its default options on
+SQLite:
+
+    manage.py benchmark_walkthroughs --baseline profilingpoll/benchmark_baseline.json
+
+The query counts and the session size hold on every machine, the latencies only
+roughly; save a baseline of your own with --save-baseline to compare those.
+"""
+import math
+import random
+import time
+from datetime import datetime
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from .exports import iter_csv
+from .models import Poll, Question, Answer, Profile, AnswerProfile, Walkthrough
+from .plan import get_plan, invalidate_plan
+from .scoring import matching_profile_id
+
+
+VIEWS = ('question', 'answer', 'get_email', 'email', 'result')
+
+
+def create_poll(questions=50, answers=6, profiles=20, seed=0):
+    """
+    creates an active poll with random answer -> profile quantifiers
+    """
+    rnd = random.Random(seed)
+    poll = Poll.objects.create(title='Benchmark', slug='benchmark-%s' % datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                               active=True)
+
+    poll.default_profile = Profile.objects.create(description='benchmark default', text='Default')
+    poll.save()
+    profile_ids = [Profile.objects.create(description='benchmark %s' % i, text='Profile %s' % i).pk
+                   for i in range(profiles)]
+
+    # bulk_create doesn't set primary keys, so the rows are read back in id order
+    Question.objects.bulk_create([Question(poll=poll, text='Question %s' % i, ordering=i) for i in range(questions)])
+    question_ids = list(poll.questions.order_by('id').values_list('id', flat=True))
+
+    Answer.objects.bulk_create([Answer(question_id=question_id, text='Answer %s' % i, ordering=i)
+                                for question_id in question_ids for i in range(answers)])
+    answer_ids = list(Answer.objects.filter(question__poll=poll).order_by('id').values_list('id', flat=True))
+
+    AnswerProfile.objects.bulk_create([
+        AnswerProfile(answer_id=answer_id, profile_id=profile_id, quantifier=rnd.randint(1, 10))
+        for answer_id in answer_ids
+        for profile_id in rnd.sample(profile_ids, min(3, len(profile_ids)))
+    ])
+
+    # bulk_create sends no signals
+    invalidate_plan(poll.pk)
+    return poll
+
+
+def percentile(values, percent):
+    """
+    nearest rank percentile of values
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class Recorder(object):
+    """
+    collects queries and latencies of the requests made through request()
+    """
+    def __init__(self):
+        self.queries = dict((view, []) for view in VIEWS)
+        self.timings = dict((view, []) for view in VIEWS)
+
+    def request(self, view, method, *args, **kwargs):
+        use_debug_cursor, connection.use_debug_cursor = connection.use_debug_cursor, True
+        started = time.time()
+        try:
+            response = method(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        self.timings[view].append((time.time() - started) * 1000)
+        # the query log is reset when a request starts
+        self.queries[view].append(len(connection.queries))
+        return response
+
+    def results(self):
+        return dict((view, {
+            # the median, first writes to a statistics counter shard cost some extra queries
+            'queries': percentile(self.queries[view], 50),
+            'max_queries': max(self.queries[view]),
+            'p50': round(percentile(self.timings[view], 50), 3),
+            'p99': round(percentile(self.timings[view], 99), 3),
+        }) for view in VIEWS if self.timings[view])
+
+
+def _session_size(client):
+    session = client.session
+    return len(session.encode(dict(session.items())))
+
+
+def run_flow(poll, walkthroughs=10, seed=0):
+    """
+    answers all questions of poll in walkthroughs fresh sessions and returns
+    {view: {'queries', 'p50', 'p99'}, 'session_size': bytes}
+    """
+    rnd = random.Random(seed)
+    plan = get_plan(poll.pk)
+    recorder = Recorder()
+    session_size = 0
+
+    for i in range(walkthroughs):
+        client = Client()
+        for question_id in plan.question_ids:
+            url = plan.question_url(question_id)
+            recorder.request('question', client.get, url)
+            answer_id = rnd.choice(plan.answer_choices(question_id))[0]
+            recorder.request('answer', client.post, url, {'answer': answer_id})
+            session_size = max(session_size, _session_size(client))
+
+        url = reverse('profilingpoll_get_email', kwargs={'slug': poll.slug})
+        recorder.request('get_email', client.get, url)
+        response = recorder.request('email', client.post, url, {'email': 'benchmark%s@example.com' % i})
+        recorder.request('result', client.get, response['Location'])
+        session_size = max(session_size, _session_size(client))
+
+    results = recorder.results()
+    results['session_size'] = session_size
+    return results
+
+
+def create_walkthroughs(poll, count, batch_size=1000, seed=0):
+    """
+    bulk creates count completed walkthroughs with email. The denormalized fields
+    are set directly from random answers, no answer rows are written.
+    """
+    rnd = random.Random(seed)
+    plan = get_plan(poll.pk)
+    now = datetime.now()
+
+    for start in range(0, count, batch_size):
+        rows = []
+        for i in range(start, min(count, start + batch_size)):
+            answer_ids = [rnd.choice(plan.answer_choices(question_id))[0] for question_id in plan.question_ids]
+            rows.append(Walkthrough(
+                poll=poll, email='walkthrough%s@example.com' % i, ip='127.0.0.1', user_agent='benchmark',
+                _completed=now, _progress=1.0, _matching_profile_id=matching_profile_id(plan.profile_totals(answer_ids)),
+                _answered_bitmap='%x' % plan.bitmap(plan.question_ids), _bitmap_layout=plan.layout))
+        Walkthrough.objects.bulk_create(rows)
+
+
+def run_export(poll, chunk_size=1000):
+    """
+    streams the csv export of poll and returns {'rows', 'queries', 'seconds'}
+    """
+    use_debug_cursor, connection.use_debug_cursor = connection.use_debug_cursor, True
+    queries = len(connection.queries)
+    started = time.time()
+    try:
+        rows = sum(1 for line in iter_csv(poll=poll, chunk_size=chunk_size)) - 1
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    return {
+        'rows': rows,
+        'queries': len(connection.queries) - queries,
+        'seconds': round(time.time() - started, 3),
+    }
+
+
+def compare(results, baseline, tolerance=0.5, path=''):
+    """
+    returns the regressions of results against baseline: more (median or maximal)
+    queries or a bigger session than before, or latencies more than tolerance
+    (0.5 = 50%) slower
+    """
+    regressions = []
+    for key, expected in sorted(baseline.items()):
+        name = '%s.%s' % (path, key) if path else key
+        actual = results.get(key)
+        if actual is None:
+            continue
+        if isinstance(expected, dict):
+            regressions.extend(compare(actual, expected, tolerance, name))
+        elif key in ('queries', 'max_queries', 'session_size'):
+            if actual > expected:
+                regressions.append('%s: %s, baseline %s' % (name, actual, expected))
+        elif key in ('p50', 'p99', 'seconds'):
+            if actual > expected * (1 + tolerance):
+                regressions.append('%s: %s, baseline %s' % (name, actual, expected))
+    return regressions
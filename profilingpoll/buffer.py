@@ -0,0 +1,196 @@
+"""
+Write-behind buffer for answers.
+
+If PROFILINGPOLL_ANSWER_BUFFER is set, QuestionView doesn't write answers to the
+database. It appends them to a local append-only log instead (one JSON line per
+submitted question, fsynced) and only updates the walkthrough state in the session.
+A background thread per process (or the flush_answer_buffer command) periodically
+moves the log aside and applies it in batches with scoring.set_answers, which uses
+bulk operations for the answers through-table, the answered questions and the
+WalkthroughProfile rows.
+
+Applying an event means "these are the answers of walkthrough w to question q",
+so replaying a log after a crash is safe. Finishing visitors only apply the events of
+their own walkthrough, draining the log is left to the flusher.
+"""
+import fcntl
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+
+from . import app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerBuffer(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def append(self, poll_id, walkthrough_id, question_id, answer_ids):
+        line = json.dumps({'poll': poll_id, 'walkthrough': walkthrough_id, 'question': question_id,
+                           'answers': list(answer_ids)}) + '\n'
+
+        while True:
+            with open(self.path, 'a') as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                try:
+                    # the log was moved aside by a flush while we were waiting for the lock
+                    if os.path.exists(self.path) and os.fstat(log.fileno()).st_ino == os.stat(self.path).st_ino:
+                        log.write(line)
+                        log.flush()
+                        os.fsync(log.fileno())
+                        return
+                finally:
+                    fcntl.flock(log, fcntl.LOCK_UN)
+
+    def drain(self):
+        """
+        moves the current log aside and returns the paths of all logs waiting to be applied
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'a') as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                try:
+                    os.rename(self.path, '%s.%.6f.pending' % (self.path, time.time()))
+                finally:
+                    fcntl.flock(log, fcntl.LOCK_UN)
+
+        return sorted(glob.glob(self.path + '.*.pending'))
+
+    @contextmanager
+    def locked(self, blocking=True):
+        """
+        holds the lock of the flushes, yields False without blocking while another
+        process or thread holds it
+        """
+        with open(self.lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except IOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def flush(self, blocking=True):
+        """
+        applies all buffered answers and returns the number of updated walkthroughs.
+        Without blocking, nothing is done while another process is flushing.
+        """
+        with self.locked(blocking) as acquired:
+            if not acquired:
+                return 0
+
+            paths = self.drain()
+            updated = apply_events(itertools.chain(*[read_events(path) for path in paths]))
+            for path in paths:
+                os.remove(path)
+            return updated
+
+    def flush_walkthrough(self, walkthrough_id):
+        """
+        applies the buffered answers of one walkthrough right away, e.g. before its result
+        is shown, without draining the log. The flusher applies them again later, which
+        changes nothing. Holds the flush lock, so the same rows aren't created twice at
+        the same time.
+        """
+        with self.locked():
+            events = []
+            for path in sorted(glob.glob(self.path + '.*.pending')) + [self.path]:
+                try:
+                    events.extend(event for event in read_events(path) if event['walkthrough'] == walkthrough_id)
+                except (IOError, OSError):
+                    # applied and removed by a flush in the meantime
+                    continue
+            return apply_events(events)
+
+
+def read_events(path):
+    with open(path) as log:
+        for line in log:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a line torn by a crash while appending
+                logger.warning('Skipping broken line in answer buffer %s: %r', path, line)
+
+
+def apply_events(events, batch_size=None):
+    """
+    applies answer events in batches, later answers to a question replace earlier ones
+    """
+    from . import scoring
+    from .models import Walkthrough
+    from .sharding import group_ids_by_shard
+
+    batch_size = batch_size or app_settings.ANSWER_BUFFER_BATCH_SIZE
+
+    selections = {}
+    for event in events:
+        selections.setdefault(event['walkthrough'], {})[event['question']] = event['answers']
+
+    walkthrough_ids = sorted(selections)
+    updated = 0
+    for start in range(0, len(walkthrough_ids), batch_size):
+        # walkthroughs deleted in the meantime are skipped
+        shards = group_ids_by_shard(walkthrough_ids[start:start + batch_size])
+        walkthroughs = [walkthrough for using, ids in shards.items()
+                        for walkthrough in Walkthrough.objects.using(using).filter(pk__in=ids)]
+        updated += len(scoring.set_answers(dict((walkthrough, selections[walkthrough.pk])
+                                                for walkthrough in walkthroughs)))
+    return updated
+
+
+class Flusher(threading.Thread):
+    def __init__(self, buffer, interval):
+        super(Flusher, self).__init__(name='profilingpoll-answer-buffer')
+        self.daemon = True
+        self.buffer = buffer
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.buffer.flush(blocking=False)
+            except Exception:
+                logger.exception('Flushing the answer buffer %s failed', self.buffer.path)
+            finally:
+                # scoring writes to every shard
+                for connection in connections.all():
+                    connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """
+    returns the configured AnswerBuffer (and starts its flusher) or None
+    """
+    global _buffer
+
+    if not app_settings.ANSWER_BUFFER:
+        return None
+
+    if _buffer is None or _buffer.path != app_settings.ANSWER_BUFFER:
+        with _buffer_lock:
+            if _buffer is None or _buffer.path != app_settings.ANSWER_BUFFER:
+                _buffer = AnswerBuffer(app_settings.ANSWER_BUFFER)
+                if app_settings.ANSWER_BUFFER_FLUSH_INTERVAL:
+                    Flusher(_buffer, app_settings.ANSWER_BUFFER_FLUSH_INTERVAL).start()
+    return _buffer
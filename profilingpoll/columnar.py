@@ -0,0 +1,172 @@
+"""
+Columnar export of walkthrough answers and profile scores for offline analysis.
+
+Every poll gets a directory with one binary file per column (little endian arrays,
+typecodes as in COLUMNS) and a manifest.json holding the dictionaries, which map the
+small integer codes of questions, answers and profiles to their database ids (code n
+is dictionaries[kind][n - 1], 0 means none), the row count of every table and the
+export watermark.
+
+Exports are incremental: only walkthroughs modified since the watermark of the last
+export are appended, as a new batch. A walkthrough exported several times has rows in
+several batches; readers use the rows of its latest batch, as listed in the
+walkthroughs table.
+"""
+import json
+import os
+import sys
+from array import array
+from datetime import datetime
+
+from .plan import get_plan
+
+
+COLUMNS = {
+    'walkthroughs': (('walkthrough', 'i'), ('batch', 'H'), ('progress', 'f'), ('completed', 'B'), ('profile', 'H')),
+    'answers': (('walkthrough', 'i'), ('batch', 'H'), ('question', 'H'), ('answer', 'H')),
+    'profiles': (('walkthrough', 'i'), ('batch', 'H'), ('profile', 'H'), ('score', 'i')),
+}
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _column_path(directory, table, column):
+    return os.path.join(directory, '%s.%s' % (table, column))
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as manifest:
+            return json.load(manifest)
+    except IOError:
+        return {
+            'watermark': None,
+            'batches': 0,
+            'rows': dict((table, 0) for table in COLUMNS),
+            'dictionaries': {'question': [], 'answer': [], 'profile': []},
+        }
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as tmp:
+        json.dump(manifest, tmp, indent=1)
+    os.rename(path + '.tmp', path)
+
+
+def read_table(directory, table):
+    """
+    returns {column: array} of an exported table
+    """
+    rows = read_manifest(directory)['rows'][table]
+    columns = {}
+    for column, typecode in COLUMNS[table]:
+        values = array(typecode)
+        with open(_column_path(directory, table, column), 'rb') as data:
+            values.fromfile(data, rows)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        columns[column] = values
+    return columns
+
+
+class ColumnarExport(object):
+    def __init__(self, poll, directory):
+        self.poll = poll
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.codes = dict((kind, dict((id, code + 1) for code, id in enumerate(ids)))
+                          for kind, ids in self.manifest['dictionaries'].items())
+
+    def code(self, kind, id):
+        if id is None:
+            return 0
+        if id not in self.codes[kind]:
+            self.manifest['dictionaries'][kind].append(id)
+            self.codes[kind][id] = len(self.manifest['dictionaries'][kind])
+        return self.codes[kind][id]
+
+    def _append(self, table, columns):
+        for column, typecode in COLUMNS[table]:
+            values = array(typecode, columns[column])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            with open(_column_path(self.directory, table, column), 'ab') as data:
+                values.tofile(data)
+        self.manifest['rows'][table] += len(columns['walkthrough'])
+
+    def _truncate(self):
+        # drop rows of an export which crashed before its manifest was written
+        for table, rows in self.manifest['rows'].items():
+            for column, typecode in COLUMNS[table]:
+                path = _column_path(self.directory, table, column)
+                with open(path, 'ab') as data:
+                    data.truncate(rows * array(typecode).itemsize)
+
+    def export(self, chunk_size=5000):
+        """
+        appends all walkthroughs modified since the last export and returns their number
+        """
+        from .models import Walkthrough, WalkthroughProfile
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._truncate()
+
+        started = datetime.now()
+        plan = get_plan(self.poll.pk)
+        batch = self.manifest['batches']
+
+        since = self.manifest['watermark'] and datetime.strptime(self.manifest['watermark'], WATERMARK_FORMAT)
+
+        exported = 0
+        for queryset in Walkthrough.objects.shards():
+            using = queryset.db
+            queryset = queryset.filter(poll=self.poll)
+            if since:
+                queryset = queryset.filter(modified__gte=since)
+
+            last_id = 0
+            while True:
+                chunk = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+                    'id', '_progress', '_completed', '_matching_profile_id')[:chunk_size])
+                if not chunk:
+                    break
+                last_id = chunk[-1][0]
+                ids = [row[0] for row in chunk]
+
+                answers = dict((column, []) for column, typecode in COLUMNS['answers'])
+                for walkthrough_id, answer_id in Walkthrough.answers.through.objects.using(using).filter(
+                        walkthrough__in=ids).order_by('walkthrough', 'answer').values_list(
+                        'walkthrough_id', 'answer_id').iterator():
+                    answers['walkthrough'].append(walkthrough_id)
+                    answers['batch'].append(batch)
+                    answers['question'].append(self.code('question', plan.answer_questions.get(answer_id)))
+                    answers['answer'].append(self.code('answer', answer_id))
+
+                profiles = dict((column, []) for column, typecode in COLUMNS['profiles'])
+                for walkthrough_id, profile_id, quantifier in WalkthroughProfile.objects.using(using).filter(
+                        walkthrough__in=ids).order_by('walkthrough', 'profile').values_list(
+                        'walkthrough_id', 'profile_id', 'quantifier').iterator():
+                    profiles['walkthrough'].append(walkthrough_id)
+                    profiles['batch'].append(batch)
+                    profiles['profile'].append(self.code('profile', profile_id))
+                    profiles['score'].append(quantifier)
+
+                walkthroughs = dict((column, []) for column, typecode in COLUMNS['walkthroughs'])
+                for walkthrough_id, progress, completed, profile_id in chunk:
+                    walkthroughs['walkthrough'].append(walkthrough_id)
+                    walkthroughs['batch'].append(batch)
+                    walkthroughs['progress'].append(progress or 0)
+                    walkthroughs['completed'].append(completed is not None)
+                    walkthroughs['profile'].append(self.code('profile', profile_id or plan.default_profile_id))
+
+                self._append('answers', answers)
+                self._append('profiles', profiles)
+                self._append('walkthroughs', walkthroughs)
+                exported += len(chunk)
+
+        self.manifest['poll'] = self.poll.pk
+        self.manifest['batches'] = batch + 1
+        self.manifest['watermark'] = started.strftime(WATERMARK_FORMAT)
+        write_manifest(self.directory, self.manifest)
+        return exported
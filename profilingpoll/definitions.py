@@ -0,0 +1,280 @@
+"""
+Poll definitions: a whole poll graph as one JSON document.
+
+    {
+        "slug": "best-course", "title": "Best course", "active": true,
+        "description": "...", "finish_text": "...", "default_profile": "beginner",
+        "profiles": {"beginner": {"text": "...", "link": null, "link_text": null}},
+        "questions": [
+            {"id": 1, "text": "...", "multiple_answers": false,
+             "answers": [{"id": 1, "text": "...", "profiles": {"beginner": 2}}]}
+        ]
+    }
+
+The natural keys are the slug for the poll, the optional id for questions and answers
+and the profile description for profiles (the id for profiles without a unique
+description). Questions and answers with an id update the row with that id of the
+poll or question, the ones without are created, so inserting a question leaves the
+following ones alone. Documents without any ids, e.g. written by hand, are matched by
+position instead.
+Importing a definition creates the missing rows with bulk_create and only updates or
+deletes the rows which differ from it, all in one transaction, so re-imports of a
+changed definition are cheap. Profiles are shared between polls and never deleted.
+"""
+from datetime import datetime
+
+from django.db import transaction
+
+from .models import Poll, Question, Answer, Profile, AnswerProfile
+from .plan import invalidate_plan
+from .polls import invalidate_polls
+
+
+POLL_FIELDS = ('title', 'active', 'description', 'finish_text')
+PROFILE_FIELDS = ('text', 'link', 'link_text')
+
+
+def profile_keys(profiles):
+    """
+    returns {profile id: key}, the description or, if missing or ambiguous, the id
+    """
+    descriptions = {}
+    for description in Profile.objects.filter(description__in=[profile.description for profile in profiles
+                                                               if profile.description]).values_list(
+            'description', flat=True):
+        descriptions[description] = descriptions.get(description, 0) + 1
+    return dict((profile.pk, profile.description if descriptions.get(profile.description) == 1
+                 else unicode(profile.pk)) for profile in profiles)
+
+
+def export_poll(poll):
+    """
+    returns the definition of poll
+    """
+    answers = {}
+    for id, question_id, text in Answer.objects.filter(question__poll=poll).values_list('id', 'question_id', 'text'):
+        answers.setdefault(question_id, []).append((id, text))
+
+    quantifiers = {}
+    for answer_id, profile_id, quantifier in AnswerProfile.objects.filter(answer__question__poll=poll).values_list(
+            'answer_id', 'profile_id', 'quantifier'):
+        profiles = quantifiers.setdefault(answer_id, {})
+        profiles[profile_id] = profiles.get(profile_id, 0) + quantifier
+
+    profile_ids = set(profile_id for profiles in quantifiers.values() for profile_id in profiles)
+    if poll.default_profile_id:
+        profile_ids.add(poll.default_profile_id)
+    profiles = Profile.objects.in_bulk(profile_ids)
+    keys = profile_keys(profiles.values())
+
+    definition = dict((field, getattr(poll, field)) for field in POLL_FIELDS)
+    definition.update({
+        'slug': poll.slug,
+        'default_profile': keys.get(poll.default_profile_id),
+        'profiles': dict((keys[profile_id], dict((field, getattr(profile, field)) for field in PROFILE_FIELDS))
+                         for profile_id, profile in profiles.items()),
+        'questions': [{
+            'id': question_id,
+            'text': text,
+            'multiple_answers': multiple_answers,
+            'answers': [{
+                'id': answer_id,
+                'text': answer_text,
+                'profiles': dict((keys[profile_id], quantifier)
+                                 for profile_id, quantifier in quantifiers.get(answer_id, {}).items()),
+            } for answer_id, answer_text in answers.get(question_id, [])],
+        } for question_id, text, multiple_answers in poll.questions.values_list('id', 'text', 'multiple_answers')],
+    })
+    return definition
+
+
+def _count(changes, kind, action, count=1):
+    changes.setdefault(kind, {'created': 0, 'updated': 0, 'deleted': 0})[action] += count
+
+
+def _import_profiles(definitions, changes):
+    """
+    returns {profile key: profile id}, creating the missing profiles
+    """
+    profiles = {}
+    for profile in Profile.objects.filter(description__in=definitions.keys()).order_by('-id'):
+        profiles[profile.description] = profile
+    numeric = [key for key in definitions if key not in profiles and key.isdigit()]
+    for profile in Profile.objects.filter(pk__in=numeric):
+        profiles[unicode(profile.pk)] = profile
+
+    for key, profile in profiles.items():
+        values = dict((field, definitions[key].get(field)) for field in PROFILE_FIELDS)
+        if any(getattr(profile, field) != value for field, value in values.items()):
+            Profile.objects.filter(pk=profile.pk).update(modified=datetime.now(), **values)
+            _count(changes, 'profiles', 'updated')
+
+    missing = [key for key in definitions if key not in profiles]
+    for key in missing:
+        if len(key) > Profile._meta.get_field('description').max_length:
+            raise ValueError('Profile key "%s" is too long' % key)
+    if missing:
+        Profile.objects.bulk_create([Profile(description=key, **dict((field, definitions[key].get(field))
+                                                                   for field in PROFILE_FIELDS))
+                                     for key in missing])
+        for profile in Profile.objects.filter(description__in=missing).order_by('-id'):
+            profiles[profile.description] = profile
+        _count(changes, 'profiles', 'created', len(missing))
+
+    return dict((key, profile.pk) for key, profile in profiles.items())
+
+
+def _match_rows(existing, keys):
+    """
+    returns the existing (id, ordering, values) row for every position of the
+    definition rows with the given ids, by id if the definition has any, otherwise by
+    position. None for the positions, which need a new row.
+    """
+    if any(key is not None for key in keys):
+        rows = dict((row[0], row) for row in existing)
+        return [rows.pop(key, None) for key in keys]
+    return [existing[position] if position < len(existing) else None for position in range(len(keys))]
+
+
+def _import_rows(model, existing, rows, keys, changes, kind):
+    """
+    updates the existing (id, ordering, values) rows to the given {field: value} rows
+    matched by keys, deletes the remaining and returns the ids by position, None for the
+    rows, which need to be created
+    """
+    matched = _match_rows(existing, keys)
+    now = datetime.now()
+    for position, row in enumerate(matched):
+        if row and row[1:] != (position, rows[position]):
+            model.objects.filter(pk=row[0]).update(ordering=position, modified=now, **rows[position])
+            _count(changes, kind, 'updated')
+
+    kept = set(row[0] for row in matched if row)
+    deleted = [id for id, ordering, values in existing if id not in kept]
+    if deleted:
+        model.objects.filter(pk__in=deleted).delete()
+        _count(changes, kind, 'deleted', len(deleted))
+    return [row and row[0] for row in matched]
+
+
+def import_poll(definition, slug=None):
+    """
+    creates or updates the poll of definition, the poll with slug if given. Returns
+    (poll, {kind: {'created', 'updated', 'deleted'}}).
+    """
+    slug = slug or definition['slug']
+    changes = {}
+
+    with transaction.commit_on_success():
+        profile_ids = _import_profiles(definition.get('profiles', {}), changes)
+        values = dict((field, definition.get(field)) for field in POLL_FIELDS)
+        values['active'] = bool(values['active'])
+        values['default_profile_id'] = profile_ids.get(definition.get('default_profile'))
+
+        try:
+            poll = Poll.objects.get(slug=slug)
+        except Poll.DoesNotExist:
+            poll = Poll.objects.create(slug=slug, **values)
+            _count(changes, 'polls', 'created')
+        else:
+            if any(getattr(poll, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(poll, field, value)
+                poll.save()
+                _count(changes, 'polls', 'updated')
+
+        # questions
+        questions = definition.get('questions', [])
+        existing = [(id, ordering, {'text': text, 'multiple_answers': multiple_answers})
+                    for id, ordering, text, multiple_answers in poll.questions.values_list(
+                        'id', 'ordering', 'text', 'multiple_answers')]
+        rows = [{'text': question['text'], 'multiple_answers': bool(question.get('multiple_answers'))}
+                for question in questions]
+        question_ids = _import_rows(Question, existing, rows, [question.get('id') for question in questions],
+                                    changes, 'questions')
+        created = [position for position, id in enumerate(question_ids) if id is None]
+        if created:
+            Question.objects.bulk_create([Question(poll=poll, ordering=position, **rows[position])
+                                          for position in created])
+            _count(changes, 'questions', 'created', len(created))
+            # bulk_create doesn't set primary keys, every question of the poll has its own ordering now
+            orderings = dict(poll.questions.filter(ordering__in=created).values_list('ordering', 'id'))
+            question_ids = [orderings[position] if id is None else id for position, id in enumerate(question_ids)]
+
+        # answers
+        existing = {}
+        for id, question_id, text, ordering in Answer.objects.filter(question__poll=poll).values_list(
+                'id', 'question_id', 'text', 'ordering'):
+            existing.setdefault(question_id, []).append((id, ordering, {'text': text}))
+
+        new_answers = []
+        answer_ids = []
+        for question_id, question in zip(question_ids, questions):
+            answers = question.get('answers', [])
+            ids = _import_rows(Answer, existing.get(question_id, []), [{'text': answer['text']} for answer in answers],
+                               [answer.get('id') for answer in answers], changes, 'answers')
+            answer_ids.append((question_id, ids, answers))
+            new_answers.extend(Answer(question_id=question_id, text=answers[position]['text'], ordering=position)
+                               for position, id in enumerate(ids) if id is None)
+        if new_answers:
+            Answer.objects.bulk_create(new_answers)
+            _count(changes, 'answers', 'created', len(new_answers))
+            orderings = dict(((question_id, ordering), id) for id, question_id, ordering in Answer.objects.filter(
+                question__poll=poll).values_list('id', 'question_id', 'ordering'))
+            answer_ids = [(question_id, [orderings[(question_id, position)] if id is None else id
+                                         for position, id in enumerate(ids)], answers)
+                          for question_id, ids, answers in answer_ids]
+
+        # answer profiles
+        quantifiers = {}
+        for question_id, ids, answers in answer_ids:
+            for answer_id, answer in zip(ids, answers):
+                for key, quantifier in answer.get('profiles', {}).items():
+                    if key not in profile_ids:
+                        raise ValueError('Profile "%s" is not defined' % key)
+                    quantifiers[(answer_id, profile_ids[key])] = quantifier
+
+        rows = {}
+        for id, answer_id, profile_id, quantifier in AnswerProfile.objects.filter(
+                answer__question__poll=poll).values_list('id', 'answer_id', 'profile_id', 'quantifier'):
+            rows.setdefault((answer_id, profile_id), []).append((id, quantifier))
+
+        deleted = []
+        for key, existing in rows.items():
+            if key in quantifiers and len(existing) == 1:
+                id, quantifier = existing[0]
+                if quantifier != quantifiers[key]:
+                    AnswerProfile.objects.filter(pk=id).update(quantifier=quantifiers[key], modified=datetime.now())
+                    _count(changes, 'answerprofiles', 'updated')
+                del quantifiers[key]
+            else:
+                # not defined anymore or duplicated: replaced by one new row
+                deleted.extend(id for id, quantifier in existing)
+        if deleted:
+            AnswerProfile.objects.filter(pk__in=deleted).delete()
+            _count(changes, 'answerprofiles', 'deleted', len(deleted))
+        if quantifiers:
+            AnswerProfile.objects.bulk_create([AnswerProfile(answer_id=answer_id, profile_id=profile_id,
+                                                             quantifier=quantifier)
+                                               for (answer_id, profile_id), quantifier in quantifiers.items()])
+            _count(changes, 'answerprofiles', 'created', len(quantifiers))
+
+    # bulk_create and update send no signals
+    invalidate_plan(poll.pk)
+    invalidate_polls()
+    return poll, changes
+
+
+def clone_poll(poll, slug, title=None):
+    """
+    copies poll with all questions, answers and quantifiers to a new, inactive poll
+    with slug, e.g. for A/B variants. The profiles are shared.
+    """
+    if Poll.objects.filter(slug=slug).exists():
+        raise ValueError('Poll "%s" already exists' % slug)
+
+    definition = export_poll(poll)
+    definition.update(slug=slug, active=False)
+    if title:
+        definition['title'] = title
+    return import_poll(definition)[0]
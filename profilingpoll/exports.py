@@ -1,15 +1,141 @@
 # export functions for use with django-excel-export
 # https://bitbucket.org/ljean/django-excel-export/overview
 
-from models import Walkthrough
+import csv
+import json
+import numbers
+from datetime import datetime
+
+from django.utils.encoding import smart_str
+
+from .models import Poll, Profile, Walkthrough, WalkthroughProfile
+from .sharding import group_ids_by_shard
+
+
+FIELDS = ('id', 'poll_id', 'email', 'ip', 'user_agent', '_completed', 'created', '_progress', '_matching_profile_id')
+COLUMNS = ('id', 'poll', 'email', 'ip', 'user_agent', 'completed', 'created', 'progress', 'profile')
+
+
+def matching_profiles(walkthrough_ids):
+    """
+    returns {walkthrough id: profile id} of the best matching profiles with one query per shard
+    """
+    profiles = {}
+    for using, ids in group_ids_by_shard(walkthrough_ids).items():
+        for walkthrough_id, profile_id in WalkthroughProfile.objects.using(using).filter(
+                walkthrough__in=ids).order_by('walkthrough', '-quantifier', 'profile').values_list(
+                'walkthrough_id', 'profile_id'):
+            profiles.setdefault(walkthrough_id, profile_id)
+    return profiles
+
+
+def iter_walkthrough_chunks(poll=None, since=None, until=None, with_email=True, chunk_size=1000):
+    """
+    yields lists of walkthrough rows (dicts of FIELDS plus profile_id), keyset paginated by id
+    on one shard after the other. Every chunk costs one query, independent of its size.
+    """
+    for queryset in Walkthrough.objects.shards():
+        if with_email:
+            queryset = queryset.filter(email__isnull=False)
+        if poll is not None:
+            queryset = queryset.filter(poll=poll)
+        if since is not None:
+            queryset = queryset.filter(created__gte=since)
+        if until is not None:
+            queryset = queryset.filter(created__lt=until)
+
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id).order_by('id').values(*FIELDS)[:chunk_size])
+            if not chunk:
+                break
+
+            last_id = chunk[-1]['id']
+            for row in chunk:
+                row['profile_id'] = row['_matching_profile_id']
+            yield chunk
+
+
+def iter_walkthrough_rows(**kwargs):
+    """
+    yields walkthrough rows with resolved poll and profile. Polls and profiles are looked
+    up once per export and kept, so their number is the only thing growing in memory.
+    """
+    polls = {}
+    profiles = {}
+
+    for chunk in iter_walkthrough_chunks(**kwargs):
+        missing = set(row['poll_id'] for row in chunk) - set(polls)
+        if missing:
+            polls.update(Poll.objects.in_bulk(missing))
+
+        missing = set(row['profile_id'] or polls[row['poll_id']].default_profile_id for row in chunk)
+        missing = missing - set(profiles) - set([None])
+        if missing:
+            profiles.update(Profile.objects.in_bulk(missing))
+
+        for row in chunk:
+            row['poll'] = polls[row['poll_id']]
+            row['profile'] = profiles.get(row['profile_id'] or row['poll'].default_profile_id)
+            yield row
+
 
 def export_walkthroughs(*args):
-    for walkthrough in Walkthrough.objects.filter(email__isnull=False):
-        yield [walkthrough.poll,
-               walkthrough.email,
-               walkthrough.ip,
-               walkthrough.user_agent,
-               walkthrough._completed,
-               walkthrough.created,
-               walkthrough._progress,
-               walkthrough.get_matching_profile()]
\ No newline at end of file
+    for row in iter_walkthrough_rows():
+        yield [row['poll'],
+               row['email'],
+               row['ip'],
+               row['user_agent'],
+               row['_completed'],
+               row['created'],
+               row['_progress'],
+               row['profile']]
+
+
+def _values(row):
+    return (row['id'], row['poll'], row['email'], row['ip'], row['user_agent'], row['_completed'], row['created'],
+            row['_progress'], row['profile'])
+
+
+def _plain(value):
+    if value is None or isinstance(value, numbers.Number):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return u'%s' % value
+
+
+class Echo(object):
+    """
+    file like object, which returns the written value instead of buffering it
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(**kwargs):
+    """
+    yields the export as csv lines
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for row in iter_walkthrough_rows(**kwargs):
+        yield writer.writerow([smart_str(_plain(value)) if value is not None else '' for value in _values(row)])
+
+
+def iter_jsonlines(**kwargs):
+    """
+    yields the export as JSON lines
+    """
+    for row in iter_walkthrough_rows(**kwargs):
+        yield json.dumps(dict(zip(COLUMNS, [_plain(value) for value in _values(row)]))) + '\n'
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'jsonl': (iter_jsonlines, 'application/x-ndjson'),
+}
+
+
+def parse_date(value):
+    return value and datetime.strptime(value, '%Y-%m-%d') or None
@@ -1,20 +1,48 @@
+import random
+
+from django.core.cache import cache
 from django.db import models
 from django.template.loader import render_to_string
+from django.utils.translation import get_language, ugettext_lazy as _
 
+from .. import app_settings
 from ..models import Poll
+from ..polls import get_registry
 
 
 class FirstPoll(models.Model):
+    """
+    Shows the first active poll, a chosen poll or, with rotate, one of the active polls
+    at random. The rendered fragment is cached per version of the poll registry and
+    language.
+    """
+    poll = models.ForeignKey(Poll, blank=True, null=True, related_name='+',
+        help_text=_('Show this poll instead of the first active one'))
+    rotate = models.BooleanField(_('rotate'), default=False,
+        help_text=_('Show one of the active polls at random'))
+
     class Meta:
         abstract = True
 
-    def render(self, request, **kwargs):
-        try:
-            #Poll.objects.filter(active=True)[0].description
-            firstpoll = Poll.objects.filter(active=True)[0]
-        except IndexError:
-            firstpoll = None
+    def get_poll_id(self, registry):
+        if self.poll_id:
+            return self.poll_id
 
-        return render_to_string('content/profilingpoll/firstpoll.html',
-                {'content': self, 'firstpoll' : firstpoll} )
+        if not registry.polls:
+            return None
+        return (random.choice(registry.polls) if self.rotate else registry.polls[0]).id
+
+    def render(self, request, **kwargs):
+        registry = get_registry()
+        poll_id = self.get_poll_id(registry)
+        key = 'profilingpoll:firstpoll:%s:%s:%s:%s:%s' % (
+            registry.version, get_language(), self.__class__.__name__, self.pk, poll_id)
 
+        html = cache.get(key)
+        if html is None:
+            polls = Poll.objects.filter(pk=poll_id)[:1] if poll_id else []
+            firstpoll = polls[0] if polls else None
+            html = render_to_string('content/profilingpoll/firstpoll.html',
+                    {'content': self, 'firstpoll' : firstpoll} )
+            cache.set(key, html, app_settings.FIRSTPOLL_CACHE_TIMEOUT)
+        return html
@@ -1,6 +1,9 @@
 from django import forms
 from django.core.exceptions import ImproperlyConfigured
 
+from .plan import get_plan
+
+
 class AnswerForm(forms.Form):
     def __init__(self, *args, **kwargs):
         try:
@@ -9,10 +12,24 @@ class AnswerForm(forms.Form):
             raise ImproperlyConfigured('AnswerForm need "question" as kwarg')
         super(AnswerForm, self).__init__(*args, **kwargs)
 
-        self.fields['answer'] = forms.ChoiceField(
-            widget=forms.RadioSelect,
-            choices=self.question.answers.all().values_list('id', 'text')
-        )
+        plan = get_plan(self.question.poll_id)
+        if plan.allows_multiple(self.question.pk):
+            self.fields['answer'] = forms.MultipleChoiceField(
+                widget=forms.CheckboxSelectMultiple,
+                choices=plan.answer_choices(self.question.pk)
+            )
+        else:
+            self.fields['answer'] = forms.ChoiceField(
+                widget=forms.RadioSelect,
+                choices=plan.answer_choices(self.question.pk)
+            )
+
+    def get_answer_ids(self):
+        """
+        returns the chosen answer ids as list, also for single answer questions
+        """
+        answer = self.cleaned_data['answer']
+        return [int(answer_id) for answer_id in (answer if isinstance(answer, list) else [answer])]
 
 
 class EmailForm(forms.Form):
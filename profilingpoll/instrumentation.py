@@ -0,0 +1,243 @@
+"""
+Low overhead instrumentation of the views and the scoring path.
+
+With PROFILINGPOLL_INSTRUMENTATION, every instrumented view or function runs in a
+span, which counts the queries, the database time and the plan and statistics cache
+hits and misses inside it. Views send their spans as Server-Timing header. All spans
+are aggregated into histograms per name in process memory, which are written to the
+django cache every PROFILINGPOLL_INSTRUMENTATION_FLUSH_INTERVAL seconds, so the
+staff page and the dump_instrumentation command see all processes.
+
+Disabled, instrumented() costs one attribute lookup per call.
+"""
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from . import app_settings
+
+
+# upper bounds in ms of the histogram buckets, the last bucket is unbounded
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+INDEX_KEY = 'profilingpoll:instrumentation'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_process = '%s-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+_last_flush = [0]
+
+
+class Histogram(object):
+    def __init__(self, name):
+        self.name = name
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, span):
+        index = 0
+        while index < len(BUCKETS) and span.duration > BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += span.duration
+        self.max = max(self.max, span.duration)
+        self.queries += span.queries
+        self.db_time += span.db_time
+        self.hits += span.hits
+        self.misses += span.misses
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.queries += other.queries
+        self.db_time += other.db_time
+        self.hits += other.hits
+        self.misses += other.misses
+
+    def percentile(self, percent):
+        """
+        upper bound in ms of the bucket holding the percentile, the max for the last bucket
+        """
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self):
+        count = self.count or 1
+        return {
+            'name': self.name,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'queries': float(self.queries) / count,
+            'db_time': self.db_time / count,
+            'hit_ratio': float(self.hits) / (self.hits + self.misses) if self.hits + self.misses else None,
+        }
+
+
+class Span(object):
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.children = []
+
+    def __enter__(self):
+        self.parent = getattr(_local, 'span', None)
+        _local.span = self
+        self.connections = [(connection, connection.use_debug_cursor, len(connection.queries))
+                            for connection in connections.all()]
+        for connection, use_debug_cursor, start in self.connections:
+            connection.use_debug_cursor = True
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = (time.time() - self.started) * 1000
+        for connection, use_debug_cursor, start in self.connections:
+            connection.use_debug_cursor = use_debug_cursor
+            # the query log is reset when a request starts
+            queries = connection.queries[start:] if len(connection.queries) >= start else connection.queries
+            self.queries += len(queries)
+            self.db_time += sum(float(query['time']) for query in queries) * 1000
+            if not (use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)):
+                # logged for this span only: outside requests, e.g. in the flusher thread or
+                # in management commands, nothing else would ever empty the log
+                del connection.queries[start:]
+
+        _local.span = self.parent
+        if self.parent is not None:
+            self.parent.children.append(self)
+            self.parent.hits += self.hits
+            self.parent.misses += self.misses
+        record(self)
+
+    def server_timing(self):
+        """
+        returns the span and its children as Server-Timing header value
+        """
+        metrics = ['%s;dur=%.1f' % (self.name, self.duration),
+                   'db;dur=%.1f;desc="%d queries"' % (self.db_time, self.queries),
+                   'cache;desc="%d hits, %d misses"' % (self.hits, self.misses)]
+        metrics.extend('%s;dur=%.1f' % (child.name, child.duration) for child in self.children)
+        return ', '.join(metrics)
+
+
+def record(span):
+    with _lock:
+        if span.name not in _histograms:
+            _histograms[span.name] = Histogram(span.name)
+        _histograms[span.name].add(span)
+
+
+def cache_hit(hit):
+    """
+    counts a hit (or miss) of the plan or statistics cache for the current span
+    """
+    span = getattr(_local, 'span', None)
+    if span is not None:
+        if hit:
+            span.hits += 1
+        else:
+            span.misses += 1
+
+
+def instrumented(name, view=False):
+    """
+    decorator running the function in a span, if instrumentation is enabled. Views
+    get the Server-Timing header and flush the histograms from time to time.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not app_settings.INSTRUMENTATION:
+                return function(*args, **kwargs)
+
+            with Span(name) as span:
+                response = function(*args, **kwargs)
+                if view and hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+
+            if view:
+                response['Server-Timing'] = span.server_timing()
+                if time.time() - _last_flush[0] > app_settings.INSTRUMENTATION_FLUSH_INTERVAL:
+                    flush()
+            return response
+        return wrapper
+    return decorator
+
+
+def flush():
+    """
+    writes the histograms of this process to the cache
+    """
+    _last_flush[0] = time.time()
+    with _lock:
+        histograms = dict((name, histogram.__dict__.copy()) for name, histogram in _histograms.items())
+
+    processes = cache.get(INDEX_KEY) or []
+    if _process not in processes:
+        cache.set(INDEX_KEY, processes + [_process], CACHE_TIMEOUT)
+    cache.set('%s:%s' % (INDEX_KEY, _process), histograms, CACHE_TIMEOUT)
+
+
+def collect():
+    """
+    returns the histograms of all processes merged by name
+    """
+    flush()
+    processes = cache.get(INDEX_KEY) or []
+    merged = {}
+    for histograms in cache.get_many(['%s:%s' % (INDEX_KEY, process) for process in processes]).values():
+        for name, values in histograms.items():
+            histogram = Histogram(name)
+            histogram.__dict__.update(values)
+            if name in merged:
+                merged[name].merge(histogram)
+            else:
+                merged[name] = histogram
+    return merged
+
+
+def top(limit=20, order_by='total'):
+    """
+    returns the summaries of the slowest span names, by total, mean, p99 or queries
+    """
+    summaries = [histogram.summary() for histogram in collect().values()]
+    return sorted(summaries, key=lambda summary: -summary[order_by])[:limit]
+
+
+def reset():
+    """
+    drops the histograms of all processes
+    """
+    with _lock:
+        _histograms.clear()
+    processes = cache.get(INDEX_KEY) or []
+    cache.delete_many(['%s:%s' % (INDEX_KEY, process) for process in processes] + [INDEX_KEY])
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ... import app_settings
+from ...archive import archive_walkthroughs
+from ...models import Poll
+
+
+class Command(NoArgsCommand):
+    help = ('Moves incomplete walkthroughs, which were not changed for some days, into the compact '
+            'ArchivedWalkthrough table and deletes them in chunks.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+            help='Archive walkthroughs not changed for this many days, defaults to '
+                 'PROFILINGPOLL_ARCHIVE_AFTER_DAYS.'),
+        make_option('--poll', dest='poll', default=None,
+            help='Only archive walkthroughs of the poll with this slug.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of walkthroughs archived and deleted per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only count the walkthroughs to archive.'),
+    )
+
+    def handle_noargs(self, **options):
+        poll_id = None
+        if options['poll']:
+            try:
+                poll_id = Poll.objects.get(slug=options['poll']).pk
+            except Poll.DoesNotExist:
+                raise CommandError('Poll "%s" does not exist' % options['poll'])
+
+        days = app_settings.ARCHIVE_AFTER_DAYS if options['days'] is None else options['days']
+        count = archive_walkthroughs(days=days, poll_id=poll_id, chunk_size=options['chunk_size'],
+                                     dry_run=options['dry_run'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%s %d walkthroughs older than %d days\n' % (
+                'Would archive' if options['dry_run'] else 'Archived', count, days))
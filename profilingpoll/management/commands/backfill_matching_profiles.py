@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...exports import matching_profiles
+from ...models import Walkthrough
+
+
+class Command(NoArgsCommand):
+    help = 'Fills the denormalized matching profile of existing walkthroughs from their profile scores.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=5000,
+            help='Number of walkthroughs updated per round.'),
+    )
+
+    def handle_noargs(self, **options):
+        updated = 0
+        for queryset in Walkthrough.objects.shards():
+            last_id = 0
+            while True:
+                ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+                    'id', flat=True)[:options['chunk_size']])
+                if not ids:
+                    break
+                last_id = ids[-1]
+
+                groups = {}
+                matching = matching_profiles(ids)
+                for id in ids:
+                    groups.setdefault(matching.get(id), []).append(id)
+                for profile_id, walkthrough_ids in groups.items():
+                    queryset.filter(id__in=walkthrough_ids).update(_matching_profile=profile_id)
+                updated += len(ids)
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Updated %d walkthroughs.\n' % updated)
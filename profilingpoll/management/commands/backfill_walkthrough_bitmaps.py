@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...models import Walkthrough
+from ...plan import get_plan
+
+
+class Command(NoArgsCommand):
+    help = 'Fills the answered question bitmaps of existing walkthroughs from their answered questions.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=5000,
+            help='Number of walkthroughs updated per round.'),
+    )
+
+    def handle_noargs(self, **options):
+        updated = 0
+        for queryset in Walkthrough.objects.shards():
+            using = queryset.db
+            last_id = 0
+            while True:
+                chunk = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+                    'id', 'poll_id')[:options['chunk_size']])
+                if not chunk:
+                    break
+                last_id = chunk[-1][0]
+
+                answered = {}
+                for walkthrough_id, question_id in Walkthrough._answered_questions.through.objects.using(using).filter(
+                        walkthrough__in=[id for id, poll_id in chunk]).values_list('walkthrough_id', 'question_id'):
+                    answered.setdefault(walkthrough_id, []).append(question_id)
+
+                groups = {}
+                for id, poll_id in chunk:
+                    plan = get_plan(poll_id)
+                    groups.setdefault(('%x' % plan.bitmap(answered.get(id, ())), plan.layout), []).append(id)
+                for (bitmap, layout), walkthrough_ids in groups.items():
+                    queryset.filter(id__in=walkthrough_ids).update(
+                        _answered_bitmap=bitmap, _bitmap_layout=layout)
+                updated += len(chunk)
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Updated %d walkthroughs.\n' % updated)
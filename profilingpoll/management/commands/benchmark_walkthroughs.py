@@ -0,0 +1,78 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from ... import benchmark
+
+
+class Command(NoArgsCommand):
+    help = ('Measures queries, latency and session size of the walkthrough flow and the walkthrough export on a '
+            'synthetic poll in a test database, and fails on regressions against a baseline.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--questions', dest='questions', type='int', default=50,
+            help='Number of questions of the synthetic poll.'),
+        make_option('--answers', dest='answers', type='int', default=6,
+            help='Number of answers per question.'),
+        make_option('--profiles', dest='profiles', type='int', default=20,
+            help='Number of profiles.'),
+        make_option('--walkthroughs', dest='walkthroughs', type='int', default=20,
+            help='Number of walkthroughs driven through the views.'),
+        make_option('--export-walkthroughs', dest='export_walkthroughs', type='int', default=100000,
+            help='Number of walkthroughs exported. 0 skips the export benchmark.'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='JSON file with the results of an earlier run to compare with, e.g. '
+                 'profilingpoll/benchmark_baseline.json for the default options.'),
+        make_option('--save-baseline', action='store_true', dest='save_baseline', default=False,
+            help='Write the results to --baseline instead of comparing.'),
+        make_option('--tolerance', dest='tolerance', type='float', default=0.5,
+            help='Allowed latency increase against the baseline, 0.5 = 50%. Queries and session size must not grow.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['save_baseline'] and not options['baseline']:
+            raise CommandError('--save-baseline requires --baseline')
+        verbosity = int(options['verbosity'])
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=max(verbosity - 1, 0))
+        try:
+            poll = benchmark.create_poll(options['questions'], options['answers'], options['profiles'])
+            results = {
+                'poll': {'questions': options['questions'], 'answers': options['answers'],
+                         'profiles': options['profiles']},
+                'flow': benchmark.run_flow(poll, options['walkthroughs']),
+            }
+            if options['export_walkthroughs']:
+                benchmark.create_walkthroughs(poll, options['export_walkthroughs'])
+                results['export'] = benchmark.run_export(poll)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=max(verbosity - 1, 0))
+            teardown_test_environment()
+
+        if verbosity > 0:
+            self.stdout.write(json.dumps(results, indent=1, sort_keys=True) + '\n')
+
+        if not options['baseline']:
+            return
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as baseline:
+                json.dump(results, baseline, indent=1, sort_keys=True)
+            return
+
+        try:
+            with open(options['baseline']) as baseline:
+                baseline = json.load(baseline)
+        except (IOError, ValueError) as e:
+            raise CommandError('Cannot read baseline %s: %s' % (options['baseline'], e))
+
+        if baseline.get('poll') != results['poll']:
+            raise CommandError('The baseline was measured on a poll of another size: %s' % baseline.get('poll'))
+
+        regressions = benchmark.compare(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
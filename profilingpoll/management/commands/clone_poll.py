@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...definitions import clone_poll
+from ...models import Poll
+
+
+class Command(BaseCommand):
+    help = 'Copies a poll with all questions, answers and quantifiers to a new inactive poll, e.g. for A/B variants.'
+    args = '<poll slug> <new slug>'
+    option_list = BaseCommand.option_list + (
+        make_option('--title', dest='title', default=None,
+            help='Title of the copy. Defaults to the title of the poll.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: clone_poll %s' % self.args)
+        try:
+            poll = Poll.objects.get(slug=args[0])
+        except Poll.DoesNotExist:
+            raise CommandError('Poll "%s" does not exist' % args[0])
+
+        try:
+            clone = clone_poll(poll, args[1], title=options['title'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Cloned %s to %s\n' % (poll.slug, clone.slug))
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ... import instrumentation
+
+
+class Command(NoArgsCommand):
+    help = 'Lists the slowest instrumented views and scoring calls of all processes.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--order', dest='order', default='total', choices=['total', 'mean', 'p99', 'queries'],
+            help='Sort by total (default), mean or p99 time or by queries per call.'),
+        make_option('--limit', dest='limit', type='int', default=20,
+            help='Number of spans listed.'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Drop the collected histograms after listing them.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.stdout.write('%-36s %8s %10s %8s %8s %8s %8s %8s %6s\n' % (
+            'span', 'count', 'total ms', 'mean ms', 'p50 ms', 'p99 ms', 'queries', 'db ms', 'hits'))
+
+        for summary in instrumentation.top(options['limit'], options['order']):
+            hit_ratio = '-' if summary['hit_ratio'] is None else '%d%%' % (summary['hit_ratio'] * 100)
+            self.stdout.write('%-36s %8d %10.1f %8.1f %8s %8s %8.1f %8.1f %6s\n' % (
+                summary['name'], summary['count'], summary['total'], summary['mean'], '<=%d' % summary['p50'],
+                '<=%d' % summary['p99'], summary['queries'], summary['db_time'], hit_ratio))
+
+        if options['reset']:
+            instrumentation.reset()
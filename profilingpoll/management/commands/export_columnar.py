@@ -0,0 +1,42 @@
+import os
+import shutil
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ...columnar import ColumnarExport
+from ...models import Poll
+
+
+class Command(NoArgsCommand):
+    help = ('Appends answers and profile scores of walkthroughs modified since the last run to a columnar '
+            'export per poll.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='Directory of the export. One subdirectory per poll slug is written.'),
+        make_option('--poll', dest='poll', default=None,
+            help='Only export the poll with this slug.'),
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Discard the existing export and rewrite it from scratch.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=5000,
+            help='Number of walkthroughs fetched per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not options['output']:
+            raise CommandError('--output is required')
+
+        polls = Poll.objects.all()
+        if options['poll']:
+            polls = polls.filter(slug=options['poll'])
+            if not polls:
+                raise CommandError('Poll "%s" does not exist' % options['poll'])
+
+        for poll in polls:
+            directory = os.path.join(options['output'], poll.slug)
+            if options['full'] and os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+            exported = ColumnarExport(poll, directory).export(chunk_size=options['chunk_size'])
+            if int(options['verbosity']) > 0:
+                self.stdout.write('%s: appended %d walkthroughs\n' % (poll.slug, exported))
@@ -0,0 +1,33 @@
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...definitions import export_poll
+from ...models import Poll
+
+
+class Command(BaseCommand):
+    help = 'Writes the definition of a poll with all questions, answers and profiles as JSON.'
+    args = '<poll slug>'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='File to write to. Defaults to stdout.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: export_poll %s' % self.args)
+        try:
+            poll = Poll.objects.get(slug=args[0])
+        except Poll.DoesNotExist:
+            raise CommandError('Poll "%s" does not exist' % args[0])
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            json.dump(export_poll(poll), output, indent=2, sort_keys=True)
+            output.write('\n')
+        finally:
+            if options['output']:
+                output.close()
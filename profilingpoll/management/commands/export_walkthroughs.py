@@ -0,0 +1,51 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ...exports import FORMATS, parse_date
+from ...models import Poll
+
+
+class Command(NoArgsCommand):
+    help = 'Streams walkthroughs as csv or JSON lines, in chunks and with constant memory.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='csv', choices=sorted(FORMATS.keys()),
+            help='Output format: csv (default) or jsonl.'),
+        make_option('--poll', dest='poll', default=None,
+            help='Only export walkthroughs of the poll with this slug.'),
+        make_option('--since', dest='since', default=None,
+            help='Only export walkthroughs created on or after this date (YYYY-MM-DD).'),
+        make_option('--until', dest='until', default=None,
+            help='Only export walkthroughs created before this date (YYYY-MM-DD).'),
+        make_option('--all', action='store_false', dest='with_email', default=True,
+            help='Also export walkthroughs without email.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of walkthroughs fetched per query.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write to. Defaults to stdout.'),
+    )
+
+    def handle_noargs(self, **options):
+        poll = None
+        if options['poll']:
+            try:
+                poll = Poll.objects.get(slug=options['poll'])
+            except Poll.DoesNotExist:
+                raise CommandError('Poll "%s" does not exist' % options['poll'])
+
+        try:
+            since, until = parse_date(options['since']), parse_date(options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        rows = FORMATS[options['format']][0](poll=poll, since=since, until=until,
+            with_email=options['with_email'], chunk_size=options['chunk_size'])
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            for line in rows:
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ... import app_settings
+from ...buffer import AnswerBuffer
+
+
+class Command(NoArgsCommand):
+    help = 'Drains the write-behind answer buffer and applies it to the database.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+            help='Path of the answer buffer. Defaults to PROFILINGPOLL_ANSWER_BUFFER.'),
+    )
+
+    def handle_noargs(self, **options):
+        path = options['path'] or app_settings.ANSWER_BUFFER
+        if not path:
+            raise CommandError('No answer buffer configured. Set PROFILINGPOLL_ANSWER_BUFFER or use --path.')
+
+        updated = AnswerBuffer(path).flush()
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Applied buffered answers of %d walkthroughs.\n' % updated)
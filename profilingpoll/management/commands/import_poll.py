@@ -0,0 +1,31 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...definitions import import_poll
+
+
+class Command(BaseCommand):
+    help = ('Creates or updates a poll from a JSON definition as written by export_poll. Only the rows which '
+            'differ from the definition are written, in one transaction.')
+    args = '<definition file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--slug', dest='slug', default=None,
+            help='Import into the poll with this slug instead of the slug of the definition.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_poll %s' % self.args)
+        try:
+            with open(args[0]) as definition:
+                poll, changes = import_poll(json.load(definition), slug=options['slug'])
+        except (IOError, ValueError, KeyError) as e:
+            raise CommandError('Can not import %s: %s' % (args[0], e))
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%s: %s\n' % (poll.slug, ', '.join(
+                '%s %d created, %d updated, %d deleted' % (kind, counts['created'], counts['updated'],
+                                                           counts['deleted'])
+                for kind, counts in sorted(changes.items())) or 'unchanged'))
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...sharding import move_walkthroughs
+
+
+class Command(NoArgsCommand):
+    help = ('Moves existing walkthroughs to their shard, after sharding was enabled or the number of '
+            'shards changed.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--from', action='append', dest='sources', default=None,
+            help='Database alias to move walkthroughs from, defaults to the default database and the '
+                 'shards. Can be given several times, e.g. for shards which were removed.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of walkthroughs read per round.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only count the walkthroughs to move.'),
+    )
+
+    def handle_noargs(self, **options):
+        count = move_walkthroughs(sources=options['sources'], chunk_size=options['chunk_size'],
+                                  dry_run=options['dry_run'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('%s %d walkthroughs\n' % ('Would move' if options['dry_run'] else 'Moved', count))
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ...models import Poll
+from ...stats import rebuild_stats
+
+
+class Command(NoArgsCommand):
+    help = 'Recomputes the statistics counters of all polls from the walkthroughs.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--poll', dest='poll', default=None,
+            help='Only rebuild the poll with this slug.'),
+    )
+
+    def handle_noargs(self, **options):
+        polls = Poll.objects.all()
+        if options['poll']:
+            polls = polls.filter(slug=options['poll'])
+            if not polls:
+                raise CommandError('Poll "%s" does not exist' % options['poll'])
+
+        for poll in polls:
+            rebuild_stats(poll.pk)
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Rebuilt statistics of %s\n' % poll.slug)
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ... import rescoring
+from ...models import Poll, Profile
+
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the profile scores and matching profiles of existing walkthroughs with the current '
+            'quantifiers and reports how the profile distribution of completed walkthroughs shifts.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--poll', dest='poll', default=None,
+            help='Only rescore the poll with this slug.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report the shift of the profile distribution, write nothing.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of walkthroughs scored per round.'),
+    )
+
+    def handle_noargs(self, **options):
+        polls = Poll.objects.all()
+        if options['poll']:
+            polls = polls.filter(slug=options['poll'])
+            if not polls:
+                raise CommandError('Poll "%s" does not exist' % options['poll'])
+
+        verbosity = int(options['verbosity'])
+        if verbosity > 1 and rescoring.numpy is None:
+            self.stdout.write('NumPy is not installed, scoring in python.\n')
+
+        for poll in polls:
+            result = rescoring.rescore_poll(poll.pk, chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+            if verbosity == 0:
+                continue
+
+            self.stdout.write('%s: %d walkthroughs, %d with changed scores%s\n' % (
+                poll.slug, result['walkthroughs'], result['changed'], ' (dry run)' if options['dry_run'] else ''))
+
+            profile_ids = set(result['before']).union(result['after'])
+            profiles = Profile.objects.in_bulk([profile_id for profile_id in profile_ids if profile_id])
+            for profile_id in sorted(profile_ids, key=lambda profile_id: profile_id or 0):
+                before, after = result['before'].get(profile_id, 0), result['after'].get(profile_id, 0)
+                name = profile_id and profiles.get(profile_id) or poll.default_profile or '-'
+                self.stdout.write('  %s: %d -> %d (%+d)\n' % (name, before, after, after - before))
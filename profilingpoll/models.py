@@ -1,12 +1,15 @@
-from datetime import datetime
-
 from django.core import signing
 from django.db import models
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_save, post_delete
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import truncatechars
 
+from . import app_settings, results, scoring, sharding, stats
+from .instrumentation import instrumented
+from .plan import get_plan, invalidate_plan
+from .polls import invalidate_polls
+
 
 class TimestampMixin(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -33,17 +36,19 @@ class Poll(TimestampMixin):
     def get_absolute_url(self):
         return ('profilingpoll_poll_detail', (), {'slug' : self.slug})
 
-    def get_first_question(self):
-        return self.questions.all()[0]
+    def get_plan(self):
+        return get_plan(self.pk)
 
-    def get_question_list(self):
-        return list(self.questions.all())
+    def get_first_question(self):
+        return self.questions.get(pk=self.get_plan().question_ids[0])
 
 
 class Question(TimestampMixin):
     poll = models.ForeignKey(Poll, related_name='questions')
     text = models.TextField(_('text'))
     ordering = models.PositiveIntegerField(default=0)
+    multiple_answers = models.BooleanField(_('multiple answers'), default=False,
+        help_text=_('Answers are checkboxes instead of radio buttons'))
 
     class Meta:
         ordering = ('poll', 'ordering', 'created', 'id')
@@ -59,26 +64,17 @@ class Question(TimestampMixin):
         """
         returns the number the question has in the poll
         """
-        return self.poll.get_question_list().index(self)
+        return get_plan(self.poll_id).index(self.pk)
 
     def next(self):
-        try:
-            return self.poll.get_question_list()[self.get_index() + 1]
-        except IndexError:
-            return None
+        next_id = get_plan(self.poll_id).next_question_id(self.pk)
 
-    @property
-    def multiple_answers(self):
-        # TODO: change this to a real feature
-        return False
+        if next_id is None:
+            return None
+        return Question.objects.get(pk=next_id)
 
     def question_answered(self, walkthrough):
-        answers_to_self = walkthrough.answers.filter(question=self)
-
-        if answers_to_self.count() >= 1:
-            return True
-        else:
-            return False
+        return walkthrough.is_answered(self.pk)
 
 
 class Answer(TimestampMixin):
@@ -114,6 +110,39 @@ class AnswerProfile(TimestampMixin):
     quantifier = models.IntegerField(_('quantifier'), default=1)
 
 
+class WalkthroughManager(models.Manager):
+    """
+    places new walkthroughs on their shard and finds them there, see sharding.py
+    """
+    def create(self, **kwargs):
+        if self._db is None and app_settings.SHARDS and 'id' not in kwargs and 'pk' not in kwargs:
+            kwargs['id'] = sharding.walkthrough_ids.allocate()
+            return self.shard(kwargs['id']).create(**kwargs)
+        return super(WalkthroughManager, self).create(**kwargs)
+
+    def bulk_create(self, objs, batch_size=None):
+        if self._db is None and app_settings.SHARDS:
+            for walkthrough in objs:
+                if walkthrough.pk is None:
+                    walkthrough.pk = sharding.walkthrough_ids.allocate()
+            for using, walkthroughs in sharding.group_by_shard(objs).items():
+                self.using(using).bulk_create(walkthroughs, batch_size)
+            return objs
+        return super(WalkthroughManager, self).bulk_create(objs, batch_size)
+
+    def shard(self, walkthrough_id):
+        """
+        returns the walkthroughs on the shard of walkthrough_id
+        """
+        return self.using(sharding.shard_for(walkthrough_id))
+
+    def shards(self):
+        """
+        returns the walkthroughs of every shard, one queryset per shard
+        """
+        return [self.using(alias) for alias in sharding.get_shards()]
+
+
 class Walkthrough(TimestampMixin):
     poll = models.ForeignKey(Poll, related_name='walkthroughs')
     answers = models.ManyToManyField(Answer, blank=True, null=True)
@@ -127,6 +156,21 @@ class Walkthrough(TimestampMixin):
     _progress = models.FloatField(blank=True, null=True) # between 0 and 1
     _profiles = models.ManyToManyField(Profile, through='WalkthroughProfile', blank=True, null=True,
         related_name='walkthrough_set')
+    _matching_profile = models.ForeignKey(Profile, blank=True, null=True, related_name='+',
+        on_delete=models.SET_NULL)
+    # bit n is set, if the n-th question of the poll plan with _bitmap_layout is answered (hex)
+    _answered_bitmap = models.CharField(max_length=255, blank=True, default='')
+    _bitmap_layout = models.CharField(max_length=12, blank=True, null=True)
+    # the result frozen at completion as JSON, see results.py
+    _result_snapshot = models.TextField(blank=True, null=True)
+
+    objects = WalkthroughManager()
+
+    class Meta:
+        index_together = (
+            ('poll', '_completed'),
+            ('poll', 'email'),
+        )
 
     def __unicode__(self):
         return u'%s %s %s %s %s' %(self.id, self.poll, self.ip, self.email, self.modified)
@@ -137,7 +181,9 @@ class Walkthrough(TimestampMixin):
 
     @property
     def answered_questions(self):
-        return self._answered_questions.all()
+        # the questions may live on another database than the walkthrough
+        return Question.objects.filter(pk__in=list(Walkthrough._answered_questions.through.objects.using(
+            sharding.db_for(self)).filter(walkthrough=self).values_list('question_id', flat=True)))
 
     @property
     def completed(self):
@@ -148,22 +194,40 @@ class Walkthrough(TimestampMixin):
         return self._progress
 
     def get_matching_profile(self):
-        try:
-            return self.walkthroughprofiles.order_by('-quantifier')[0].profile
-        except IndexError:
-            return self.poll.default_profile or None
+        if self._matching_profile_id:
+            return self._matching_profile
+        return self.poll.default_profile or None
+    get_matching_profile.short_description = _('matching profile')
+
+    def get_answered_bitmap(self):
+        """
+        returns the answered questions as bitmap over the current poll plan. Only
+        rebuilt from _answered_questions, if the questions of the poll changed.
+        """
+        plan = get_plan(self.poll_id)
+        if self._bitmap_layout != plan.layout:
+            using = sharding.db_for(self)
+            bitmap = plan.bitmap(Walkthrough._answered_questions.through.objects.using(using).filter(
+                walkthrough=self).values_list('question_id', flat=True))
+            self._answered_bitmap, self._bitmap_layout = '%x' % bitmap, plan.layout
+            Walkthrough.objects.using(using).filter(pk=self.pk).update(
+                _answered_bitmap=self._answered_bitmap, _bitmap_layout=self._bitmap_layout)
+        return int(self._answered_bitmap or '0', 16)
+
+    def is_answered(self, question_id):
+        index = get_plan(self.poll_id).question_index.get(question_id)
+        return index is not None and bool(self.get_answered_bitmap() & (1 << index))
+
+    def get_next_question_id(self):
+        return get_plan(self.poll_id).first_unanswered_id(self.get_answered_bitmap())
 
     def get_next_question(self):
-        try:
-            return self.poll.questions.all().exclude(id__in=self._answered_questions.all().values_list('id', flat=True))[0]
-        except IndexError:
-            # All questions are answered
-            
-            if not self._completed:
-                self._completed = datetime.now()
-                self.save()
-            
+        next_id = self.get_next_question_id()
+
+        if next_id is None:
+            # All questions are answered, completion is set by scoring.update_walkthroughs
             return None
+        return Question.objects.get(pk=next_id)
 
 
 class WalkthroughProfile(TimestampMixin):
@@ -171,62 +235,129 @@ class WalkthroughProfile(TimestampMixin):
     profile = models.ForeignKey(Profile, related_name='walkthroughprofiles')
     quantifier = models.IntegerField(_('quantifier'), default=1)
 
+    class Meta:
+        unique_together = ('walkthrough', 'profile')
+        index_together = (
+            ('walkthrough', 'quantifier'),
+        )
+
+
+class ArchivedWalkthrough(models.Model):
+    """
+    Compact row of an abandoned walkthrough, moved here by the archive_walkthroughs
+    command. The answers are packed as comma separated answer ids.
+    """
+    walkthrough_id = models.IntegerField(unique=True)
+    poll = models.ForeignKey(Poll, related_name='archived_walkthroughs')
+    answers = models.TextField(blank=True, default='')
+    progress = models.FloatField(blank=True, null=True)
+    matching_profile_id = models.IntegerField(blank=True, null=True)
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
 
-@receiver(m2m_changed, sender=Walkthrough.answers.through)
-def denormalize_walkthrough(signal, sender, instance, action, reverse, model, pk_set, using, **kwargs):
-    if 'post' in action and pk_set and len(pk_set):
+    def __unicode__(self):
+        return u'%s %s %s' %(self.walkthrough_id, self.poll, self.modified)
+
+    @property
+    def answer_ids(self):
+        return [int(id) for id in self.answers.split(',') if id]
+
+
+class IdSequence(models.Model):
+    """
+    Next free id of a sequence shared by several databases, see sharding.IdAllocator
+    """
+    name = models.CharField(max_length=50, unique=True)
+    next_id = models.BigIntegerField(default=1)
+
+    def __unicode__(self):
+        return u'%s %s' %(self.name, self.next_id)
+
+
+class PollStatsCounter(models.Model):
+    """
+    Incremental counters of a poll, summed up by stats.get_stats. Every counter is
+    spread over several shard rows, which are incremented at random.
+    """
+    KIND_ANSWER = 'answer'
+    KIND_COMPLETED = 'completed'
+    KIND_PROFILE = 'profile'
+    KIND_CHOICES = (
+        (KIND_ANSWER, _('walkthroughs with this answer')),
+        (KIND_COMPLETED, _('completed walkthroughs')),
+        (KIND_PROFILE, _('completed walkthroughs matching this profile')),
+    )
+
+    poll = models.ForeignKey(Poll, related_name='stats_counters')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    key = models.IntegerField(default=0) # answer or profile id
+    shard = models.PositiveSmallIntegerField(default=0)
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('poll', 'kind', 'key', 'shard')
 
-        answer = model.objects.get(pk=pk_set.pop())
-        question = answer.question
 
-        if 'add' in action:
+@receiver(m2m_changed, sender=Walkthrough.answers.through)
+@instrumented('denormalize_walkthrough')
+def denormalize_walkthrough(signal, sender, instance, action, reverse, model, pk_set, using, **kwargs):
+    # only the walkthrough side of the relation is denormalized
+    if reverse:
+        return
+
+    if action in ('pre_remove', 'pre_clear'):
+        # remember the answers really removed, for the poll statistics
+        answers = instance.answers.through.objects.using(sharding.db_for(instance)).filter(walkthrough=instance)
+        if action == 'pre_remove':
+            answers = answers.filter(answer__in=pk_set)
+        instance._removed_answers = list(answers.values_list('answer_id', flat=True))
+
+    elif action in ('post_add', 'post_remove') and pk_set:
+        if action == 'post_add':
             # question already answered -> keep last answer
-            if question in instance._answered_questions.all():
-                if not question.multiple_answers:
-                    instance.answers.through.objects.filter(walkthrough=instance, answer__question=question).exclude(answer=answer).delete()
-            else:
-                instance._answered_questions.add(question)
-
-            for answer_profile in answer.answerprofiles.all():
-                if not answer_profile.profile in instance._profiles.all():
-                    WalkthroughProfile.objects.create(
-                        walkthrough = instance,
-                        profile = answer_profile.profile,
-                        quantifier = answer_profile.quantifier
-                    )
-                else:
-                    walkthroughprofile = instance.walkthroughprofiles.get(profile=answer_profile.profile)
-                    walkthroughprofile.quantifier += answer_profile.quantifier
-                    walkthroughprofile.save()
-
-        elif 'remove' in action:
-            instance._answered_questions.remove(question)
-
-            for answer_profile in answer.answerprofiles.all():
-                if answer_profile.profile in instance._profiles.all():
-                    walkthroughprofile = instance.walkthroughprofiles.get(profile=answer_profile.profile)
-                    walkthroughprofile.quantifier -= answer_profile.quantifier
-                    walkthroughprofile.save()
-
-        all_questions_count = instance.poll.questions.all().count() or 1
-        answered_questions_count = instance._answered_questions.all().count()
-
-        if answered_questions_count > 0:
-            instance._progress = float(answered_questions_count) / float(all_questions_count)
+            removed = scoring.keep_last_answers(instance, pk_set)
+            stats.record(stats.answer_deltas(instance.poll_id, added=pk_set, removed=removed))
         else:
-            instance._progress = 0
+            stats.record(stats.answer_deltas(instance.poll_id, removed=instance.__dict__.pop('_removed_answers', ())))
+
+        scoring.update_walkthrough(instance)
+
+    elif action == 'post_clear':
+        stats.record(stats.answer_deltas(instance.poll_id, removed=instance.__dict__.pop('_removed_answers', ())))
+        scoring.clear_walkthrough(instance)
+
+
+@receiver(post_delete, sender=Walkthrough)
+def forget_result_snapshot(sender, instance, **kwargs):
+    results.forget_snapshot(instance.pk)
+
+
+@receiver(post_save, sender=Poll)
+@receiver(post_delete, sender=Poll)
+def invalidate_poll_plan(sender, instance, **kwargs):
+    invalidate_plan(instance.pk)
+    invalidate_polls()
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_plan(sender, instance, **kwargs):
+    invalidate_plan(instance.poll_id)
+    # the registry knows the first question of every active poll
+    invalidate_polls()
 
-        if answered_questions_count == all_questions_count:
-            instance._completed = datetime.now()
-        else:
-            instance._completed = None
 
-        instance.save()
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def invalidate_answer_plan(sender, instance, **kwargs):
+    # on cascading deletes the question is already gone and invalidates the plan itself
+    for poll_id in Question.objects.filter(pk=instance.question_id).values_list('poll_id', flat=True):
+        invalidate_plan(poll_id)
 
-    elif 'post_clear' in action:
-        instance._answered_questions.clear()
-        instance._profiles.clear()
-        instance._completed = None
-        instance._progress = None
-        instance.save()
 
+@receiver(post_save, sender=AnswerProfile)
+@receiver(post_delete, sender=AnswerProfile)
+def invalidate_answerprofile_plan(sender, instance, **kwargs):
+    for poll_id in Answer.objects.filter(pk=instance.answer_id).values_list('question__poll_id', flat=True):
+        invalidate_plan(poll_id)
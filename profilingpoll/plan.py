@@ -0,0 +1,279 @@
+"""
+Compiled poll plans.
+
+A plan is an immutable snapshot of everything the walkthrough flow needs to know
+about a poll: the ordered question ids, the answer choices per question and the
+answer -> profile quantifiers. Plans are built with a fixed number of queries, kept
+in process memory and in the django cache and are versioned: every save or delete
+of a Poll, Question, Answer or AnswerProfile bumps the version of the affected poll
+(see the receivers in models.py), so all processes rebuild on their next lookup.
+
+Question instances are kept in a process local LRU cache as well, each valid for the
+plan version it was loaded with.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from . import app_settings
+from .instrumentation import cache_hit
+
+
+GENERATION_KEY = 'profilingpoll:plan:generation'
+
+# poll id -> PollPlan, local to this process
+_local_plans = {}
+
+# question id -> (expires, plan version, Question), least recently used first, local to this process
+_local_questions = OrderedDict()
+_questions_lock = threading.Lock()
+
+
+class PollPlan(object):
+    # plans cached before questions could take multiple answers
+    multiple = frozenset()
+
+    def __init__(self, poll_id, version, slug, default_profile_id, question_ids, choices, answer_questions,
+                 quantifiers, multiple=()):
+        self.poll_id = poll_id
+        self.version = version
+        self.slug = slug
+        self.default_profile_id = default_profile_id
+        self.question_ids = tuple(question_ids)
+        self.question_index = dict((question_id, index) for index, question_id in enumerate(self.question_ids))
+        # identifies the question order, answered question bitmaps are only valid for the same layout
+        self.layout = hashlib.md5(','.join(str(id) for id in self.question_ids)).hexdigest()[:12]
+        self.choices = choices                  # question id -> ((answer id, text), ...)
+        self.answer_questions = answer_questions  # answer id -> question id
+        self.quantifiers = quantifiers          # answer id -> ((profile id, quantifier), ...)
+        self.multiple = frozenset(multiple)     # ids of the questions taking multiple answers
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    @property
+    def first_question_id(self):
+        try:
+            return self.question_ids[0]
+        except IndexError:
+            return None
+
+    def index(self, question_id):
+        """
+        returns the number the question has in the poll
+        """
+        try:
+            return self.question_index[question_id]
+        except KeyError:
+            raise ValueError('Question %s is not part of poll %s' % (question_id, self.poll_id))
+
+    def next_question_id(self, question_id):
+        try:
+            return self.question_ids[self.index(question_id) + 1]
+        except IndexError:
+            return None
+
+    def bitmap(self, question_ids):
+        """
+        returns the bitmap of the given questions, bit n stands for the n-th question
+        """
+        bitmap = 0
+        for question_id in question_ids:
+            if question_id in self.question_index:
+                bitmap |= 1 << self.question_index[question_id]
+        return bitmap
+
+    def first_unanswered_index(self, bitmap):
+        """
+        returns the index of the first question not in bitmap, len(self) if all are answered
+        """
+        index = 0
+        while bitmap & (1 << index):
+            index += 1
+        return min(index, len(self))
+
+    def first_unanswered_id(self, bitmap):
+        try:
+            return self.question_ids[self.first_unanswered_index(bitmap)]
+        except IndexError:
+            return None
+
+    def allows_multiple(self, question_id):
+        return question_id in self.multiple
+
+    def group_answers(self, answer_ids, complete=True):
+        """
+        returns {question id: [answer ids]} of the given answers. Raises ValueError, if an
+        answer isn't part of the poll, a single answer question got several answers or,
+        with complete, a question isn't answered.
+        """
+        questions = {}
+        for answer_id in answer_ids:
+            if answer_id not in self.answer_questions:
+                raise ValueError('Answer %s is not part of poll %s' % (answer_id, self.poll_id))
+            questions.setdefault(self.answer_questions[answer_id], []).append(answer_id)
+
+        for question_id, answers in questions.items():
+            if len(set(answers)) > 1 and question_id not in self.multiple:
+                raise ValueError('Question %s allows only one answer' % question_id)
+            questions[question_id] = sorted(set(answers))
+
+        if complete and len(questions) < len(self.question_ids):
+            raise ValueError('Question %s is not answered' % [question_id for question_id in self.question_ids
+                                                                if question_id not in questions][0])
+        return questions
+
+    def answer_choices(self, question_id):
+        return self.choices.get(question_id, ())
+
+    def question_url(self, question_id):
+        return reverse('profilingpoll_question', kwargs={'poll__slug': self.slug, 'id': question_id})
+
+    def profile_totals(self, answer_ids):
+        """
+        sums up the quantifiers of the given answers per profile id
+        """
+        totals = {}
+        for answer_id in answer_ids:
+            for profile_id, quantifier in self.quantifiers.get(answer_id, ()):
+                totals[profile_id] = totals.get(profile_id, 0) + quantifier
+        return totals
+
+
+def _version_key(poll_id):
+    return 'profilingpoll:plan:%s:version' % poll_id
+
+
+def _plan_key(poll_id, version):
+    return 'profilingpoll:plan:%s:%s' % (poll_id, version)
+
+
+def new_token():
+    """
+    returns a random version token, also used by the registry of active polls
+    """
+    return uuid.uuid4().hex[:12]
+
+
+def get_version(poll_id):
+    """
+    returns the current version token of the plan for poll_id with one cache round trip
+    """
+    keys = [GENERATION_KEY, _version_key(poll_id)]
+    tokens = cache.get_many(keys)
+
+    for key in keys:
+        if key not in tokens:
+            # unknown or evicted: start a fresh token, so no stale plan can ever match
+            cache.add(key, new_token(), app_settings.PLAN_CACHE_TIMEOUT)
+            tokens[key] = cache.get(key)
+
+    return '%s.%s' % tuple(tokens[key] for key in keys)
+
+
+def build_plan(poll_id, version=None):
+    from .models import Poll, Question, Answer, AnswerProfile
+
+    slug, default_profile_id = Poll.objects.values_list('slug', 'default_profile_id').get(pk=poll_id)
+    questions = list(Question.objects.filter(poll=poll_id).values_list('id', 'multiple_answers'))
+
+    choices = {}
+    answer_questions = {}
+    for answer_id, question_id, text in Answer.objects.filter(question__poll=poll_id).values_list(
+            'id', 'question_id', 'text'):
+        choices.setdefault(question_id, []).append((answer_id, text))
+        answer_questions[answer_id] = question_id
+
+    quantifiers = {}
+    for answer_id, profile_id, quantifier in AnswerProfile.objects.filter(
+            answer__question__poll=poll_id).order_by('id').values_list('answer_id', 'profile_id', 'quantifier'):
+        profiles = quantifiers.setdefault(answer_id, {})
+        profiles[profile_id] = profiles.get(profile_id, 0) + quantifier
+
+    return PollPlan(
+        poll_id=poll_id,
+        version=version,
+        slug=slug,
+        default_profile_id=default_profile_id,
+        question_ids=[question_id for question_id, multiple in questions],
+        choices=dict((question_id, tuple(answers)) for question_id, answers in choices.items()),
+        answer_questions=answer_questions,
+        quantifiers=dict((answer_id, tuple(sorted(profiles.items()))) for answer_id, profiles in quantifiers.items()),
+        multiple=[question_id for question_id, multiple in questions if multiple],
+    )
+
+
+def get_plan(poll_id):
+    """
+    returns the compiled plan for poll_id. Raises Poll.DoesNotExist for unknown polls.
+    """
+    version = get_version(poll_id)
+
+    plan = _local_plans.get(poll_id)
+    if plan is not None and plan.version == version:
+        cache_hit(True)
+        return plan
+
+    plan = cache.get(_plan_key(poll_id, version))
+    cache_hit(plan is not None)
+    if plan is None:
+        plan = build_plan(poll_id, version)
+        cache.set(_plan_key(poll_id, version), plan, app_settings.PLAN_CACHE_TIMEOUT)
+
+    _local_plans[poll_id] = plan
+    return plan
+
+
+def invalidate_plan(poll_id=None):
+    """
+    bumps the version of the plan for poll_id or, without poll_id, of all plans
+    """
+    if poll_id is None:
+        cache.set(GENERATION_KEY, new_token(), app_settings.PLAN_CACHE_TIMEOUT)
+        _local_plans.clear()
+        with _questions_lock:
+            _local_questions.clear()
+    else:
+        cache.set(_version_key(poll_id), new_token(), app_settings.PLAN_CACHE_TIMEOUT)
+        _local_plans.pop(poll_id, None)
+
+
+def get_question(question_id, poll_slug=None):
+    """
+    returns the Question with question_id, from process memory as long as the plan of
+    its poll didn't change. Raises Question.DoesNotExist for unknown questions and for
+    questions not part of the poll with poll_slug.
+    """
+    from .models import Question
+
+    now = time.time()
+    with _questions_lock:
+        entry = _local_questions.pop(question_id, None)
+        if entry is not None:
+            _local_questions[question_id] = entry
+
+    question = None
+    if entry is not None and entry[0] > now:
+        plan = get_plan(entry[2].poll_id)
+        if plan.version == entry[1] and question_id in plan.question_index:
+            question = entry[2]
+    cache_hit(question is not None)
+
+    if question is None:
+        question = Question.objects.get(pk=question_id)
+        # an edit between the query and this lookup is caught by the timeout at the latest
+        plan = get_plan(question.poll_id)
+        with _questions_lock:
+            _local_questions.pop(question_id, None)
+            _local_questions[question_id] = (now + app_settings.QUESTION_CACHE_TIMEOUT, plan.version, question)
+            while len(_local_questions) > app_settings.QUESTION_CACHE_SIZE:
+                _local_questions.popitem(last=False)
+
+    if poll_slug is not None and plan.slug != poll_slug:
+        raise Question.DoesNotExist('Question %s is not part of poll %s' % (question_id, poll_slug))
+    return question
@@ -0,0 +1,82 @@
+"""
+Registry of the active polls, local to every worker.
+
+The registry maps the slugs of the active polls to their id, title and first question
+url, so the entry views and the FirstPoll content answer without queries. It is
+versioned by a token in the django cache, which every save or delete of a Poll or
+Question bumps (see the receivers in models.py): each process compares its registry
+with the token once per lookup and reloads it lazily, with one query and the cached
+poll plans.
+"""
+from django.core.cache import cache
+
+from . import app_settings
+from .plan import new_token, get_plan
+
+
+VERSION_KEY = 'profilingpoll:polls:version'
+
+# the PollRegistry of this process
+_local_registry = [None]
+
+
+class ActivePoll(object):
+    def __init__(self, id, slug, title, first_question_url):
+        self.id = self.pk = id
+        self.slug = slug
+        self.title = title
+        self.first_question_url = first_question_url
+
+
+class PollRegistry(object):
+    def __init__(self, version, polls):
+        self.version = version
+        self.polls = tuple(polls)   # ActivePolls, oldest first
+        self.slugs = dict((poll.slug, poll) for poll in self.polls)
+
+    def __len__(self):
+        return len(self.polls)
+
+    def __iter__(self):
+        return iter(self.polls)
+
+    def get(self, slug):
+        return self.slugs.get(slug)
+
+
+def get_polls_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        token = new_token()
+        cache.add(VERSION_KEY, token, app_settings.PLAN_CACHE_TIMEOUT)
+        version = cache.get(VERSION_KEY) or token
+    return version
+
+
+def invalidate_polls():
+    cache.set(VERSION_KEY, new_token(), app_settings.PLAN_CACHE_TIMEOUT)
+    _local_registry[0] = None
+
+
+def load_registry(version):
+    from .models import Poll
+
+    polls = []
+    for id, slug, title in Poll.objects.filter(active=True).order_by('id').values_list('id', 'slug', 'title'):
+        plan = get_plan(id)
+        first_question_url = plan.question_url(plan.first_question_id) if plan.first_question_id else None
+        polls.append(ActivePoll(id, slug, title, first_question_url))
+    return PollRegistry(version, polls)
+
+
+def get_registry():
+    """
+    returns the registry of the active polls with one cache lookup, reloaded if a
+    Poll or Question changed since
+    """
+    # read before loading, so changes during the load are caught by the next lookup
+    version = get_polls_version()
+    registry = _local_registry[0]
+    if registry is None or registry.version != version:
+        registry = _local_registry[0] = load_registry(version)
+    return registry
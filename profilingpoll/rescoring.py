@@ -0,0 +1,147 @@
+"""
+Re-scoring of historical walkthroughs, e.g. after quantifiers were changed.
+
+The answers of a poll's walkthroughs are loaded in chunks as walkthrough x answer
+incidence matrix and multiplied with the answer x profile quantifier matrix of the
+compiled poll plan, which gives all profile totals of the chunk at once. Like in live
+scoring, profiles once scored keep their row with 0. Only the walkthroughs whose
+totals changed are written back: their WalkthroughProfile rows are
+replaced with one delete and one bulk insert, the matching profiles are updated with
+one query per profile.
+
+NumPy is used if installed, otherwise the same totals are summed up in python.
+"""
+from datetime import datetime
+
+from django.db import transaction
+
+from .plan import get_plan
+from .scoring import kept_totals, matching_profile_id, group_pairs
+from .stats import rebuild_stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class QuantifierMatrix(object):
+    """
+    the quantifiers of a poll plan as answer x profile matrix
+    """
+    def __init__(self, plan):
+        self.answer_ids = sorted(plan.quantifiers)
+        self.profile_ids = sorted(set(profile_id for quantifiers in plan.quantifiers.values()
+                                      for profile_id, quantifier in quantifiers))
+        self.answer_index = dict((answer_id, index) for index, answer_id in enumerate(self.answer_ids))
+        profile_index = dict((profile_id, index) for index, profile_id in enumerate(self.profile_ids))
+
+        shape = (len(self.answer_ids), len(self.profile_ids))
+        self.quantifiers = numpy.zeros(shape, dtype=numpy.int64)
+        # answers scoring a profile, even with 0: their walkthroughs get a WalkthroughProfile row
+        self.scored = numpy.zeros(shape, dtype=numpy.int64)
+        for answer_id, quantifiers in plan.quantifiers.items():
+            for profile_id, quantifier in quantifiers:
+                self.quantifiers[self.answer_index[answer_id], profile_index[profile_id]] = quantifier
+                self.scored[self.answer_index[answer_id], profile_index[profile_id]] = 1
+
+    def totals(self, walkthrough_ids, answers):
+        """
+        returns {walkthrough id: {profile id: total}} for the given {walkthrough id: answer ids}
+        """
+        incidence = numpy.zeros((len(walkthrough_ids), len(self.answer_ids)), dtype=numpy.int64)
+        for row, walkthrough_id in enumerate(walkthrough_ids):
+            columns = [self.answer_index[answer_id] for answer_id in answers.get(walkthrough_id, ())
+                       if answer_id in self.answer_index]
+            incidence[row, columns] = 1
+
+        totals = incidence.dot(self.quantifiers)
+        scored = incidence.dot(self.scored) > 0
+
+        result = {}
+        for row, walkthrough_id in enumerate(walkthrough_ids):
+            result[walkthrough_id] = dict((self.profile_ids[column], int(totals[row, column]))
+                                          for column in numpy.nonzero(scored[row])[0])
+        return result
+
+
+def chunk_totals(plan, matrix, walkthrough_ids, answers):
+    if matrix is not None:
+        return matrix.totals(walkthrough_ids, answers)
+    return dict((walkthrough_id, plan.profile_totals(answers.get(walkthrough_id, ())))
+                for walkthrough_id in walkthrough_ids)
+
+
+def rescore_poll(poll_id, chunk_size=1000, dry_run=False):
+    """
+    recomputes the profile totals and matching profiles of all walkthroughs of a poll
+    with its current quantifiers. Returns {'walkthroughs', 'changed', 'before', 'after'},
+    where before and after map profile ids (None for the default) to the number of
+    completed walkthroughs matching them. With dry_run nothing is written.
+    """
+    from .models import Walkthrough, WalkthroughProfile
+
+    plan = get_plan(poll_id)
+    matrix = QuantifierMatrix(plan) if numpy is not None else None
+    through = Walkthrough.answers.through
+    now = datetime.now()
+    result = {'walkthroughs': 0, 'changed': 0, 'before': {}, 'after': {}}
+    rescored = False
+
+    for queryset in Walkthrough.objects.shards():
+        using = queryset.db
+        queryset = queryset.filter(poll=poll_id)
+
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+                'id', '_matching_profile_id', '_completed')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            ids = [row[0] for row in chunk]
+
+            answers = group_pairs(through.objects.using(using).filter(walkthrough__in=ids).values_list(
+                'walkthrough_id', 'answer_id'))
+            totals = chunk_totals(plan, matrix, ids, answers)
+
+            existing = dict((id, {}) for id in ids)
+            for walkthrough_id, profile_id, quantifier in WalkthroughProfile.objects.using(using).filter(
+                    walkthrough__in=ids).values_list('walkthrough_id', 'profile_id', 'quantifier'):
+                existing[walkthrough_id][profile_id] = quantifier
+
+            changed = []
+            matchings = []
+            for id, matching, completed in chunk:
+                totals[id] = kept_totals(totals[id], existing[id])
+                new_matching = matching_profile_id(totals[id])
+                if totals[id] != existing[id]:
+                    changed.append(id)
+                if new_matching != matching:
+                    matchings.append((new_matching, id))
+                if completed:
+                    result['before'][matching] = result['before'].get(matching, 0) + 1
+                    result['after'][new_matching] = result['after'].get(new_matching, 0) + 1
+
+            result['walkthroughs'] += len(ids)
+            result['changed'] += len(changed)
+
+            if dry_run or not (changed or matchings):
+                continue
+
+            with transaction.commit_on_success(using=using):
+                WalkthroughProfile.objects.using(using).filter(walkthrough__in=changed).delete()
+                WalkthroughProfile.objects.using(using).bulk_create([
+                    WalkthroughProfile(walkthrough_id=id, profile_id=profile_id, quantifier=quantifier)
+                    for id in changed
+                    for profile_id, quantifier in totals[id].items()
+                ])
+                for value, walkthrough_ids in group_pairs(matchings).items():
+                    Walkthrough.objects.using(using).filter(pk__in=walkthrough_ids).update(_matching_profile=value)
+                Walkthrough.objects.using(using).filter(
+                    pk__in=set(changed).union(id for value, id in matchings)).update(modified=now)
+                rescored = True
+
+    if rescored:
+        rebuild_stats(poll_id)
+    return result
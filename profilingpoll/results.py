@@ -0,0 +1,137 @@
+"""
+Result snapshots of completed walkthroughs.
+
+The first time the result of a completed walkthrough is shown, it is frozen into a
+snapshot: the matching profile, the profile scores and the answers with their shares
+at that time. The snapshot is stored as JSON in Walkthrough._result_snapshot and
+cached per walkthrough, so shared result links are served without queries and with
+long-lived caching headers. Published results don't follow later changes, e.g. of a
+rescoring.
+"""
+import json
+
+from django.core.cache import cache
+from django.template.defaultfilters import truncatechars
+
+from . import app_settings
+from .instrumentation import cache_hit
+from .plan import get_plan
+from .sharding import db_for, shard_for
+from .stats import get_stats
+
+
+def _cache_key(walkthrough_id):
+    return 'profilingpoll:result:%s' % walkthrough_id
+
+
+class ResultProfile(object):
+    """
+    the fields of the matching Profile the result page shows
+    """
+    def __init__(self, id, description, text, link, link_text):
+        self.id = self.pk = id
+        self.description = description
+        self.text = text
+        self.link = link
+        self.link_text = link_text
+
+    def __unicode__(self):
+        if self.description:
+            return self.description
+        else:
+            return truncatechars(self.text, 50)
+
+
+class ResultSnapshot(object):
+    def __init__(self, walkthrough_id, poll_id, completed, profile, scores, profile_share, answer_shares):
+        self.walkthrough_id = walkthrough_id
+        self.poll_id = poll_id
+        self.completed = completed
+        self.profile = profile                  # ResultProfile or None
+        self.scores = scores                    # profile id -> total
+        self.profile_share = profile_share
+        self.answer_shares = answer_shares      # [(answer text, share)]
+
+    def dumps(self):
+        return json.dumps({
+            'walkthrough': self.walkthrough_id,
+            'poll': self.poll_id,
+            'completed': self.completed,
+            'profile': self.profile and [self.profile.id, self.profile.description, self.profile.text,
+                                         self.profile.link, self.profile.link_text],
+            'scores': self.scores,
+            'profile_share': self.profile_share,
+            'answer_shares': self.answer_shares,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        return cls(
+            walkthrough_id=data['walkthrough'],
+            poll_id=data['poll'],
+            completed=data['completed'],
+            profile=data['profile'] and ResultProfile(*data['profile']),
+            scores=dict((int(profile_id), total) for profile_id, total in data['scores'].items()),
+            profile_share=data['profile_share'],
+            answer_shares=[tuple(answer) for answer in data['answer_shares']],
+        )
+
+
+def build_snapshot(walkthrough):
+    from .models import Walkthrough
+
+    using = db_for(walkthrough)
+    plan = get_plan(walkthrough.poll_id)
+    stats = get_stats(walkthrough.poll_id)
+    texts = dict(choice for question_id in plan.question_ids for choice in plan.answer_choices(question_id))
+    profile = walkthrough.get_matching_profile()
+
+    return ResultSnapshot(
+        walkthrough_id=walkthrough.pk,
+        poll_id=walkthrough.poll_id,
+        completed=bool(walkthrough._completed),
+        profile=profile and ResultProfile(profile.pk, profile.description, profile.text, profile.link,
+                                          profile.link_text),
+        scores=dict(walkthrough.walkthroughprofiles.values_list('profile_id', 'quantifier')),
+        profile_share=stats.profile_share(profile and profile.pk or 0),
+        answer_shares=[(texts.get(answer_id), stats.answer_share(answer_id))
+                       for answer_id in Walkthrough.answers.through.objects.using(using).filter(
+                           walkthrough=walkthrough).values_list('answer_id', flat=True)],
+    )
+
+
+def get_snapshot(walkthrough_id):
+    """
+    returns the result snapshot of a walkthrough, frozen on the first call after its
+    completion. Incomplete walkthroughs get a fresh snapshot every time. Raises
+    Walkthrough.DoesNotExist.
+    """
+    from .models import Walkthrough
+
+    data = cache.get(_cache_key(walkthrough_id))
+    cache_hit(data is not None)
+    if data is not None:
+        return ResultSnapshot.loads(data)
+
+    using = shard_for(walkthrough_id)
+    walkthrough = Walkthrough.objects.using(using)
+    if not app_settings.SHARDS:
+        # the profiles can't be joined across databases
+        walkthrough = walkthrough.select_related('_matching_profile', 'poll__default_profile')
+    walkthrough = walkthrough.get(pk=walkthrough_id)
+    if walkthrough._result_snapshot:
+        data = walkthrough._result_snapshot
+    else:
+        snapshot = build_snapshot(walkthrough)
+        if not snapshot.completed:
+            return snapshot
+        data = snapshot.dumps()
+        Walkthrough.objects.using(using).filter(pk=walkthrough_id).update(_result_snapshot=data)
+
+    cache.set(_cache_key(walkthrough_id), data, app_settings.RESULT_CACHE_TIMEOUT)
+    return ResultSnapshot.loads(data)
+
+
+def forget_snapshot(walkthrough_id):
+    cache.delete(_cache_key(walkthrough_id))
@@ -0,0 +1,341 @@
+"""
+Set based scoring of walkthroughs.
+
+Instead of replaying every single answer through the m2m signal, the denormalized
+fields of walkthroughs (answered questions and their bitmap, progress, completion and
+the per profile totals in WalkthroughProfile) are recomputed from their whole answer sets against the
+compiled poll plans. This costs a constant number of queries, independent of the
+number of walkthroughs, answers, questions and profiles involved, per shard of the
+walkthroughs (see sharding.py).
+"""
+import operator
+from contextlib import contextmanager
+from datetime import datetime
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Q
+
+from . import stats
+from .instrumentation import instrumented
+from .plan import get_plan
+from .sharding import db_for, group_by_shard
+
+
+def _answer_through():
+    from .models import Walkthrough
+    return Walkthrough.answers.through
+
+
+def _question_through():
+    from .models import Walkthrough
+    return Walkthrough._answered_questions.through
+
+
+def group_pairs(pairs):
+    """
+    returns {key: [values]} of (key, value) pairs
+    """
+    groups = {}
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return groups
+
+
+@contextmanager
+def _commit_on_success(using):
+    """
+    commit_on_success on using, unless the caller manages the transaction already:
+    leaving a nested commit_on_success would commit the caller's transaction early
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+
+def matching_profile_id(quantifiers, default=None):
+    """
+    returns the profile id with the highest quantifier, the lowest profile id on ties
+    """
+    if not quantifiers:
+        return default
+    return min(quantifiers.items(), key=lambda item: (-item[1], item[0]))[0]
+
+
+def kept_totals(totals, existing):
+    """
+    returns the profile totals a walkthrough keeps rows for: totals, plus 0 for the
+    profiles of existing, which were scored once and aren't anymore
+    """
+    quantifiers = dict((profile_id, 0) for profile_id in existing)
+    quantifiers.update(totals)
+    return quantifiers
+
+
+def keep_last_answers(walkthrough, answer_ids, plan=None):
+    """
+    removes all other answers to the questions of answer_ids from walkthrough, if the
+    question doesn't allow multiple answers. Does not send m2m signals. Returns the
+    removed answer ids.
+    """
+    plan = plan or get_plan(walkthrough.poll_id)
+
+    # answer ids which are replaced by the new ones. If a question gets several new
+    # answers at once, only the last one is kept.
+    last_answers = {}
+    for answer_id in sorted(answer_ids):
+        question_id = plan.answer_questions.get(answer_id)
+        if question_id is not None and not plan.allows_multiple(question_id):
+            last_answers[question_id] = answer_id
+
+    replaced = [choice_id
+                for question_id, answer_id in last_answers.items()
+                for choice_id, text in plan.answer_choices(question_id)
+                if choice_id != answer_id]
+
+    if not replaced:
+        return []
+
+    answers = _answer_through().objects.using(db_for(walkthrough)).filter(walkthrough=walkthrough, answer__in=replaced)
+    removed = list(answers.values_list('answer_id', flat=True))
+    if removed:
+        answers.filter(answer__in=removed).delete()
+    return removed
+
+
+def update_walkthroughs(walkthroughs, answer_ids=None):
+    """
+    recomputes the answered questions, progress, completion and profile totals of
+    walkthroughs from their answers. answer_ids optionally maps walkthrough ids to
+    their already known answer ids.
+    """
+    updated = []
+    for using, shard_walkthroughs in group_by_shard(walkthroughs).items():
+        updated.extend(_update_walkthroughs(shard_walkthroughs, answer_ids, using))
+    return updated
+
+
+@instrumented('scoring.update_walkthroughs')
+def _update_walkthroughs(walkthroughs, answer_ids, using):
+    from .models import Walkthrough, WalkthroughProfile
+
+    walkthroughs = dict((walkthrough.pk, walkthrough) for walkthrough in walkthroughs)
+    plans = dict((walkthrough.poll_id, get_plan(walkthrough.poll_id)) for walkthrough in walkthroughs.values())
+    now = datetime.now()
+
+    with _commit_on_success(using):
+        answers = dict((id, set()) for id in walkthroughs)
+        if answer_ids is None:
+            for walkthrough_id, answer_id in _answer_through().objects.using(using).filter(
+                    walkthrough__in=walkthroughs.keys()).values_list('walkthrough_id', 'answer_id'):
+                answers[walkthrough_id].add(answer_id)
+        else:
+            for walkthrough_id in walkthroughs:
+                answers[walkthrough_id].update(answer_ids.get(walkthrough_id, ()))
+
+        # answered questions
+        answered = {}
+        for walkthrough_id, walkthrough in walkthroughs.items():
+            plan = plans[walkthrough.poll_id]
+            answered[walkthrough_id] = set(plan.answer_questions[answer_id]
+                                           for answer_id in answers[walkthrough_id]
+                                           if answer_id in plan.answer_questions)
+
+        question_through = _question_through()
+        stale = []
+        current = dict((id, set()) for id in walkthroughs)
+        for id, walkthrough_id, question_id in question_through.objects.using(using).filter(
+                walkthrough__in=walkthroughs.keys()).values_list('id', 'walkthrough_id', 'question_id'):
+            if question_id in answered[walkthrough_id]:
+                current[walkthrough_id].add(question_id)
+            else:
+                stale.append(id)
+
+        if stale:
+            question_through.objects.using(using).filter(id__in=stale).delete()
+        question_through.objects.using(using).bulk_create([
+            question_through(walkthrough_id=walkthrough_id, question_id=question_id)
+            for walkthrough_id, question_ids in answered.items()
+            for question_id in question_ids - current[walkthrough_id]
+        ])
+
+        # profile totals. Profiles once scored keep their row, even if they drop to 0.
+        totals = dict((walkthrough_id, plans[walkthrough.poll_id].profile_totals(answers[walkthrough_id]))
+                      for walkthrough_id, walkthrough in walkthroughs.items())
+        existing = dict((id, {}) for id in walkthroughs)
+        changed = []
+        rows = []
+        for id, walkthrough_id, profile_id, quantifier in WalkthroughProfile.objects.using(using).filter(
+                walkthrough__in=walkthroughs.keys()).values_list('id', 'walkthrough_id', 'profile_id', 'quantifier'):
+            existing[walkthrough_id][profile_id] = quantifier
+            if totals[walkthrough_id].get(profile_id, 0) != quantifier:
+                changed.append(id)
+                rows.append((walkthrough_id, profile_id, totals[walkthrough_id].get(profile_id, 0)))
+        rows.extend((walkthrough_id, profile_id, quantifier)
+                    for walkthrough_id, profile_totals in totals.items()
+                    for profile_id, quantifier in profile_totals.items()
+                    if profile_id not in existing[walkthrough_id])
+
+        # changed rows are replaced, so any number of new totals costs two queries
+        if changed:
+            WalkthroughProfile.objects.using(using).filter(id__in=changed).delete()
+        WalkthroughProfile.objects.using(using).bulk_create([
+            WalkthroughProfile(walkthrough_id=walkthrough_id, profile_id=profile_id, quantifier=quantifier)
+            for walkthrough_id, profile_id, quantifier in rows
+        ])
+
+        # progress and completion, one update per distinct progress, bitmap and completion change
+        progress = []
+        completion = []
+        matchings = []
+        matching_cache = Walkthrough._meta.get_field('_matching_profile').get_cache_name()
+        counters = {}
+        for walkthrough_id, walkthrough in walkthroughs.items():
+            plan = plans[walkthrough.poll_id]
+            question_count = len(plan)
+
+            # matching profile before and after, rows once scored count with 0
+            matching = matching_profile_id(existing[walkthrough_id], plan.default_profile_id)
+            quantifiers = kept_totals(totals[walkthrough_id], existing[walkthrough_id])
+            new_matching = matching_profile_id(quantifiers, plan.default_profile_id)
+            was_completed = bool(walkthrough._completed)
+
+            # the denormalized column holds the scored profile only, the default is resolved on read
+            if walkthrough._matching_profile_id != matching_profile_id(quantifiers):
+                walkthrough._matching_profile_id = matching_profile_id(quantifiers)
+                walkthrough.__dict__.pop(matching_cache, None)
+                matchings.append((walkthrough._matching_profile_id, walkthrough_id))
+
+            if answered[walkthrough_id]:
+                walkthrough._progress = float(len(answered[walkthrough_id])) / float(question_count or 1)
+            else:
+                walkthrough._progress = 0
+            walkthrough._answered_bitmap = '%x' % plan.bitmap(answered[walkthrough_id])
+            walkthrough._bitmap_layout = plan.layout
+            progress.append(((walkthrough._progress, walkthrough._answered_bitmap, plan.layout), walkthrough_id))
+
+            if len(answered[walkthrough_id]) == question_count:
+                if not walkthrough._completed:
+                    walkthrough._completed = now
+                    completion.append((now, walkthrough_id))
+            elif walkthrough._completed:
+                walkthrough._completed = None
+                completion.append((None, walkthrough_id))
+            walkthrough.modified = now
+
+            if was_completed and (not walkthrough._completed or matching != new_matching):
+                stats.completion_deltas(walkthrough.poll_id, matching, -1, counters)
+            if walkthrough._completed and (not was_completed or matching != new_matching):
+                stats.completion_deltas(walkthrough.poll_id, new_matching, 1, counters)
+
+        for (value, bitmap, layout), ids in group_pairs(progress).items():
+            Walkthrough.objects.using(using).filter(pk__in=ids).update(
+                _progress=value, _answered_bitmap=bitmap, _bitmap_layout=layout, modified=now)
+        for value, ids in group_pairs(completion).items():
+            Walkthrough.objects.using(using).filter(pk__in=ids).update(_completed=value)
+        for value, ids in group_pairs(matchings).items():
+            Walkthrough.objects.using(using).filter(pk__in=ids).update(_matching_profile=value)
+
+        stats.record(counters)
+
+    return list(walkthroughs.values())
+
+
+def update_walkthrough(walkthrough, answer_ids=None):
+    """
+    recomputes the denormalizations of a single walkthrough, see update_walkthroughs
+    """
+    if answer_ids is not None:
+        answer_ids = {walkthrough.pk: answer_ids}
+    update_walkthroughs([walkthrough], answer_ids=answer_ids)
+    return walkthrough
+
+
+@instrumented('scoring.set_answers')
+def set_answers(walkthroughs):
+    """
+    replaces the answers of the given questions and rescores, without m2m signals.
+    walkthroughs maps Walkthrough instances to {question id: [answer ids]}.
+    """
+    updated = []
+    for using, shard_walkthroughs in group_by_shard(walkthroughs).items():
+        updated.extend(_set_answers(dict((walkthrough, walkthroughs[walkthrough])
+                                         for walkthrough in shard_walkthroughs), using))
+    return updated
+
+
+def _set_answers(walkthroughs, using):
+    through = _answer_through()
+
+    with _commit_on_success(using):
+        replaced = []
+        chosen = {}
+        for walkthrough, questions in walkthroughs.items():
+            plan = get_plan(walkthrough.poll_id)
+            chosen[walkthrough.pk] = set()
+            for question_id, answer_ids in questions.items():
+                choices = set(answer_id for answer_id, text in plan.answer_choices(question_id))
+                chosen[walkthrough.pk].update(choices.intersection(answer_ids))
+                replaced.extend((walkthrough.pk, answer_id) for answer_id in choices.difference(answer_ids))
+
+        existing = set(through.objects.using(using).filter(walkthrough__in=chosen.keys()).values_list(
+            'walkthrough_id', 'answer_id'))
+
+        stale = existing.intersection(replaced)
+        if stale:
+            through.objects.using(using).filter(reduce(operator.or_, [
+                Q(walkthrough=walkthrough_id, answer__in=answer_ids)
+                for walkthrough_id, answer_ids in group_pairs(stale).items()
+            ])).delete()
+        through.objects.using(using).bulk_create([
+            through(walkthrough_id=walkthrough_id, answer_id=answer_id)
+            for walkthrough_id, answer_ids in chosen.items()
+            for answer_id in answer_ids
+            if (walkthrough_id, answer_id) not in existing
+        ])
+
+        counters = {}
+        for walkthrough in walkthroughs:
+            stats.answer_deltas(walkthrough.poll_id,
+                added=[answer_id for answer_id in chosen[walkthrough.pk] if (walkthrough.pk, answer_id) not in existing],
+                removed=[answer_id for walkthrough_id, answer_id in stale if walkthrough_id == walkthrough.pk],
+                deltas=counters)
+        stats.record(counters)
+
+        answer_ids = group_pairs(pair for pair in existing.union(
+            (walkthrough_id, answer_id) for walkthrough_id, answer_ids in chosen.items() for answer_id in answer_ids)
+            if pair not in stale)
+        return _update_walkthroughs(walkthroughs.keys(), answer_ids, using)
+
+
+def clear_walkthrough(walkthrough):
+    """
+    resets all denormalizations of a walkthrough without answers
+    """
+    from .models import Walkthrough, WalkthroughProfile
+
+    using = db_for(walkthrough)
+    with _commit_on_success(using):
+        _question_through().objects.using(using).filter(walkthrough=walkthrough).delete()
+
+        profiles = WalkthroughProfile.objects.using(using).filter(walkthrough=walkthrough)
+        if walkthrough._completed:
+            matching = matching_profile_id(dict(profiles.values_list('profile_id', 'quantifier')),
+                                           get_plan(walkthrough.poll_id).default_profile_id)
+            stats.record(stats.completion_deltas(walkthrough.poll_id, matching, -1))
+        profiles.delete()
+
+        walkthrough._completed = None
+        walkthrough._progress = None
+        walkthrough._matching_profile_id = None
+        walkthrough._answered_bitmap = ''
+        walkthrough._bitmap_layout = None
+        walkthrough.__dict__.pop(Walkthrough._meta.get_field('_matching_profile').get_cache_name(), None)
+        walkthrough.modified = datetime.now()
+        Walkthrough.objects.using(using).filter(pk=walkthrough.pk).update(_completed=None, _progress=None,
+                                                             _matching_profile=None, _answered_bitmap='',
+                                                             _bitmap_layout=None, modified=walkthrough.modified)
+
+    return walkthrough
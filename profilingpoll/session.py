@@ -0,0 +1,230 @@
+"""
+Compact, JSON serializable walkthrough state in the session.
+
+Instead of pickled Walkthrough instances, the session only holds the walkthrough id,
+the layout of the poll plan the state was computed against, a bitmap of the answered
+questions (bit n is the n-th question of the plan) and the index of the next
+unanswered question. The walkthrough itself is only fetched if a view really needs
+it, and then at most once per request.
+
+For cacheable question pages (PROFILINGPOLL_CACHEABLE_QUESTIONS), the state the page
+needs is additionally written to a signed cookie, which the page reads client side:
+"<walkthrough id>.<plan layout>.<choices>", where choices has one character per
+question of the plan, 0 for unanswered, otherwise the base 36 position of the chosen
+answer plus one ("-" if it can't be encoded).
+"""
+from .plan import get_plan
+from .sharding import shard_for
+from .throttling import forget_walkthrough
+from . import app_settings
+
+
+CURRENT_KEY = 'current_walkthrough'
+COMPLETED_KEY = 'completed_walkthroughs'
+STATE_COOKIE_SALT = 'profilingpoll.state'
+CHOICE_CODES = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class WalkthroughState(object):
+    def __init__(self, id, poll_id, layout, answered=0, pending=False):
+        self.id = id
+        self.poll_id = poll_id
+        self.layout = layout
+        self.answered = answered
+        # answers waiting in the write-behind buffer, see buffer.py
+        self.pending = pending
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['poll'], data.get('layout'), data['answered'], data.get('pending', False))
+
+    def to_dict(self):
+        return {'id': self.id, 'poll': self.poll_id, 'layout': self.layout, 'answered': self.answered,
+                'index': self.next_index, 'pending': self.pending}
+
+    @property
+    def plan(self):
+        return get_plan(self.poll_id)
+
+    def is_answered(self, index):
+        return bool(self.answered & (1 << index))
+
+    def mark_answered(self, index):
+        self.answered |= 1 << index
+
+    @property
+    def next_index(self):
+        """
+        index of the first unanswered question, the number of questions if all are answered
+        """
+        return self.plan.first_unanswered_index(self.answered)
+
+    @property
+    def completed(self):
+        return self.next_index >= len(self.plan)
+
+    def next_question_id(self):
+        return self.plan.first_unanswered_id(self.answered)
+
+    def sync(self):
+        """
+        recomputes the bitmap from the database, if the questions of the poll changed since it was built
+        """
+        from .models import Walkthrough
+
+        plan = self.plan
+        if plan.layout != self.layout and not self.pending:
+            self.answered = plan.bitmap(Walkthrough._answered_questions.through.objects.using(
+                shard_for(self.id)).filter(walkthrough=self.id).values_list('question_id', flat=True))
+            self.layout = plan.layout
+            return True
+        return False
+
+
+def get_state(request):
+    """
+    returns the WalkthroughState of the current walkthrough or None
+    """
+    data = request.session.get(CURRENT_KEY, None)
+    if not data:
+        return None
+
+    state = WalkthroughState.from_dict(data)
+    if state.sync():
+        set_state(request, state)
+    return state
+
+
+def set_state(request, state):
+    request.session[CURRENT_KEY] = state and state.to_dict()
+    request.session.modified = True
+
+    if hasattr(request, '_profilingpoll_walkthrough'):
+        del request._profilingpoll_walkthrough
+
+
+def start_walkthrough(request, walkthrough):
+    plan = get_plan(walkthrough.poll_id)
+    state = WalkthroughState(walkthrough.pk, walkthrough.poll_id, plan.layout)
+    set_state(request, state)
+    request._profilingpoll_walkthrough = walkthrough
+    return state
+
+
+def continue_walkthrough(request, walkthrough_id):
+    """
+    makes the walkthrough walkthrough_id the current walkthrough, for clients which lost
+    their session, see throttling.py. Returns its state, None if it is completed or
+    doesn't exist anymore.
+    """
+    from .buffer import get_buffer
+    from .models import Walkthrough
+
+    try:
+        walkthrough = Walkthrough.objects.shard(walkthrough_id).get(pk=walkthrough_id)
+    except Walkthrough.DoesNotExist:
+        return None
+    if walkthrough._completed:
+        return None
+
+    # answers of the lost session may still wait in the answer buffer
+    state = WalkthroughState(walkthrough.pk, walkthrough.poll_id, get_plan(walkthrough.poll_id).layout,
+                             walkthrough.get_answered_bitmap(), pending=bool(get_buffer()))
+    set_state(request, state)
+    request._profilingpoll_walkthrough = walkthrough
+    return state
+
+
+def flush_pending(request):
+    """
+    applies the buffered answers of the current walkthrough, if it has some
+    """
+    from .buffer import get_buffer
+
+    state = get_state(request)
+    if state and state.pending:
+        answer_buffer = get_buffer()
+        if answer_buffer:
+            answer_buffer.flush_walkthrough(state.id)
+        state.pending = False
+        set_state(request, state)
+
+
+def get_walkthrough(request):
+    """
+    returns the current Walkthrough with at most one query per request. If it doesn't
+    exist anymore, e.g. archived in the meantime, the state is cleared and None returned.
+    """
+    from .models import Walkthrough
+
+    if not hasattr(request, '_profilingpoll_walkthrough'):
+        state = get_state(request)
+        try:
+            walkthrough = state and Walkthrough.objects.shard(state.id).get(pk=state.id)
+        except Walkthrough.DoesNotExist:
+            set_state(request, None)
+            walkthrough = None
+        request._profilingpoll_walkthrough = walkthrough
+    return request._profilingpoll_walkthrough
+
+
+def complete_walkthrough(request):
+    """
+    moves the current walkthrough id to the (bounded) list of completed walkthroughs
+    """
+    state = get_state(request)
+    if state:
+        completed = request.session.get(COMPLETED_KEY, None) or []
+        completed.append(state.id)
+        request.session[COMPLETED_KEY] = completed[-app_settings.MAX_COMPLETED_WALKTHROUGHS:]
+        set_state(request, None)
+        forget_walkthrough(request, state.poll_id)
+    return state
+
+
+def choice_code(plan, question_id, answer_id):
+    """
+    returns the character of answer_id in the choices of the state cookie, '-' if it
+    can't be preselected client side, e.g. for questions taking multiple answers
+    """
+    if plan.allows_multiple(question_id):
+        return '-'
+    for position, (choice_id, text) in enumerate(plan.answer_choices(question_id)):
+        if choice_id == answer_id and position + 1 < len(CHOICE_CODES):
+            return CHOICE_CODES[position + 1]
+    return '-'
+
+
+def get_client_choices(request, state):
+    """
+    returns the choices of the state cookie as list, rebuilt from the database if the
+    cookie is missing or doesn't belong to state
+    """
+    from .models import Walkthrough
+
+    plan = state.plan
+    value = request.get_signed_cookie(app_settings.STATE_COOKIE, None, salt=STATE_COOKIE_SALT)
+    if value and value.count('.') == 2:
+        id, layout, choices = value.split('.')
+        if id == str(state.id) and layout == plan.layout and len(choices) == len(plan):
+            return list(choices)
+
+    choices = ['0'] * len(plan)
+    for answer_id in Walkthrough.answers.through.objects.using(shard_for(state.id)).filter(
+            walkthrough=state.id).values_list('answer_id', flat=True):
+        question_id = plan.answer_questions.get(answer_id)
+        if question_id is not None:
+            choices[plan.index(question_id)] = choice_code(plan, question_id, answer_id)
+    return choices
+
+
+def set_client_state(response, state, choices=None):
+    """
+    writes the state cookie for cacheable question pages, deletes it without state
+    """
+    if state is None:
+        response.delete_cookie(app_settings.STATE_COOKIE)
+    else:
+        response.set_signed_cookie(app_settings.STATE_COOKIE,
+                                   '%s.%s.%s' % (state.id, state.plan.layout, ''.join(choices)),
+                                   salt=STATE_COOKIE_SALT)
@@ -0,0 +1,214 @@
+"""
+Horizontal sharding of the walkthrough data.
+
+With PROFILINGPOLL_SHARDS set to a list of database aliases, walkthroughs, their
+answer and answered question rows and their WalkthroughProfile rows live on the
+shard walkthrough id % number of shards. The poll definitions (Poll, Question,
+Answer, Profile, AnswerProfile), the statistics counters and the archive stay on the
+default database. Add ShardRouter to DATABASE_ROUTERS to route them:
+
+    DATABASE_ROUTERS = ['profilingpoll.sharding.ShardRouter']
+    PROFILINGPOLL_SHARDS = ['default', 'walkthroughs1', 'walkthroughs2']
+
+Walkthrough ids are unique over all shards: Walkthrough.objects.create() takes them
+from an IdSequence row on the default database, in blocks of
+PROFILINGPOLL_SHARD_ID_BLOCK_SIZE per process. Queries joining walkthrough tables with
+definition tables don't work across databases, so the walkthrough side reads the
+through tables instead of e.g. walkthrough.answers, and code working on several
+walkthroughs runs once per shard. Deleting a poll only cascades to its walkthroughs on
+the default database.
+
+Walkthroughs are only found on their shard. After enabling sharding on an existing
+installation, or after changing the number of shards, run
+
+    manage.py move_walkthroughs_to_shards
+
+to move the existing walkthroughs there; until then the moved walkthroughs are
+missing for sessions, result links and the admin.
+
+Without PROFILINGPOLL_SHARDS everything stays on the default database.
+"""
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from . import app_settings
+
+
+def get_shards():
+    return list(app_settings.SHARDS or [DEFAULT_DB_ALIAS])
+
+
+def shard_for(walkthrough_id):
+    """
+    returns the database alias of the shard holding walkthrough_id
+    """
+    shards = get_shards()
+    return shards[int(walkthrough_id) % len(shards)]
+
+
+def db_for(walkthrough):
+    return walkthrough._state.db or shard_for(walkthrough.pk)
+
+
+def group_by_shard(walkthroughs):
+    """
+    returns {database alias: [walkthroughs]}
+    """
+    groups = {}
+    for walkthrough in walkthroughs:
+        groups.setdefault(db_for(walkthrough), []).append(walkthrough)
+    return groups
+
+
+def group_ids_by_shard(walkthrough_ids):
+    """
+    returns {database alias: [walkthrough ids]}
+    """
+    groups = {}
+    for walkthrough_id in walkthrough_ids:
+        groups.setdefault(shard_for(walkthrough_id), []).append(walkthrough_id)
+    return groups
+
+
+def _copy_rows(model, rows, using, with_ids=True):
+    """
+    inserts rows with their timestamps, and ids if with_ids, in batches
+    """
+    fields = [field for field in model._meta.local_fields if with_ids or not field.primary_key]
+    batch_size = max(connections[using].ops.bulk_batch_size(fields, rows), 1)
+    for start in range(0, len(rows), batch_size):
+        model._base_manager._insert(rows[start:start + batch_size], fields=fields, using=using, raw=True)
+
+
+def move_walkthroughs(sources=None, chunk_size=500, dry_run=False):
+    """
+    moves the walkthroughs on the databases sources (default and the shards) which
+    aren't on their shard there, with their answers, answered questions and profile
+    totals. Returns the number of moved walkthroughs, with dry_run only counts them.
+    """
+    from .models import Walkthrough, WalkthroughProfile
+
+    throughs = (Walkthrough.answers.through, Walkthrough._answered_questions.through, WalkthroughProfile)
+    moved = 0
+
+    for source in sources or sorted(set(get_shards() + [DEFAULT_DB_ALIAS])):
+        last_id = 0
+        while True:
+            ids = list(Walkthrough.objects.using(source).filter(id__gt=last_id).order_by('id').values_list(
+                'id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            for target, target_ids in group_ids_by_shard(ids).items():
+                if target == source:
+                    continue
+                moved += len(target_ids)
+                if dry_run:
+                    continue
+
+                # the target is committed first: walkthroughs copied by an interrupted run are
+                # only deleted from the source by the next one
+                with transaction.commit_on_success(using=source):
+                    copied = set(Walkthrough.objects.using(target).filter(pk__in=target_ids).values_list(
+                        'id', flat=True))
+                    missing = [id for id in target_ids if id not in copied]
+                    if missing:
+                        with transaction.commit_on_success(using=target):
+                            _copy_rows(Walkthrough, list(Walkthrough.objects.using(source).filter(pk__in=missing)),
+                                       target)
+                            for model in throughs:
+                                _copy_rows(model, list(model.objects.using(source).filter(walkthrough__in=missing)),
+                                           target, with_ids=False)
+                    for model in throughs:
+                        model.objects.using(source).filter(walkthrough__in=target_ids).delete()
+                    Walkthrough.objects.using(source).filter(pk__in=target_ids).delete()
+
+    return moved
+
+
+class IdAllocator(object):
+    """
+    hands out ids from blocks reserved on the IdSequence row with name
+    """
+    def __init__(self, name, block_size=None):
+        self.name = name
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+
+    def reserve(self):
+        # imported here, as DATABASE_ROUTERS imports this module while django.db is loading
+        from django.db.models import F, Max
+        from .models import IdSequence, Walkthrough
+
+        block_size = self.block_size or app_settings.SHARD_ID_BLOCK_SIZE
+        with transaction.commit_on_success(using=DEFAULT_DB_ALIAS):
+            sequences = IdSequence.objects.using(DEFAULT_DB_ALIAS).filter(name=self.name)
+            if not sequences.exists():
+                # continue after the walkthroughs created before sharding
+                start = max([Walkthrough.objects.using(alias).aggregate(id=Max('id'))['id'] or 0
+                             for alias in get_shards()]) + 1
+                IdSequence.objects.using(DEFAULT_DB_ALIAS).get_or_create(name=self.name, defaults={'next_id': start})
+            sequences.update(next_id=F('next_id') + block_size)
+            end = sequences.values_list('next_id', flat=True)[0]
+        return end - block_size, end
+
+    def allocate(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.next, self.end = self.reserve()
+            self.next += 1
+            return self.next - 1
+
+
+walkthrough_ids = IdAllocator('walkthrough')
+
+
+class ShardRouter(object):
+    """
+    routes the walkthrough side to the shard of the walkthrough and everything else of
+    the app to the default database
+    """
+    def walkthrough_models(self):
+        from .models import Walkthrough, WalkthroughProfile
+        return (Walkthrough, Walkthrough.answers.through, Walkthrough._answered_questions.through,
+                WalkthroughProfile)
+
+    def _db(self, model, instance=None):
+        from .models import Walkthrough
+
+        if model._meta.app_label != 'profilingpoll' or not app_settings.SHARDS:
+            return None
+        if model not in self.walkthrough_models():
+            return DEFAULT_DB_ALIAS
+        if instance is None:
+            return None
+
+        # the instance is the walkthrough itself, a row of it, or the walkthrough of a related manager
+        walkthrough_id = getattr(instance, 'walkthrough_id', None)
+        if walkthrough_id is not None:
+            return shard_for(walkthrough_id)
+        if isinstance(instance, Walkthrough) and instance.pk is not None:
+            return db_for(instance)
+        return instance._state.db
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # walkthroughs refer to the definitions on the default database
+        if obj1._meta.app_label == obj2._meta.app_label == 'profilingpoll' and app_settings.SHARDS:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label != 'profilingpoll' or not app_settings.SHARDS:
+            return None
+        if model in self.walkthrough_models():
+            return db in get_shards()
+        return db == DEFAULT_DB_ALIAS
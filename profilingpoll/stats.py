@@ -0,0 +1,176 @@
+"""
+Precomputed poll statistics: walkthroughs per answer, completed walkthroughs and
+completed walkthroughs per matching profile.
+
+The counters are PollStatsCounter rows, updated incrementally by the scoring path
+with F() increments on a random shard row, so concurrent walkthroughs rarely hit the
+same row. Reading sums up the shards of a poll with one query and caches the result
+for PROFILINGPOLL_STATS_CACHE_TIMEOUT seconds, so result pages look up shares in
+plain dicts. The rebuild_poll_stats command recomputes all counters from scratch.
+"""
+import random
+
+from django.core.cache import cache
+from django.db.models import Count, F, Sum
+
+from . import app_settings
+from .instrumentation import cache_hit
+from .plan import get_plan
+
+
+def _cache_key(poll_id):
+    return 'profilingpoll:stats:%s' % poll_id
+
+
+def increment(poll_id, kind, keys, delta=1):
+    """
+    adds delta to the counters of kind for all keys (answer or profile ids)
+    """
+    from .models import PollStatsCounter
+
+    keys = set(keys)
+    if not keys or not delta:
+        return
+
+    shard = random.randrange(app_settings.STATS_SHARDS)
+    counters = PollStatsCounter.objects.filter(poll=poll_id, kind=kind, shard=shard)
+
+    if counters.filter(key__in=keys).update(value=F('value') + delta) < len(keys):
+        for key in keys - set(counters.filter(key__in=keys).values_list('key', flat=True)):
+            counter, created = PollStatsCounter.objects.get_or_create(
+                poll_id=poll_id, kind=kind, key=key, shard=shard, defaults={'value': delta})
+            if not created:
+                counters.filter(key=key).update(value=F('value') + delta)
+
+
+def record(deltas):
+    """
+    applies {(poll id, kind, key): delta} to the counters, one update per poll, kind and delta
+    """
+    groups = {}
+    for (poll_id, kind, key), delta in deltas.items():
+        if delta:
+            groups.setdefault((poll_id, kind, delta), []).append(key)
+
+    for (poll_id, kind, delta), keys in groups.items():
+        increment(poll_id, kind, keys, delta)
+
+
+def answer_deltas(poll_id, added=(), removed=(), deltas=None):
+    from .models import PollStatsCounter
+
+    deltas = {} if deltas is None else deltas
+    for answer_id, delta in [(answer_id, 1) for answer_id in added] + [(answer_id, -1) for answer_id in removed]:
+        key = (poll_id, PollStatsCounter.KIND_ANSWER, answer_id)
+        deltas[key] = deltas.get(key, 0) + delta
+    return deltas
+
+
+def completion_deltas(poll_id, profile_id, delta, deltas=None):
+    """
+    counts a walkthrough, which was completed (delta 1) or isn't anymore (delta -1),
+    for its matching profile
+    """
+    from .models import PollStatsCounter
+
+    deltas = {} if deltas is None else deltas
+    for key in [(poll_id, PollStatsCounter.KIND_COMPLETED, 0), (poll_id, PollStatsCounter.KIND_PROFILE, profile_id or 0)]:
+        deltas[key] = deltas.get(key, 0) + delta
+    return deltas
+
+
+class PollStats(object):
+    def __init__(self, poll_id, answers, completed, profiles):
+        self.poll_id = poll_id
+        self.answers = answers      # answer id -> walkthroughs
+        self.completed = completed
+        self.profiles = profiles    # profile id -> completed walkthroughs
+
+    def answer_share(self, answer_id):
+        """
+        share of the walkthroughs answering the question of answer_id, which gave this answer
+        """
+        plan = get_plan(self.poll_id)
+        question_id = plan.answer_questions.get(answer_id)
+        total = sum(self.answers.get(choice_id, 0) for choice_id, text in plan.answer_choices(question_id))
+        return float(self.answers.get(answer_id, 0)) / total if total else 0.0
+
+    def profile_share(self, profile_id):
+        return float(self.profiles.get(profile_id, 0)) / self.completed if self.completed else 0.0
+
+    def profile_distribution(self):
+        """
+        returns [(profile id, completed walkthroughs, share)], most frequent profile first
+        """
+        return sorted([(profile_id, count, self.profile_share(profile_id))
+                       for profile_id, count in self.profiles.items() if count],
+                      key=lambda item: (-item[1], item[0]))
+
+
+def compute_stats(poll_id):
+    from .models import PollStatsCounter
+
+    answers = {}
+    profiles = {}
+    completed = 0
+    for kind, key, value in PollStatsCounter.objects.filter(poll=poll_id).values('kind', 'key').annotate(
+            total=Sum('value')).values_list('kind', 'key', 'total'):
+        if kind == PollStatsCounter.KIND_ANSWER:
+            answers[key] = value
+        elif kind == PollStatsCounter.KIND_PROFILE:
+            profiles[key] = value
+        elif kind == PollStatsCounter.KIND_COMPLETED:
+            completed = value
+    return PollStats(poll_id, answers, completed, profiles)
+
+
+def get_stats(poll_id):
+    stats = cache.get(_cache_key(poll_id))
+    cache_hit(stats is not None)
+    if stats is None:
+        stats = compute_stats(poll_id)
+        cache.set(_cache_key(poll_id), stats, app_settings.STATS_CACHE_TIMEOUT)
+    return stats
+
+
+def rebuild_stats(poll_id):
+    """
+    recomputes all counters of a poll from the walkthroughs and archived walkthroughs
+    """
+    from django.db import transaction
+    from .archive import archived_answer_counts
+    from .models import PollStatsCounter, Walkthrough
+    from .sharding import get_shards
+
+    default_profile_id = get_plan(poll_id).default_profile_id
+    counters = []
+
+    # archived walkthroughs still count for their answers
+    answers = archived_answer_counts(poll_id)
+    completed = 0
+    profiles = {}
+    for using in get_shards():
+        for answer_id, count in Walkthrough.answers.through.objects.using(using).filter(
+                walkthrough__poll=poll_id).values('answer').annotate(count=Count('walkthrough')).values_list(
+                'answer', 'count'):
+            answers[answer_id] = answers.get(answer_id, 0) + count
+
+        for profile_id, count in Walkthrough.objects.using(using).filter(
+                poll=poll_id, _completed__isnull=False).values('_matching_profile').annotate(
+                count=Count('id')).values_list('_matching_profile', 'count'):
+            profile_id = profile_id or default_profile_id or 0
+            profiles[profile_id] = profiles.get(profile_id, 0) + count
+            completed += count
+
+    counters.extend((PollStatsCounter.KIND_ANSWER, answer_id, count) for answer_id, count in answers.items())
+
+    counters.append((PollStatsCounter.KIND_COMPLETED, 0, completed))
+    counters.extend((PollStatsCounter.KIND_PROFILE, profile_id, count) for profile_id, count in profiles.items())
+
+    with transaction.commit_on_success():
+        PollStatsCounter.objects.filter(poll=poll_id).delete()
+        PollStatsCounter.objects.bulk_create([
+            PollStatsCounter(poll_id=poll_id, kind=kind, key=key, shard=0, value=value)
+            for kind, key, value in counters
+        ])
+    cache.delete(_cache_key(poll_id))
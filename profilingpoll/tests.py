@@ -1,7 +1,44 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
 
-from .models import Poll, Question, Answer, Profile, AnswerProfile, Walkthrough
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.admin.util import lookup_field
+from django.db import connection, router
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.utils.unittest import skipIf
+
+from .models import Poll, Question, Answer, Profile, AnswerProfile, Walkthrough, ArchivedWalkthrough
+from . import app_settings, benchmark, instrumentation, scoring, sharding, throttling
+from .admin import ProfileAdmin, WalkthroughAdmin
+from .archive import archive_walkthroughs
+from .buffer import AnswerBuffer
+from .columnar import ColumnarExport, read_table
+from .definitions import clone_poll, export_poll, import_poll
+from .exports import export_walkthroughs, iter_csv, iter_walkthrough_chunks
 from .forms import AnswerForm
+from .plan import get_plan, get_question
+from .polls import get_registry
+from .rescoring import rescore_poll
+from .session import STATE_COOKIE_SALT
+from .sharding import ShardRouter
+from .stats import get_stats, rebuild_stats
+
+
+def override_app_settings(testcase, **values):
+    """
+    sets app_settings for the rest of the test, restored even if it fails
+    """
+    for name, value in values.items():
+        testcase.addCleanup(setattr, app_settings, name, getattr(app_settings, name))
+        setattr(app_settings, name, value)
 
 
 class CreationTest(TestCase):
@@ -97,6 +134,194 @@ class WalkthroughTest(TestCase):
         walkthrough.answers.remove(self.answer1_2)
         self.assertFalse(self.question1 in walkthrough._answered_questions.all())
 
+    def test_replaced_answer_is_unscored(self):
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1)
+        walkthrough.answers.add(self.answer1_2)
+        self.assertEqual(walkthrough.walkthroughprofiles.get(profile=self.profile1).quantifier, 0)
+        self.assertEqual(walkthrough.walkthroughprofiles.get(profile=self.profile2).quantifier, 20)
+        self.assertEqual(walkthrough.get_matching_profile(), self.profile2)
+
+    def test_constant_queries(self):
+        override_app_settings(self, STATS_SHARDS=1)
+
+        # the same number of queries, no matter how many profiles an answer scores
+        for i, profile in enumerate([Profile.objects.create(text=str(i)) for i in range(5)]):
+            self.answer2_1.answerprofiles.create(profile=profile, quantifier=i + 1)
+            self.answer1_1.answerprofiles.create(profile=profile, quantifier=1)
+
+        # the first walkthrough creates the statistics counters
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1, self.answer2_1)
+
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1)
+        with self.assertNumQueries(14):
+            walkthrough.answers.add(self.answer2_1)
+
+        self.assertEqual(walkthrough.walkthroughprofiles.count(), 6)
+        self.assertTrue(walkthrough.completed)
+
+    def test_answered_bitmap(self):
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1)
+        get_plan(self.poll1.pk)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.question1.question_answered(walkthrough))
+            self.assertFalse(self.question2.question_answered(walkthrough))
+            self.assertEqual(walkthrough.get_next_question_id(), self.question2.pk)
+
+        # the bitmap is stored on the row
+        walkthrough = Walkthrough.objects.get(pk=walkthrough.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(walkthrough.get_next_question_id(), self.question2.pk)
+
+        # a new question changes the layout, the bitmap is rebuilt once
+        question3 = self.poll1.questions.create(text='Do you like polls')
+        self.assertEqual(walkthrough.get_next_question_id(), self.question2.pk)
+        get_plan(self.poll1.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(walkthrough.is_answered(self.question1.pk))
+
+        walkthrough.answers.add(self.answer2_1)
+        self.assertEqual(walkthrough.get_next_question(), question3)
+        self.assertFalse(walkthrough.completed)
+
+    def test_rescore(self):
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1, self.answer2_1)
+        self.assertEqual(walkthrough.get_matching_profile(), self.profile1)
+
+        answerprofile = self.answer2_1.answerprofiles.get()
+        answerprofile.profile = self.profile2
+        answerprofile.quantifier = 30
+        answerprofile.save()
+
+        result = rescore_poll(self.poll1.pk, dry_run=True)
+        self.assertEqual(result['changed'], 1)
+        self.assertEqual(result['before'], {self.profile1.pk: 1})
+        self.assertEqual(result['after'], {self.profile2.pk: 1})
+        self.assertEqual(Walkthrough.objects.get(pk=walkthrough.pk).get_matching_profile(), self.profile1)
+
+        rescore_poll(self.poll1.pk, chunk_size=1)
+        walkthrough = Walkthrough.objects.get(pk=walkthrough.pk)
+        self.assertEqual(walkthrough.get_matching_profile(), self.profile2)
+        self.assertEqual(dict(walkthrough.walkthroughprofiles.values_list('profile', 'quantifier')),
+                         {self.profile1.pk: 10, self.profile2.pk: 30})
+        self.assertEqual(rescore_poll(self.poll1.pk)['changed'], 0)
+
+    def test_rescore_after_live_scoring(self):
+        walkthrough = self.poll1.walkthroughs.create()
+        walkthrough.answers.add(self.answer1_1, self.answer2_1)
+
+        # live scoring keeps the row of a profile, which isn't scored anymore
+        AnswerProfile.objects.filter(answer__in=[self.answer1_1, self.answer2_1]).delete()
+        scoring.update_walkthroughs([Walkthrough.objects.get(pk=walkthrough.pk)])
+        self.assertEqual(dict(walkthrough.walkthroughprofiles.values_list('profile', 'quantifier')),
+                         {self.profile1.pk: 0})
+
+        result = rescore_poll(self.poll1.pk)
+        self.assertEqual(result['changed'], 0)
+        self.assertEqual(result['before'], result['after'])
+
+    def test_stats(self):
+        for answer in (self.answer1_1, self.answer1_2, self.answer1_2):
+            walkthrough = self.poll1.walkthroughs.create()
+            walkthrough.answers.add(answer, self.answer2_2)
+
+        walkthrough.answers.remove(self.answer2_2)
+        cache.clear()
+        stats = get_stats(self.poll1.id)
+        self.assertEqual(stats.completed, 2)
+        self.assertEqual(stats.profile_distribution(), [(self.profile2.id, 2, 1.0)])
+        self.assertEqual(stats.answer_share(self.answer1_2.id), 2.0 / 3)
+        self.assertEqual(stats.answer_share(self.answer2_2.id), 1.0)
+
+        rebuild_stats(self.poll1.id)
+        self.assertEqual(get_stats(self.poll1.id).__dict__, stats.__dict__)
+
+    def test_archive(self):
+        stale = self.poll1.walkthroughs.create()
+        stale.answers.add(self.answer1_2)
+        completed = self.poll1.walkthroughs.create()
+        completed.answers.add(self.answer1_1, self.answer2_1)
+        fresh = self.poll1.walkthroughs.create()
+        Walkthrough.objects.filter(pk__in=[stale.pk, completed.pk]).update(modified=datetime(2000, 1, 1))
+        cache.clear()
+        stats = get_stats(self.poll1.id)
+
+        self.assertEqual(archive_walkthroughs(days=30, dry_run=True), 1)
+        self.assertEqual(archive_walkthroughs(days=30, chunk_size=1), 1)
+        self.assertEqual(list(Walkthrough.objects.order_by('id').values_list('id', flat=True)),
+                         [completed.pk, fresh.pk])
+        archived = ArchivedWalkthrough.objects.get()
+        self.assertEqual((archived.walkthrough_id, archived.answer_ids), (stale.pk, [self.answer1_2.pk]))
+
+        rebuild_stats(self.poll1.id)
+        self.assertEqual(get_stats(self.poll1.id).__dict__, stats.__dict__)
+
+
+class PlanTest(TestCase):
+    fixtures = ['test.json',]
+
+    def test_navigation(self):
+        plan = get_plan(1)
+        self.assertEqual(plan.question_ids, (1, 3))
+        self.assertEqual(Question.objects.get(id=3).get_index(), 1)
+        self.assertEqual(Question.objects.get(id=1).next(), Question.objects.get(id=3))
+        self.assertEqual(Question.objects.get(id=3).next(), None)
+        self.assertEqual(plan.question_url(3), '/bester-kurs/3/')
+
+    def test_cached(self):
+        get_plan(1)
+        with self.assertNumQueries(0):
+            plan = get_plan(1)
+            plan.answer_choices(1)
+            plan.profile_totals([1, 10])
+
+    def test_invalidation(self):
+        plan = get_plan(1)
+        question = Question.objects.get(id=1)
+        answer = question.answers.create(text='new')
+        self.assertNotEqual(get_plan(1).version, plan.version)
+        self.assertIn((answer.id, 'new'), get_plan(1).answer_choices(1))
+
+        question.ordering = 5
+        question.save()
+        self.assertEqual(get_plan(1).question_ids, (3, 1))
+
+        answer.delete()
+        self.assertNotIn(answer.id, get_plan(1).answer_questions)
+
+    def test_registry(self):
+        registry = get_registry()
+        self.assertEqual([poll.slug for poll in registry], ['bester-kurs'])
+        self.assertEqual(registry.get('bester-kurs').first_question_url, '/bester-kurs/1/')
+        with self.assertNumQueries(0):
+            self.assertIs(get_registry(), registry)
+
+        Poll.objects.create(title='Second', slug='second', active=True)
+        self.assertEqual(len(get_registry()), 2)
+
+        question = Question.objects.get(id=1)
+        question.ordering = 5
+        question.save()
+        self.assertEqual(get_registry().get('bester-kurs').first_question_url, '/bester-kurs/3/')
+
+    def test_question_cache(self):
+        question = get_question(1, 'bester-kurs')
+        with self.assertNumQueries(0):
+            self.assertIs(get_question(1, 'bester-kurs'), question)
+        self.assertRaises(Question.DoesNotExist, get_question, 1, 'other-poll')
+
+        Question.objects.filter(id=1).update(text='changed')
+        Question.objects.get(id=3).save()
+        self.assertEqual(get_question(1).text, 'changed')
+
+        Question.objects.get(id=1).delete()
+        self.assertRaises(Question.DoesNotExist, get_question, 1)
+
 
 class FormTest(TestCase):
     fixtures = ['test.json',]
@@ -124,6 +349,11 @@ class RequestWalkthroughTest(TestCase):
         # only show the first question should not create a walkthrough
         self.assertEqual(response.context['walkthrough'], None)
 
+        # the entry views answer from the registry of active polls
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/')['Location'], 'http://testserver/bester-kurs/')
+            self.assertEqual(self.client.get('/bester-kurs/')['Location'], 'http://testserver/bester-kurs/1/')
+
     def test_answer_the_questions(self):
         # send the form empty; should display errors and also not create a walkthrough
         response = self.client.post('/bester-kurs/1/', {})
@@ -134,21 +364,33 @@ class RequestWalkthroughTest(TestCase):
         # really answer the question
         response = self.client.post('/bester-kurs/1/', {'answer' : 1})
         self.assertEqual(response.status_code, 302)
-        self.assertIsInstance(self.client.session['current_walkthrough'], Walkthrough)
+        self.assertTrue(Walkthrough.objects.filter(id=self.client.session['current_walkthrough']['id']).exists())
 
     def test_answer_a_question_2times(self):
         self.client.post('/bester-kurs/1/', {'answer' : 1})
         self.client.post('/bester-kurs/1/', {'answer' : 2})
-        self.assertIsInstance(self.client.session['current_walkthrough'], Walkthrough)
 
         # be sure, only the last answer is in the walkthrough
-        walkthrough = self.client.session['current_walkthrough']
+        walkthrough = Walkthrough.objects.get(id=self.client.session['current_walkthrough']['id'])
         self.assertEqual(walkthrough.answers.all().count(), 1)
 
         # as long as the walkthrough is active, it should prefill the question form
         response = self.client.get('/bester-kurs/1/')
         self.assertEqual(response.context['form'].initial, {'answer' : 2})
 
+    def test_archived_walkthrough(self):
+        self.client.post('/bester-kurs/1/', {'answer' : 1})
+        walkthrough_id = self.client.session['current_walkthrough']['id']
+        Walkthrough.objects.filter(id=walkthrough_id).update(modified=datetime(2000, 1, 1))
+        archive_walkthroughs(days=30)
+        self.assertFalse(Walkthrough.objects.filter(id=walkthrough_id).exists())
+
+        # the next answer starts over with a new walkthrough
+        response = self.client.post('/bester-kurs/3/', {'answer' : 10}, follow=True)
+        self.assertEqual(response.request['PATH_INFO'], '/bester-kurs/1/')
+        walkthrough = Walkthrough.objects.get(id=self.client.session['current_walkthrough']['id'])
+        self.assertEqual(list(walkthrough.answers.values_list('id', flat=True)), [10])
+
     def test_walkthrough_and_restart(self):
         """
         a full walkthrough will show the results page with the matching profile
@@ -156,18 +398,64 @@ class RequestWalkthroughTest(TestCase):
         """
         self.client.post('/bester-kurs/1/', {'answer' : 1})
         response = self.client.post('/bester-kurs/3/', {'answer' : 10}, follow=True)
+        self.assertEqual(response.request['PATH_INFO'], '/bester-kurs/finished/')
+        response = self.client.post('/bester-kurs/finished/', {'email': 'test@example.com'}, follow=True)
 
         # The current walkthrough is sent as context and completed
         self.assertTrue(response.context['object'])
         self.assertTrue(response.context['object'].completed)
 
+        self.assertEqual(response.context['object'].email, 'test@example.com')
+
         # But removed from the session.
         self.assertEqual(self.client.session['current_walkthrough'], None)
+        self.assertEqual(self.client.session['completed_walkthroughs'], [response.context['object'].id])
 
         # A restart is empty
         response = self.client.get('/bester-kurs/1/')
         self.assertEqual(response.context['form'].initial, {})
 
+    def test_result_snapshot(self):
+        cache.clear()
+        AnswerProfile.objects.create(answer_id=1, profile_id=1, quantifier=3)
+        self.client.post('/bester-kurs/1/', {'answer' : 1})
+        self.client.post('/bester-kurs/3/', {'answer' : 10})
+        response = self.client.post('/bester-kurs/finished/', {'email': 'test@example.com'})
+        url = response['Location']
+        response = self.client.get(url)
+        self.assertNotIn('public', response.get('Cache-Control', ''))
+        profile = response.context['profile']
+
+        # shared links are served from the snapshot
+        Profile.objects.filter(pk=profile.pk).update(text='changed')
+        client = Client()
+        with self.assertNumQueries(0):
+            response = client.get(url)
+        self.assertEqual(response.context['profile'].text, profile.text)
+        self.assertIn('public', response['Cache-Control'])
+
+        cache.clear()
+        self.assertEqual(client.get(url).context['profile'].text, profile.text)
+        self.assertEqual(client.get('/result/invalid/').status_code, 404)
+
+    def test_multiple_answers(self):
+        Question.objects.filter(id=1).update(multiple_answers=True)
+        Question.objects.get(id=3).save()
+        self.assertRaises(ValueError, get_plan(1).group_answers, [10, 10, 11])
+        self.assertEqual(get_plan(1).group_answers([2, 1, 10]), {1: [1, 2], 3: [10]})
+
+        response = self.client.get('/bester-kurs/1/')
+        self.assertContains(response, 'type="checkbox"')
+        self.client.post('/bester-kurs/1/', {'answer' : [1, 2]})
+        walkthrough = Walkthrough.objects.get(id=self.client.session['current_walkthrough']['id'])
+        self.assertEqual(sorted(walkthrough.answers.values_list('id', flat=True)), [1, 2])
+        self.assertEqual(walkthrough.progress, 0.5)
+
+        self.client.post('/bester-kurs/1/', {'answer' : [2]})
+        self.assertEqual(list(walkthrough.answers.values_list('id', flat=True)), [2])
+        response = self.client.get('/bester-kurs/1/')
+        self.assertEqual(response.context['form'].initial, {'answer' : [2]})
+
     def test_enforce_workflow(self):
         """
         A poll has to start with the first question in it. If a question is opened, with unanswered
@@ -178,9 +466,606 @@ class RequestWalkthroughTest(TestCase):
         self.assertEqual(response.request['PATH_INFO'], '/bester-kurs/1/')
 
         # directly open finish also
+        self.client.post('/bester-kurs/1/', {'answer' : 1})
+        response = self.client.get('/bester-kurs/finished/', follow=True)
+        self.assertEqual(response.request['PATH_INFO'], '/bester-kurs/3/')
+
+    def test_compact_session(self):
+        self.client.post('/bester-kurs/1/', {'answer' : 1})
+        state = self.client.session['current_walkthrough']
+        self.assertEqual(state['answered'], 1)
+        self.assertEqual(state['index'], 1)
+        json.dumps(dict(self.client.session.items()))
+
+
+class CacheableQuestionTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def setUp(self):
+        override_app_settings(self, CACHEABLE_QUESTIONS=True)
+
+    def test_cacheable_question(self):
+        response = self.client.get('/bester-kurs/3/')
+
+        # no redirect to the first question and no session: the same page for everyone
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertFalse(response.has_header('Vary'))
+        self.assertNotIn('name="csrfmiddlewaretoken"', response.content)
+        self.assertNotIn('csrftoken', response.cookies)
+
+        response = self.client.get('/bester-kurs/3/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # a changed question is a new version
+        Question.objects.get(pk=3).save()
+        response = self.client.get('/bester-kurs/3/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_answer(self):
+        response = self.client.post('/bester-kurs/1/answer/', {'answer': 2})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/bester-kurs/3/'))
+
+        state = self.client.session['current_walkthrough']
+        cookie = signing.get_cookie_signer(salt=app_settings.STATE_COOKIE + STATE_COOKIE_SALT).unsign(
+            self.client.cookies[app_settings.STATE_COOKIE].value)
+        self.assertEqual(cookie, '%s.%s.20' % (state['id'], state['layout']))
+
+        self.client.post('/bester-kurs/3/answer/', {'answer': 10})
+        response = self.client.post('/bester-kurs/finished/', {}, follow=True)
+        self.assertTrue(response.context['object'].completed)
+        self.assertEqual(self.client.cookies[app_settings.STATE_COOKIE].value, '')
+
+    def test_answer_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.get('/bester-kurs/1/')
+        self.assertIn("'csrftoken=' + token", response.content)
+
+        # the token the page's script copies from the csrf cookie
+        self.assertEqual(client.post('/bester-kurs/1/answer/', {'answer': 2}).status_code, 403)
+        client.cookies['csrftoken'] = 'a' * 32
+        response = client.post('/bester-kurs/1/answer/', {'answer': 2, 'csrfmiddlewaretoken': 'a' * 32})
+        self.assertEqual(response.status_code, 302)
+
+        # invalid answers are rendered per client, with the csrf token in the form
+        response = client.post('/bester-kurs/3/answer/', {'csrfmiddlewaretoken': 'a' * 32})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('data-layout', response.content)
+        self.assertIn('name="csrfmiddlewaretoken" value="%s"' % ('a' * 32), response.content)
+
+    def test_answer_url_needs_cacheable_questions(self):
+        override_app_settings(self, CACHEABLE_QUESTIONS=False)
+        response = self.client.post('/bester-kurs/1/answer/', {'answer': 1})
+        self.assertEqual(response.status_code, 404)
+
+
+class SubmitWalkthroughTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def submit(self, data):
+        return self.client.post('/bester-kurs/submit.json', json.dumps(data), content_type='application/json')
+
+    def test_submit(self):
+        AnswerProfile.objects.create(answer_id=2, profile_id=1, quantifier=3)
+        override_app_settings(self, STATS_SHARDS=1)
+        # the first submission creates the statistics counters
+        self.submit({'answers': [2, 10]})
+        get_plan(1)
+
+        # the same for every poll size, see scoring.set_answers
+        with self.assertNumQueries(15):
+            response = self.submit({'answers': [2, 10], 'email': 'test@example.com'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        walkthrough = Walkthrough.objects.get(pk=data['walkthrough'])
+        self.assertTrue(walkthrough.completed)
+        self.assertEqual(walkthrough.email, 'test@example.com')
+        self.assertEqual(sorted(walkthrough.answers.values_list('id', flat=True)), [2, 10])
+        self.assertEqual(data['profile']['id'], 1)
+        self.assertEqual(walkthrough.get_matching_profile().pk, 1)
+        self.assertTrue(data['result_url'].endswith(walkthrough.get_absolute_url()))
+
+    def test_invalid(self):
+        count = Walkthrough.objects.count()
+        for data in ({'answers': [1]}, {'answers': [1, 2, 10]}, {'answers': [1, 10, 999]}, {'answer': 1}):
+            self.assertEqual(self.submit(data).status_code, 400)
+        self.assertEqual(Walkthrough.objects.count(), count)
+
+
+class SubmitTransactionTest(TransactionTestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def test_failed_submit_leaves_no_walkthrough(self):
+        update_walkthroughs = scoring._update_walkthroughs
+
+        def failing_update_walkthroughs(*args, **kwargs):
+            update_walkthroughs(*args, **kwargs)
+            raise ValueError('scoring failed')
+        scoring._update_walkthroughs = failing_update_walkthroughs
+        self.addCleanup(setattr, scoring, '_update_walkthroughs', update_walkthroughs)
+
+        counts = Walkthrough.objects.count(), Walkthrough.answers.through.objects.count()
+        with self.assertRaises(ValueError):
+            self.client.post('/bester-kurs/submit.json', json.dumps({'answers': [2, 10]}),
+                             content_type='application/json')
+        self.assertEqual((Walkthrough.objects.count(), Walkthrough.answers.through.objects.count()), counts)
+
+
+class ThrottlingTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def setUp(self):
+        cache.clear()
+        throttling._backends.clear()
+        self.settings = (app_settings.THROTTLE_RATE, app_settings.THROTTLE_BURST, app_settings.THROTTLE_BACKEND,
+                         app_settings.DUPLICATE_WALKTHROUGH_WINDOW)
+
+    def tearDown(self):
+        (app_settings.THROTTLE_RATE, app_settings.THROTTLE_BURST, app_settings.THROTTLE_BACKEND,
+         app_settings.DUPLICATE_WALKTHROUGH_WINDOW) = self.settings
+
+    def test_throttle(self):
+        app_settings.THROTTLE_RATE, app_settings.THROTTLE_BURST = 1, 2
+        for backend in ('local', 'cache'):
+            app_settings.THROTTLE_BACKEND = backend
+            client = Client(REMOTE_ADDR='10.0.0.1', HTTP_USER_AGENT=backend)
+            for i in range(2):
+                self.assertEqual(client.post('/bester-kurs/1/', {'answer': 1}).status_code, 302)
+            with self.assertNumQueries(0):
+                response = client.post('/bester-kurs/1/', {'answer': 1})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '60')
+
+            # other clients have their own buckets
+            other = Client(REMOTE_ADDR='10.0.0.2', HTTP_USER_AGENT=backend)
+            self.assertEqual(other.post('/bester-kurs/1/', {'answer': 1}).status_code, 302)
+
+        response = client.post('/bester-kurs/submit.json', json.dumps({'answers': [2, 10]}),
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+
+    def test_duplicate_walkthroughs(self):
+        app_settings.DUPLICATE_WALKTHROUGH_WINDOW = 60
+        count = Walkthrough.objects.count()
+        for i in range(3):
+            # a fresh session every time
+            Client(REMOTE_ADDR='10.0.0.1').post('/bester-kurs/1/', {'answer': i + 1})
+        Client(REMOTE_ADDR='10.0.0.2').post('/bester-kurs/1/', {'answer': 1})
+
+        self.assertEqual(Walkthrough.objects.count(), count + 2)
+        walkthrough = Walkthrough.objects.order_by('id').filter(ip='10.0.0.1')[0]
+        self.assertEqual(list(walkthrough.answers.values_list('id', flat=True)), [3])
+
+        # the continued walkthrough keeps its answered questions
+        client = Client(REMOTE_ADDR='10.0.0.1')
+        client.post('/bester-kurs/3/', {'answer': 10})
+        self.assertEqual(client.session['current_walkthrough']['id'], walkthrough.pk)
+        self.assertEqual(client.session['current_walkthrough']['answered'], 0b11)
+
+        # completed walkthroughs are never continued
+        client.post('/bester-kurs/finished/', {})
+        Client(REMOTE_ADDR='10.0.0.1').post('/bester-kurs/1/', {'answer': 1})
+        self.assertEqual(Walkthrough.objects.count(), count + 3)
+
+        walkthrough = Walkthrough.objects.order_by('-id').filter(ip='10.0.0.1')[0]
+        Walkthrough.objects.filter(pk=walkthrough.pk).update(_completed=datetime.now())
+        Client(REMOTE_ADDR='10.0.0.1').post('/bester-kurs/1/', {'answer': 1})
+        self.assertEqual(Walkthrough.objects.count(), count + 4)
+        self.assertEqual(list(walkthrough.answers.values_list('id', flat=True)), [1])
+
+
+class InstrumentationTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def setUp(self):
+        override_app_settings(self, INSTRUMENTATION=True)
+        instrumentation.reset()
+
+    def tearDown(self):
+        instrumentation.reset()
+
+    def test_spans(self):
+        response = self.client.get('/bester-kurs/1/')
+        self.assertTrue(response['Server-Timing'].startswith('view.question;dur='))
+        self.assertIn('queries"', response['Server-Timing'])
+
+        response = self.client.post('/bester-kurs/1/', {'answer' : 1})
+        self.assertIn('scoring.set_answers;dur=', response['Server-Timing'])
+
+        summaries = dict((summary['name'], summary) for summary in instrumentation.top())
+        self.assertEqual(summaries['view.question']['count'], 2)
+        self.assertEqual(summaries['scoring.update_walkthroughs']['count'], 1)
+        self.assertTrue(summaries['scoring.update_walkthroughs']['queries'] > 0)
+        self.assertTrue(summaries['scoring.set_answers']['queries'] >= summaries['scoring.update_walkthroughs']['queries'])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/instrumentation/slow/?order=p99')
+        self.assertContains(response, 'scoring.update_walkthroughs')
+
+    def test_query_log_outside_requests(self):
+        walkthrough = Walkthrough.objects.create(poll_id=1)
+        queries = len(connection.queries)
+        for answer_id in (1, 2, 1):
+            scoring.set_answers({walkthrough: {1: [answer_id]}})
+
+        # counted, but not left in the query log, which no request would empty
+        self.assertEqual(len(connection.queries), queries)
+        summaries = dict((summary['name'], summary) for summary in instrumentation.top())
+        self.assertTrue(summaries['scoring.set_answers']['queries'] > 0)
+
+    def test_disabled(self):
+        override_app_settings(self, INSTRUMENTATION=False)
+        response = self.client.get('/bester-kurs/1/')
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(instrumentation.top(), [])
+
+    def test_histogram(self):
+        histogram = instrumentation.Histogram('test')
+        for duration in (0.5, 3, 3, 4, 700):
+            span = instrumentation.Span('test')
+            span.duration = duration
+            histogram.add(span)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(99), 1000)
+        self.assertEqual(histogram.summary()['max'], 700)
+
+
+class AnswerBufferTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = app_settings.ANSWER_BUFFER, app_settings.ANSWER_BUFFER_FLUSH_INTERVAL
+        app_settings.ANSWER_BUFFER = os.path.join(self.directory, 'answers.log')
+        app_settings.ANSWER_BUFFER_FLUSH_INTERVAL = None
+
+    def tearDown(self):
+        app_settings.ANSWER_BUFFER, app_settings.ANSWER_BUFFER_FLUSH_INTERVAL = self.settings
+        shutil.rmtree(self.directory)
+
+    def test_buffered_walkthrough(self):
+        other = Client()
+        other.post('/bester-kurs/1/', {'answer' : 3})
+        self.client.post('/bester-kurs/1/', {'answer' : 1})
+        self.client.post('/bester-kurs/1/', {'answer' : 2})
+        response = self.client.post('/bester-kurs/3/', {'answer' : 10}, follow=True)
+
+        # progress comes from the session, the database is not yet written
+        self.assertEqual(response.request['PATH_INFO'], '/bester-kurs/finished/')
+        walkthrough = Walkthrough.objects.get(id=self.client.session['current_walkthrough']['id'])
+        self.assertEqual(walkthrough.answers.count(), 0)
+
+        # revisiting a question shows the buffered answer
+        self.assertEqual(self.client.get('/bester-kurs/1/').context['form'].initial['answer'], 2)
+
+        response = self.client.post('/bester-kurs/finished/', {}, follow=True)
+        walkthrough = response.context['object']
+        self.assertTrue(walkthrough.completed)
+        self.assertEqual(sorted(walkthrough.answers.values_list('id', flat=True)), [2, 10])
+
+        # only the answers of the finishing walkthrough are applied
+        other_walkthrough = Walkthrough.objects.get(id=other.session['current_walkthrough']['id'])
+        self.assertEqual(other_walkthrough.answers.count(), 0)
+        self.assertEqual(AnswerBuffer(app_settings.ANSWER_BUFFER).flush(), 2)
+        self.assertEqual(list(other_walkthrough.answers.values_list('id', flat=True)), [3])
+
+    def test_replay(self):
+        walkthrough = Walkthrough.objects.create(poll_id=1)
+        answer_buffer = AnswerBuffer(app_settings.ANSWER_BUFFER)
+        answer_buffer.append(1, walkthrough.id, 1, [1])
+        answer_buffer.drain()
+        answer_buffer.append(1, walkthrough.id, 1, [2])
+
+        # flushes of other threads or processes wait for the running one
+        with answer_buffer.locked():
+            self.assertEqual(answer_buffer.flush(blocking=False), 0)
+        self.assertEqual(answer_buffer.flush(), 1)
+        self.assertEqual(list(walkthrough.answers.values_list('id', flat=True)), [2])
+        self.assertEqual(answer_buffer.flush(), 0)
+
+
+def without_ids(definition):
+    for question in definition['questions']:
+        del question['id']
+        for answer in question['answers']:
+            del answer['id']
+    return definition
+
+
+class DefinitionTest(TestCase):
+    def test_clone(self):
+        for questions in (2, 10):
+            poll = benchmark.create_poll(questions=questions, answers=3, profiles=4)
+            Profile.objects.update(description=None)
+            with self.assertNumQueries(17):
+                clone = clone_poll(poll, '%s-b' % poll.slug)
+
+            definition, cloned = without_ids(export_poll(poll)), without_ids(export_poll(clone))
+            self.assertEqual((cloned.pop('slug'), cloned.pop('active')), (clone.slug, False))
+            del definition['slug'], definition['active']
+            self.assertEqual(cloned, definition)
+            self.assertEqual(get_plan(clone.pk).profile_totals(get_plan(clone.pk).answer_questions),
+                             get_plan(poll.pk).profile_totals(get_plan(poll.pk).answer_questions))
+
+    def test_reimport(self):
+        poll = benchmark.create_poll(questions=3, answers=2, profiles=2)
+        definition = without_ids(export_poll(poll))
+        self.assertEqual(import_poll(definition)[1], {})
+
+        answer = definition['questions'][0]['answers'][0]
+        answer['text'] = 'changed'
+        answer['profiles'] = {}
+        definition['questions'].pop()
+        definition['questions'].append({'text': 'new', 'multiple_answers': True, 'answers': [{'text': 'yes', 'profiles': {'new profile': 5}}]})
+        definition['profiles']['new profile'] = {'text': 'New'}
+        question_ids = get_plan(poll.pk).question_ids
+
+        poll, changes = import_poll(definition)
+        # questions and answers are matched by position
+        self.assertEqual(changes['questions'], {'created': 0, 'updated': 1, 'deleted': 0})
+        self.assertEqual(get_plan(poll.pk).multiple, frozenset(get_plan(poll.pk).question_ids[-1:]))
+        self.assertEqual(changes['answers'], {'created': 0, 'updated': 2, 'deleted': 1})
+        self.assertEqual(changes['profiles']['created'], 1)
+        self.assertEqual(get_plan(poll.pk).question_ids, question_ids)
+        self.assertEqual(without_ids(export_poll(poll))['questions'], definition['questions'])
+        self.assertEqual(import_poll(definition)[1], {})
+
+    def test_insert(self):
+        poll = benchmark.create_poll(questions=3, answers=2, profiles=2)
+        definition = export_poll(poll)
+        self.assertEqual(import_poll(definition)[1], {})
+        answer_ids = list(Answer.objects.filter(question__poll=poll).values_list('id', flat=True))
+
+        definition['questions'].insert(0, {'text': 'new', 'answers': [{'text': 'yes'}, {'text': 'no'}]})
+        definition['questions'][1]['answers'].insert(0, {'text': 'new', 'profiles': {}})
+        poll, changes = import_poll(definition)
+        # the following rows keep their ids and only move down
+        self.assertEqual(changes['questions'], {'created': 1, 'updated': 3, 'deleted': 0})
+        self.assertEqual(changes['answers'], {'created': 3, 'updated': 2, 'deleted': 0})
+        self.assertNotIn('answerprofiles', changes)
+        exported = export_poll(poll)
+        self.assertEqual([answer['text'] for answer in exported['questions'][0]['answers']], ['yes', 'no'])
+        self.assertEqual([answer['id'] for question in exported['questions'][1:] for answer in question['answers']
+                          if answer['text'] != 'new'], answer_ids)
+        self.assertEqual(import_poll(exported)[1], {})
+
+
+class ExportTest(TestCase):
+    fixtures = ['test.json',]
+
+    def setUp(self):
+        for i in range(5):
+            walkthrough = Walkthrough.objects.create(poll_id=1, email='%s@example.com' % i)
+            walkthrough.answers.add(1 + i % 2)
+        Walkthrough.objects.create(poll_id=1)
+
+    def test_export_walkthroughs(self):
+        # one query per chunk, the empty last chunk and the poll once
+        with self.assertNumQueries(1 + 1 + 1):
+            rows = list(export_walkthroughs())
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0][0], Poll.objects.get(id=1))
+        self.assertEqual([row[7] for row in rows], [Walkthrough.objects.get(email=row[1]).get_matching_profile()
+                                                    for row in rows])
+
+    def test_csv(self):
+        lines = list(iter_csv(poll=Poll.objects.get(id=1), chunk_size=2))
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith('id,poll,email'))
+
+
+class ColumnarExportTest(TestCase):
+    fixtures = ['test.json',]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.poll = Poll.objects.get(id=1)
+        self.poll.walkthroughs.all().delete()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_incremental_export(self):
+        walkthrough = self.poll.walkthroughs.create()
+        walkthrough.answers.add(1)
+        self.assertEqual(ColumnarExport(self.poll, self.directory).export(), 1)
+
+        answers = read_table(self.directory, 'answers')
+        self.assertEqual(list(answers['walkthrough']), [walkthrough.id])
+        self.assertEqual(list(answers['batch']), [0])
+
+        # nothing changed, nothing appended
+        self.assertEqual(ColumnarExport(self.poll, self.directory).export(), 0)
+
+        walkthrough.answers.add(10)
+        export = ColumnarExport(self.poll, self.directory)
+        self.assertEqual(export.export(), 1)
+        answers = read_table(self.directory, 'answers')
+        self.assertEqual(list(answers['batch']), [0, 2, 2])
+        self.assertEqual(sorted(export.manifest['dictionaries']['answer'][code - 1]
+                                for code in answers['answer'][1:]), [1, 10])
+        self.assertEqual(list(read_table(self.directory, 'walkthroughs')['completed']), [0, 1])
+
+
+def changelist(model_admin, **params):
+    request = RequestFactory().get('/', params)
+    return model_admin.get_changelist(request)(request, model_admin.model, model_admin.list_display,
+        model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy,
+        model_admin.search_fields, model_admin.list_select_related, model_admin.list_per_page,
+        model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+
+
+class AdminTest(TestCase):
+    fixtures = ['test.json',]
+
+    def test_walkthrough_changelist_queries(self):
+        for answer_id in (1, 2, 1):
+            Walkthrough.objects.create(poll_id=1).answers.add(answer_id)
+        request = RequestFactory().get('/')
+        walkthrough_admin = WalkthroughAdmin(Walkthrough, admin.site)
+
+        with self.assertNumQueries(1):
+            rows = [[unicode(lookup_field(name, walkthrough, walkthrough_admin)[2])
+                     for name in walkthrough_admin.list_display]
+                    for walkthrough in walkthrough_admin.queryset(request)]
+        self.assertEqual(len(rows), Walkthrough.objects.count())
+
+    def test_keyset_changelist(self):
+        for i in range(5):
+            Walkthrough.objects.create(poll_id=1)
+        walkthrough_admin = WalkthroughAdmin(Walkthrough, admin.site)
+        walkthrough_admin.list_per_page = 2
+        override_app_settings(self, ADMIN_COUNT_LIMIT=3)
+
+        cl = changelist(walkthrough_admin)
+        ids = [walkthrough.pk for walkthrough in cl.result_list]
+        self.assertEqual(ids, list(Walkthrough.objects.order_by('-id').values_list('id', flat=True)[:2]))
+        # counted up to the limit only
+        self.assertEqual(cl.result_count, 3)
+
+        cl = changelist(walkthrough_admin, id__lt=ids[-1])
+        self.assertEqual(cl.result_list[0].pk, Walkthrough.objects.filter(id__lt=ids[-1]).order_by('-id')[0].pk)
+        self.assertEqual(cl.newest_query_string, '?')
+        self.assertIn('id__lt=%s' % cl.result_list[-1].pk, cl.older_query_string)
+
+    def test_profile_filters(self):
+        cache.clear()
+        Profile.objects.create(text='not in any poll')
+        AnswerProfile.objects.create(answer_id=1, profile_id=1, quantifier=1)
+        AnswerProfile.objects.create(answer_id=2, profile_id=1, quantifier=1)
+        profile_admin = ProfileAdmin(Profile, admin.site)
+
+        cl = changelist(profile_admin, poll=1)
+        self.assertEqual([p.pk for p in cl.result_list], [1])
+        with self.assertNumQueries(0):
+            choices = cl.filter_specs[0].lookups(RequestFactory().get('/'), profile_admin)
+        self.assertEqual(set(id for id, title in choices), set(Poll.objects.values_list('id', flat=True)))
+
+        cl = changelist(profile_admin, question=3)
+        self.assertEqual(list(cl.result_list), [])
+        self.assertEqual(len(cl.filter_specs[2].lookup_choices), Answer.objects.filter(question=3).count())
+
+
+class BenchmarkTest(TestCase):
+    urls = 'profilingpoll.urls'
+
+    def test_flow_queries_independent_of_poll_size(self):
+        cache.clear()
+        override_app_settings(self, STATS_SHARDS=1)
+        small = benchmark.run_flow(benchmark.create_poll(questions=2, answers=2, profiles=2), walkthroughs=2)
+        large = benchmark.run_flow(benchmark.create_poll(questions=8, answers=6, profiles=10), walkthroughs=2)
+
+        for view in ('question', 'answer', 'get_email', 'email', 'result'):
+            self.assertEqual(small[view]['max_queries'], large[view]['max_queries'], view)
+        self.assertEqual(small['session_size'], large['session_size'])
+        self.assertEqual(benchmark.compare(large, dict(large, session_size=100)),
+                         ['session_size: %s, baseline 100' % large['session_size']])
+        baseline = dict(large, result=dict(large['result'], max_queries=large['result']['max_queries'] - 1))
+        self.assertEqual(benchmark.compare(large, baseline), ['result.max_queries: %s, baseline %s' % (
+            large['result']['max_queries'], large['result']['max_queries'] - 1)])
+
+    def test_export(self):
+        poll = benchmark.create_poll(questions=3, answers=2, profiles=3)
+        benchmark.create_walkthroughs(poll, 25, batch_size=10)
+
+        results = benchmark.run_export(poll, chunk_size=10)
+        self.assertEqual(results['rows'], 25)
+        # three chunks and the empty last one, the poll and the profiles of the first chunk
+        self.assertEqual(results['queries'], 4 + 1 + 1)
+        self.assertEqual(benchmark.compare(results, dict(results, queries=5)), ['queries: 6, baseline 5'])
+
+
+@skipIf(len(settings.DATABASES) < 2, 'needs a second database')
+class ShardingTest(TestCase):
+    fixtures = ['test.json',]
+    urls = 'profilingpoll.urls'
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.router = ShardRouter()
+        router.routers.insert(0, self.router)
+        self.shards = app_settings.SHARDS
+        self.shards_setting = app_settings.SHARDS = ['default', [alias for alias in sorted(settings.DATABASES)
+                                                                 if alias != 'default'][0]]
+        sharding.walkthrough_ids.next = sharding.walkthrough_ids.end = 0
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        app_settings.SHARDS = self.shards
+        sharding.walkthrough_ids.next = sharding.walkthrough_ids.end = 0
+
+    def submit(self, answers):
+        return json.loads(self.client.post('/bester-kurs/submit.json', json.dumps({'answers': answers}),
+                                           content_type='application/json').content)
+
+    def test_walkthroughs_on_shards(self):
+        AnswerProfile.objects.create(answer_id=2, profile_id=1, quantifier=3)
+        results = [self.submit([2, 10]) for i in range(4)]
+        ids = [result['walkthrough'] for result in results]
+        self.assertEqual(len(set(ids)), 4)
+        self.assertTrue(min(ids) > 1)
+
+        for walkthrough_id in ids:
+            shard = sharding.shard_for(walkthrough_id)
+            other = [alias for alias in app_settings.SHARDS if alias != shard][0]
+            self.assertTrue(Walkthrough.objects.using(shard).get(pk=walkthrough_id).completed)
+            self.assertFalse(Walkthrough.objects.using(other).filter(pk=walkthrough_id).exists())
+            self.assertEqual(sorted(Walkthrough.answers.through.objects.using(shard).filter(
+                walkthrough=walkthrough_id).values_list('answer_id', flat=True)), [2, 10])
+        self.assertEqual(set(sharding.shard_for(walkthrough_id) for walkthrough_id in ids), set(app_settings.SHARDS))
+
+        # the walkthrough flow and the result pages resolve the shard
+        self.client.post('/bester-kurs/1/', {'answer': 2})
+        self.client.post('/bester-kurs/3/', {'answer': 10})
+        response = self.client.post('/bester-kurs/finished/', {'email': 'test@example.com'})
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.context['profile'].pk, 1)
+        self.assertEqual(self.client.get(results[0]['result_url']).context['profile'].pk, 1)
 
-        # TODO: Really test this behaviour
+        # exports, statistics and admin see the walkthroughs of all shards
+        exported = set(row['id'] for chunk in iter_walkthrough_chunks(with_email=False, chunk_size=2)
+                       for row in chunk)
+        self.assertTrue(exported.issuperset(ids))
+        rebuild_stats(1)
+        self.assertEqual(get_stats(1).completed, sum(queryset.filter(poll=1, _completed__isnull=False).count()
+                                                     for queryset in Walkthrough.objects.shards()))
 
+        walkthrough_admin = WalkthroughAdmin(Walkthrough, admin.site)
+        request = RequestFactory().get('/')
+        for walkthrough_id in ids:
+            self.assertEqual(walkthrough_admin.get_object(request, walkthrough_id).pk, walkthrough_id)
+        cl = changelist(walkthrough_admin, shard=app_settings.SHARDS[1])
+        self.assertEqual(set(walkthrough.pk for walkthrough in cl.result_list),
+                         set(Walkthrough.objects.using(app_settings.SHARDS[1]).values_list('id', flat=True)))
 
+    def test_move_walkthroughs(self):
+        app_settings.SHARDS = None
+        walkthroughs = [Walkthrough.objects.create(poll_id=1) for i in range(4)]
+        for walkthrough in walkthroughs:
+            walkthrough.answers.add(2)
+        modified = Walkthrough.objects.get(pk=walkthroughs[0].pk).modified
+        app_settings.SHARDS = self.shards_setting
 
+        misplaced = [walkthrough.pk for walkthrough in walkthroughs if sharding.shard_for(walkthrough.pk) != 'default']
+        self.assertTrue(misplaced)
+        self.assertEqual(sharding.move_walkthroughs(dry_run=True), len(misplaced) + 1)
+        self.assertEqual(sharding.move_walkthroughs(chunk_size=2), len(misplaced) + 1)
+        self.assertEqual(sharding.move_walkthroughs(), 0)
 
+        for walkthrough in walkthroughs:
+            moved = Walkthrough.objects.shard(walkthrough.pk).get(pk=walkthrough.pk)
+            self.assertEqual(list(Walkthrough.answers.through.objects.using(moved._state.db).filter(
+                walkthrough=moved).values_list('answer_id', flat=True)), [2])
+            self.assertEqual(moved.get_answered_bitmap(), walkthrough.get_answered_bitmap())
+        self.assertFalse(Walkthrough.objects.using('default').filter(pk__in=misplaced).exists())
+        self.assertEqual(Walkthrough.objects.shard(walkthroughs[0].pk).get(pk=walkthroughs[0].pk).modified, modified)
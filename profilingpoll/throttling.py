@@ -0,0 +1,156 @@
+"""
+Throttling of the answer path.
+
+Clients are told apart by REMOTE_ADDR and user agent. Every client has a token bucket
+of PROFILINGPOLL_THROTTLE_BURST answers, refilled with PROFILINGPOLL_THROTTLE_RATE
+answers per minute; posts finding the bucket empty are rejected before the session
+or the database are touched. The local backend keeps the buckets in process memory,
+so every worker throttles on its own; the cache backend shares fixed windows of
+burst answers per client through the django cache instead, at the cost of a cache
+roundtrip per post.
+
+With PROFILINGPOLL_DUPLICATE_WALKTHROUGH_WINDOW, a client without walkthrough in its
+session (e.g. a bot dropping its cookies) continues the walkthrough it started last
+within the window instead of creating a new one, as long as that one isn't completed.
+Clients behind one NAT with the same browser share a key, so they may continue each
+others walkthroughs within the window; keep it short or off where that matters.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from . import app_settings
+
+
+def client_key(request):
+    """
+    returns the key of the client of request, computed once per request
+    """
+    if not hasattr(request, '_profilingpoll_client'):
+        request._profilingpoll_client = hashlib.md5(smart_str('%s|%s' % (
+            request.META.get('REMOTE_ADDR', ''), request.META.get('HTTP_USER_AGENT', '')))).hexdigest()
+    return request._profilingpoll_client
+
+
+class LocalBackend(object):
+    """
+    token buckets and last walkthroughs in process memory, the least recently seen
+    clients are dropped beyond THROTTLE_CLIENTS
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()        # client -> (tokens, timestamp)
+        self.walkthroughs = OrderedDict()   # (client, poll id) -> (walkthrough id, expiry)
+
+    def _remember(self, entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > app_settings.THROTTLE_CLIENTS:
+            entries.popitem(last=False)
+
+    def consume(self, client, rate, burst):
+        now = time.time()
+        with self.lock:
+            tokens, last = self.buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate / 60.0)
+            allowed = tokens >= 1
+            self._remember(self.buckets, client, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    def get_walkthrough(self, client, poll_id):
+        with self.lock:
+            walkthrough_id, expiry = self.walkthroughs.get((client, poll_id), (None, 0))
+        return walkthrough_id if expiry > time.time() else None
+
+    def set_walkthrough(self, client, poll_id, walkthrough_id, timeout):
+        with self.lock:
+            self._remember(self.walkthroughs, (client, poll_id), (walkthrough_id, time.time() + timeout))
+
+    def delete_walkthrough(self, client, poll_id):
+        with self.lock:
+            self.walkthroughs.pop((client, poll_id), None)
+
+
+class CacheBackend(object):
+    """
+    fixed windows of burst answers per client and last walkthroughs in the django cache
+    """
+    def consume(self, client, rate, burst):
+        window = max(1, int(60.0 * burst / rate))
+        key = 'profilingpoll:throttle:%s:%d' % (client, time.time() // window)
+        cache.add(key, 0, window)
+        try:
+            return cache.incr(key) <= burst
+        except ValueError:
+            # evicted in the meantime
+            return True
+
+    def get_walkthrough(self, client, poll_id):
+        return cache.get('profilingpoll:recent:%s:%s' % (client, poll_id))
+
+    def set_walkthrough(self, client, poll_id, walkthrough_id, timeout):
+        cache.set('profilingpoll:recent:%s:%s' % (client, poll_id), walkthrough_id, timeout)
+
+    def delete_walkthrough(self, client, poll_id):
+        cache.delete('profilingpoll:recent:%s:%s' % (client, poll_id))
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'cache': CacheBackend,
+}
+
+_backends = {}
+
+
+def get_backend():
+    name = app_settings.THROTTLE_BACKEND
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def throttled(request):
+    """
+    returns True if the client of request posts too fast, otherwise takes one answer
+    from its bucket
+    """
+    if not app_settings.THROTTLE_RATE:
+        return False
+    return not get_backend().consume(client_key(request), app_settings.THROTTLE_RATE, app_settings.THROTTLE_BURST)
+
+
+def retry_after():
+    """
+    returns the seconds until a throttled client gets the next answer
+    """
+    return max(1, int(60.0 / app_settings.THROTTLE_RATE + 0.5))
+
+
+def recent_walkthrough(request, poll_id):
+    """
+    returns the id of the walkthrough the client of request started last in poll
+    within DUPLICATE_WALKTHROUGH_WINDOW seconds, or None
+    """
+    if not app_settings.DUPLICATE_WALKTHROUGH_WINDOW:
+        return None
+    return get_backend().get_walkthrough(client_key(request), poll_id)
+
+
+def remember_walkthrough(request, walkthrough):
+    if app_settings.DUPLICATE_WALKTHROUGH_WINDOW:
+        get_backend().set_walkthrough(client_key(request), walkthrough.poll_id, walkthrough.pk,
+                                      app_settings.DUPLICATE_WALKTHROUGH_WINDOW)
+
+
+def forget_walkthrough(request, poll_id):
+    """
+    stops continuing the last walkthrough of the client of request in poll, e.g. once
+    it is completed
+    """
+    if app_settings.DUPLICATE_WALKTHROUGH_WINDOW:
+        get_backend().delete_walkthrough(client_key(request), poll_id)
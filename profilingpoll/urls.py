@@ -1,12 +1,17 @@
 from django.conf.urls import patterns, url
 
-from .views import poll_list, poll_detail, question, get_email, result
+from .views import (poll_list, poll_detail, question, answer, get_email, result, submit_walkthrough,
+                    export_walkthroughs, slow_paths)
 
 
 urlpatterns = patterns('',
     url(r'^$', poll_list, name='profilingpoll_poll_list'),
+    url(r'^export/walkthroughs\.(?P<format>csv|jsonl)$', export_walkthroughs, name='profilingpoll_export_walkthroughs'),
+    url(r'^instrumentation/slow/$', slow_paths, name='profilingpoll_instrumentation'),
     url(r'^(?P<slug>[\w-]+)/$', poll_detail, name='profilingpoll_poll_detail'),
     url(r'^(?P<poll__slug>[\w-]+)/(?P<id>\d+)/$', question, name='profilingpoll_question'),
+    url(r'^(?P<poll__slug>[\w-]+)/(?P<id>\d+)/answer/$', answer, name='profilingpoll_answer'),
     url(r'^(?P<slug>[\w-]+)/finished/$', get_email, name='profilingpoll_get_email'),
+    url(r'^(?P<slug>[\w-]+)/submit\.json$', submit_walkthrough, name='profilingpoll_submit_walkthrough'),
     url(r'^result/(?P<hash>[\S^/\?=#]+)/$', result, name='profilingpoll_result'),
 )
\ No newline at end of file
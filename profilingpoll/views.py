@@ -1,25 +1,68 @@
+import hashlib
+import json
+
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core import signing
 from django.core.urlresolvers import reverse
-from django.shortcuts import redirect, get_object_or_404
-from django.views.generic import ListView, RedirectView, FormView, DetailView
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
+from django.shortcuts import redirect, get_object_or_404, render
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from django.views.generic import ListView, RedirectView, FormView, TemplateView
+from django.utils.functional import SimpleLazyObject
 from django.views.generic.detail import SingleObjectTemplateResponseMixin, SingleObjectMixin
 
+from . import app_settings, instrumentation, scoring
+from .buffer import get_buffer
+from .exports import FORMATS, parse_date
 from .forms import AnswerForm, EmailForm
-from .models import Poll, Question, Walkthrough
+from .instrumentation import instrumented
+from .models import Poll, Question, Profile, Walkthrough
+from .plan import get_plan, get_question
+from .polls import get_registry
+from .results import get_snapshot
+from .stats import get_stats
+from .sharding import shard_for, walkthrough_ids
+from .session import (get_state, set_state, start_walkthrough, continue_walkthrough, get_walkthrough,
+                      complete_walkthrough, flush_pending, choice_code, get_client_choices, set_client_state)
+from .throttling import throttled, retry_after, recent_walkthrough, remember_walkthrough
+
+
+def lazy_walkthrough(request):
+    """
+    returns the current walkthrough for the template context, fetched only when used
+    """
+    if get_state(request) is None:
+        return None
+    return SimpleLazyObject(lambda: get_walkthrough(request))
 
 
 class SingleRedirectToDetailListView(ListView):
     def render_to_response(self, context, **response_kwargs):
-        if Poll.objects.filter(active=True).count() == 1:
-            return redirect(Poll.objects.filter(active=True)[0])
+        registry = get_registry()
+        if len(registry) == 1:
+            return redirect('profilingpoll_poll_detail', slug=registry.polls[0].slug)
         else:
             return super(ListView, self).render_to_response(context, **response_kwargs)
 
 
 class RedirectToFirstQuestion(RedirectView):
     def get_redirect_url(self, **kwargs):
-        poll = get_object_or_404(Poll, slug=kwargs['slug'])
-        return poll.questions.all()[0].get_absolute_url()
+        poll = get_registry().get(kwargs['slug'])
+        if poll is not None:
+            url = poll.first_question_url
+        else:
+            # inactive polls aren't registered
+            plan = get_object_or_404(Poll, slug=kwargs['slug']).get_plan()
+            url = plan.first_question_id and plan.question_url(plan.first_question_id)
+
+        if not url:
+            raise Http404
+        return url
 
 
 class QuestionView(FormView, SingleObjectTemplateResponseMixin, SingleObjectMixin):
@@ -28,106 +71,244 @@ class QuestionView(FormView, SingleObjectTemplateResponseMixin, SingleObjectMixi
 
     @property
     def object(self):
-        return self.get_object()
+        # looked up once per request
+        if not hasattr(self, '_object'):
+            self._object = self.get_object()
+        return self._object
+
+    @property
+    def cacheable(self):
+        """
+        True, if this page is served the same to everyone, see PROFILINGPOLL_CACHEABLE_QUESTIONS
+        """
+        return app_settings.CACHEABLE_QUESTIONS and self.request.method in ('GET', 'HEAD')
 
     def get(self, request, *args, **kwargs):
         form_class = self.get_form_class()
 
         try:
+            if self.cacheable:
+                return self.get_cacheable(form_class)
             form = self.get_form(form_class)
             return self.render_to_response(self.get_context_data(form=form))
         except Question.DoesNotExist:
             return redirect('profilingpoll_poll_list')
 
+    def get_etag(self):
+        question = self.object
+        plan = get_plan(question.poll_id)
+        return hashlib.md5('%s:%s' % (plan.version, question.pk)).hexdigest()
+
+    def get_cacheable(self, form_class):
+        """
+        renders the question without walkthrough state, revalidated by the version of the poll plan
+        """
+        etag = self.get_etag()
+
+        if etag in parse_etags(self.request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = self.render_to_response(self.get_context_data(form=self.get_form(form_class)))
+        response['ETag'] = quote_etag(etag)
+        patch_cache_control(response, public=True, max_age=app_settings.QUESTION_MAX_AGE)
+        return response
+
     def get_object(self, queryset=None):
-        queryset = queryset or self.get_queryset()
-        return queryset.get(**self.kwargs)
+        if queryset is not None:
+            return queryset.get(**self.kwargs)
+        return get_question(int(self.kwargs['id']), self.kwargs['poll__slug'])
 
     def get_form_kwargs(self):
         kwargs = super(QuestionView, self).get_form_kwargs()
-        kwargs['question'] = self.get_object()
+        kwargs['question'] = self.object
         return kwargs
 
     def get_initial(self):
         initial = self.initial.copy()
-        walkthrough = self.request.session.get('current_walkthrough', None)
-
-        if walkthrough and self.object in walkthrough.answered_questions:
-            try:
-                given_answer = walkthrough.answers.filter(question=self.object)[0]
-                initial.update({'answer': given_answer.id})
-            except IndexError:
-                pass
+        if self.cacheable:
+            # the answer given is selected client side
+            return initial
+
+        state = get_state(self.request)
+        question = self.object
+        plan = get_plan(question.poll_id)
+
+        if state and state.is_answered(plan.index(question.pk)):
+            if state.pending and self.request.method == 'GET':
+                # the answers given may still be in the answer buffer
+                flush_pending(self.request)
+            given_answers = list(Walkthrough.answers.through.objects.using(shard_for(state.id)).filter(
+                walkthrough=state.id,
+                answer__in=[answer_id for answer_id, text in plan.answer_choices(question.pk)]
+            ).values_list('answer_id', flat=True))
+
+            if given_answers and plan.allows_multiple(question.pk):
+                initial.update({'answer': sorted(given_answers)})
+            elif given_answers:
+                initial.update({'answer': given_answers[0]})
 
         return initial
 
     def get_context_data(self, **kwargs):
-        kwargs['object'] = self.get_object()
-        kwargs['walkthrough'] = self.request.session.get('current_walkthrough', None)
+        kwargs['object'] = self.object
+
+        if self.cacheable:
+            plan = get_plan(kwargs['object'].poll_id)
+            kwargs['cacheable'] = True
+            kwargs['walkthrough'] = None
+            kwargs['layout'] = plan.layout
+            kwargs['index'] = plan.index(kwargs['object'].pk)
+            kwargs['question_urls'] = [plan.question_url(question_id) for question_id in plan.question_ids]
+            kwargs['answer_url'] = reverse('profilingpoll_answer', kwargs={'poll__slug': plan.slug,
+                                                                          'id': kwargs['object'].pk})
+            kwargs['state_cookie'] = app_settings.STATE_COOKIE
+            kwargs['csrf_cookie'] = settings.CSRF_COOKIE_NAME
+            kwargs['csrf_cookie_path'] = settings.CSRF_COOKIE_PATH
+        else:
+            kwargs['walkthrough'] = lazy_walkthrough(self.request)
         return kwargs
 
-    def form_valid(self, form):
-        if not self.request.session.get('current_walkthrough', None):
-            self.request.session['current_walkthrough'] = Walkthrough.objects.create(
-                poll=self.object.poll,
-                ip=self.request.META['REMOTE_ADDR'] or None,
-                user_agent=self.request.META['HTTP_USER_AGENT'] or None
-            )
-
-        answer = self.object.answers.get(id=form.cleaned_data['answer'])
-        self.request.session['current_walkthrough'].answers.add(answer)
-        self.request.session.modified = True
+    def post(self, request, *args, **kwargs):
+        # rejected before the question, the session or the database are looked at
+        if throttled(request):
+            return _throttled(HttpResponse('Too many answers, please retry later.', content_type='text/plain'))
+        return super(QuestionView, self).post(request, *args, **kwargs)
 
-        return super(QuestionView, self).form_valid(form)
+    def form_valid(self, form):
+        question = self.object
+        state = get_state(self.request)
+        answer_buffer = get_buffer()
+
+        if state and not answer_buffer and get_walkthrough(self.request) is None:
+            # archived in the meantime: restarts with a new walkthrough
+            state = None
+        created = not state
+
+        if not state:
+            walkthrough_id = recent_walkthrough(self.request, question.poll_id)
+            state = walkthrough_id and continue_walkthrough(self.request, walkthrough_id)
+            if not state:
+                walkthrough = Walkthrough.objects.create(
+                    poll_id=question.poll_id,
+                    ip=self.request.META.get('REMOTE_ADDR') or None,
+                    user_agent=self.request.META.get('HTTP_USER_AGENT') or None
+                )
+                remember_walkthrough(self.request, walkthrough)
+                state = start_walkthrough(self.request, walkthrough)
+
+        # the form only offers the answers of this question, as compiled in the poll plan
+        answer_ids = form.get_answer_ids()
+
+        if answer_buffer:
+            answer_buffer.append(question.poll_id, state.id, question.pk, answer_ids)
+            state.pending = True
+        else:
+            # replaces the answers to this question and rescores once, also for several checkboxes
+            scoring.set_answers({get_walkthrough(self.request): {question.pk: answer_ids}})
+        state.mark_answered(state.plan.index(question.pk))
+        set_state(self.request, state)
+
+        response = super(QuestionView, self).form_valid(form)
+        if app_settings.CACHEABLE_QUESTIONS:
+            plan = state.plan
+            choices = ['0'] * len(plan) if created else get_client_choices(self.request, state)
+            choices[plan.index(question.pk)] = choice_code(plan, question.pk, answer_ids[0])
+            set_client_state(response, state, choices)
+        return response
 
     def get_success_url(self):
-        next = self.get_object().next()
+        question = self.object
+        plan = get_plan(question.poll_id)
+        next_id = plan.next_question_id(question.pk)
 
-        if next != None:
-            return next.get_absolute_url()
+        if next_id is not None:
+            return plan.question_url(next_id)
         else:
-            return reverse('profilingpoll_get_email', kwargs={'slug': self.object.poll.slug})
+            return reverse('profilingpoll_get_email', kwargs={'slug': plan.slug})
 
     def render_to_response(self, context, **response_kwargs):
         """
         Redirect, if this question can not be answered now. E.g. outside workflow.
         """
-        walkthrough = self.request.session.get('current_walkthrough', None)
-        first_question = self.object.poll.get_first_question()
+        # cacheable pages apply these rules client side
+        if self.cacheable:
+            return super(QuestionView, self).render_to_response(context, **response_kwargs)
+
+        state = get_state(self.request)
+        question = self.object
+        plan = get_plan(question.poll_id)
 
         # first case: if there is no walkthrough in the session, this has to be the first question
-        if not walkthrough:
-            if self.object != first_question:
-                return redirect(first_question)
+        if not state:
+            if question.pk != plan.first_question_id:
+                return redirect(plan.question_url(plan.first_question_id))
         else:
-            next_question = walkthrough.get_next_question()
+            next_id = state.next_question_id()
 
             # second case, the answer isn't answered and not the next answer
-            if next_question and not self.object.question_answered(walkthrough) and not self.object == next_question:
-                return redirect(next_question)
+            if next_id and not state.is_answered(plan.index(question.pk)) and not question.pk == next_id:
+                return redirect(plan.question_url(next_id))
 
         # else: Do it
         return super(QuestionView, self).render_to_response(context, **response_kwargs)
 
 
-class ResultView(DetailView):
-    model = Walkthrough
+class AnswerView(QuestionView):
+    """
+    takes the answers posted from cacheable question pages, which add the csrf token of
+    the csrf cookie client side
+    """
+    http_method_names = ['post']
+
+    def dispatch(self, request, *args, **kwargs):
+        if not app_settings.CACHEABLE_QUESTIONS:
+            raise Http404
+        return super(AnswerView, self).dispatch(request, *args, **kwargs)
+
+
+class ResultView(TemplateView):
+    """
+    shows the result snapshot of a walkthrough, completing it for its owner first
+    """
+    template_name = 'profilingpoll/walkthrough_detail.html'
 
     def get(self, request, *args, **kwargs):
-        if self.request.session.get('current_walkthrough', None):
-            if not self.request.session.get('completed_walkthroughs', None):
-                self.request.session['completed_walkthroughs'] = []
-            self.request.session['completed_walkthroughs'].append(self.request.session['current_walkthrough'])
-            self.request.session['current_walkthrough'] = None
-            self.request.session.modified = True
+        try:
+            walkthrough_id = signing.loads(self.kwargs['hash'])
+        except signing.BadSignature:
+            raise Http404
 
-        return super(DetailView, self).get(request, *args, **kwargs)
+        state = get_state(self.request)
+        completing = bool(state and state.id == walkthrough_id)
+        if completing:
+            flush_pending(self.request)
+            complete_walkthrough(self.request)
 
-    def get_object(self, queryset=None):
-        if queryset is None:
-            queryset = self.get_queryset()
+        try:
+            self.snapshot = get_snapshot(walkthrough_id)
+        except Walkthrough.DoesNotExist:
+            raise Http404
 
-        return get_object_or_404(queryset, id=signing.loads(self.kwargs['hash']))
+        response = super(ResultView, self).get(request, *args, **kwargs)
+        if app_settings.STATE_COOKIE in request.COOKIES and not get_state(self.request):
+            set_client_state(response, None)
+        elif self.snapshot.completed and not completing:
+            patch_cache_control(response, public=True, max_age=app_settings.RESULT_MAX_AGE)
+        return response
+
+    def get_context_data(self, **kwargs):
+        kwargs = super(ResultView, self).get_context_data(**kwargs)
+        snapshot = self.snapshot
+
+        # the walkthrough and the live statistics are only fetched if a template uses them
+        kwargs['object'] = kwargs['walkthrough'] = SimpleLazyObject(
+            lambda: Walkthrough.objects.shard(snapshot.walkthrough_id).get(pk=snapshot.walkthrough_id))
+        kwargs['stats'] = SimpleLazyObject(lambda: get_stats(snapshot.poll_id))
+        kwargs['snapshot'] = snapshot
+        kwargs['profile'] = snapshot.profile
+        kwargs['profile_share'] = snapshot.profile_share
+        kwargs['answer_shares'] = snapshot.answer_shares
+        return kwargs
 
 
 class EmailView(FormView, SingleObjectTemplateResponseMixin, SingleObjectMixin):
@@ -137,66 +318,169 @@ class EmailView(FormView, SingleObjectTemplateResponseMixin, SingleObjectMixin):
 
     @property
     def object(self):
-        return self.get_object()
+        # looked up once per request
+        if not hasattr(self, '_object'):
+            self._object = self.get_object()
+        return self._object
 
     def get_object(self, queryset=None):
         queryset = queryset or self.get_queryset()
         return queryset.get(**self.kwargs)
 
-    def form_valid(self, form):
-        walkthrough = self.request.session.get('current_walkthrough', None)
-        first_question = self.get_object().get_first_question()
+    def get_redirect(self):
+        """
+        returns a redirect to the question to answer, if the walkthrough isn't completed
+        """
+        state = get_state(self.request)
+
+        if not state:
+            plan = self.object.get_plan()
+            return redirect(plan.question_url(plan.first_question_id))
 
-        if not walkthrough:
-            return redirect(first_question)
+        if not state.completed:
+            return redirect(state.plan.question_url(state.next_question_id()))
 
-        # somehow, the session walkthrough differs from the database walkthrough. so get it proper
-        walkthrough = Walkthrough.objects.get(id=walkthrough.id)
+        return None
 
-        if not walkthrough.completed:
-            return redirect(walkthrough.get_next_question())
+    def form_valid(self, form):
+        response = self.get_redirect()
+        if response:
+            return response
+
+        # the result page needs the profile, so the answers have to be in the database now
+        flush_pending(self.request)
 
         if form.cleaned_data['email']:
-            walkthrough.email = form.cleaned_data['email']
-            walkthrough.save()
-        self.request.session['current_walkthrough'] = walkthrough
+            walkthrough_id = get_state(self.request).id
+            Walkthrough.objects.shard(walkthrough_id).filter(pk=walkthrough_id).update(
+                email=form.cleaned_data['email'])
 
         return super(EmailView, self).form_valid(form)
 
     def get_context_data(self, **kwargs):
-        kwargs['object'] = self.get_object()
-        kwargs['walkthrough'] = self.request.session.get('current_walkthrough', None)
+        kwargs['object'] = self.object
+        kwargs['walkthrough'] = lazy_walkthrough(self.request)
         return kwargs
 
     def get_success_url(self):
-        walkthrough = self.request.session.get('current_walkthrough')
-        return walkthrough.get_absolute_url()
+        return Walkthrough(pk=get_state(self.request).id).get_absolute_url()
 
     def render_to_response(self, context, **response_kwargs):
-        walkthrough = self.request.session.get('current_walkthrough', None)
-        first_question = self.get_object().get_first_question()
-
-        if not walkthrough:
-            return redirect(first_question)
-
-        # somehow, the session walkthrough differs from the database walkthrough. so get it proper
-        walkthrough = Walkthrough.objects.get(id=walkthrough.id)
-
-        if not walkthrough.completed:
-            next = walkthrough.get_next_question()
-            
-            # get_next_question double tests, if the walkthrough is completed and sets it, if needed.
-            if next:
-                return redirect(next)
-
-        return super(EmailView, self).render_to_response(context, **response_kwargs)
-
-
-poll_list = SingleRedirectToDetailListView.as_view(
+        return self.get_redirect() or super(EmailView, self).render_to_response(context, **response_kwargs)
+
+
+def _json_response(data, response_class=HttpResponse):
+    return response_class(json.dumps(data), content_type='application/json')
+
+
+def _throttled(response):
+    response.status_code = 429
+    response['Retry-After'] = str(retry_after())
+    return response
+
+
+@csrf_exempt
+@require_POST
+@instrumented('view.submit_walkthrough', view=True)
+def submit_walkthrough(request, slug):
+    """
+    creates a completed walkthrough from all answers at once. Expects a JSON body
+    {"answers": [answer ids], "email": optional} and returns the matching profile and
+    the result url. Costs a fixed number of queries, independent of the poll size.
+    """
+    if throttled(request):
+        return _throttled(_json_response({'error': 'Too many requests'}))
+
+    try:
+        poll_id = Poll.objects.filter(slug=slug).values_list('id', flat=True)[0]
+    except IndexError:
+        raise Http404
+
+    try:
+        data = json.loads(request.body)
+        answer_ids = [int(answer_id) for answer_id in data['answers']]
+        email = data.get('email') or None
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return _json_response({'error': 'Expected {"answers": [answer ids]}'}, HttpResponseBadRequest)
+
+    plan = get_plan(poll_id)
+    try:
+        questions = plan.group_answers(answer_ids)
+    except ValueError as e:
+        return _json_response({'error': str(e)}, HttpResponseBadRequest)
+
+    if email:
+        form = EmailForm({'email': email})
+        if not form.is_valid():
+            return _json_response({'error': 'Invalid email'}, HttpResponseBadRequest)
+
+    # the walkthrough is only stored together with its answers, on its shard
+    walkthrough_id = walkthrough_ids.allocate() if app_settings.SHARDS else None
+    using = shard_for(walkthrough_id) if walkthrough_id else DEFAULT_DB_ALIAS
+    with transaction.commit_on_success(using=using):
+        walkthrough = Walkthrough.objects.using(using).create(
+            id=walkthrough_id,
+            poll_id=poll_id,
+            email=email,
+            ip=request.META.get('REMOTE_ADDR') or None,
+            user_agent=request.META.get('HTTP_USER_AGENT') or None
+        )
+        scoring.set_answers({walkthrough: questions})
+
+    profile = None
+    profile_id = walkthrough._matching_profile_id or plan.default_profile_id
+    if profile_id:
+        profile = Profile.objects.values('id', 'description', 'text', 'link', 'link_text').get(pk=profile_id)
+
+    return _json_response({
+        'walkthrough': walkthrough.pk,
+        'hash': signing.dumps(walkthrough.pk),
+        'result_url': request.build_absolute_uri(walkthrough.get_absolute_url()),
+        'profile': profile,
+    })
+
+
+@staff_member_required
+def export_walkthroughs(request, format):
+    """
+    streams the walkthroughs with email as csv or JSON lines. Filters: ?poll=<slug>&since=<Y-m-d>&until=<Y-m-d>
+    """
+    poll = None
+    if request.GET.get('poll'):
+        poll = get_object_or_404(Poll, slug=request.GET['poll'])
+
+    try:
+        since, until = parse_date(request.GET.get('since')), parse_date(request.GET.get('until'))
+    except ValueError:
+        raise Http404
+
+    rows, content_type = FORMATS[format]
+    response = StreamingHttpResponse(rows(poll=poll, since=since, until=until), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=walkthroughs.%s' % format
+    return response
+
+
+@staff_member_required
+def slow_paths(request):
+    """
+    lists the instrumented views and scoring calls, slowest first. ?order=total|mean|p99|queries
+    """
+    order = request.GET.get('order')
+    if order not in ('total', 'mean', 'p99', 'queries'):
+        order = 'total'
+    return render(request, 'profilingpoll/instrumentation.html', {
+        'enabled': app_settings.INSTRUMENTATION,
+        'order': order,
+        'summaries': instrumentation.top(limit=50, order_by=order),
+    })
+
+
+poll_list = instrumented('view.poll_list', view=True)(SingleRedirectToDetailListView.as_view(
     queryset=Poll.objects.filter(active=True)
-)
+))
 
-get_email = EmailView.as_view()
-poll_detail = RedirectToFirstQuestion.as_view()
-question = QuestionView.as_view()
-result = ResultView.as_view()
\ No newline at end of file
+get_email = instrumented('view.get_email', view=True)(EmailView.as_view())
+poll_detail = instrumented('view.poll_detail', view=True)(RedirectToFirstQuestion.as_view())
+question = instrumented('view.question', view=True)(QuestionView.as_view())
+answer = csrf_protect(instrumented('view.answer', view=True)(AnswerView.as_view()))
+result = instrumented('view.result', view=True)(ResultView.as_view())
\ No newline at end of file